@@ -1,16 +1,54 @@
 """
-`alana` includes five components:
+`alana` includes twenty-four components:
     - color
     - prompt
     - (experimental) prompt_async
     - globals
     - aliases
+    - embed
+    - export
+    - stream
+    - loop
+    - structured
+    - tools
+    - sampling
+    - batching
+    - scheduler
+    - jobs
+    - dataset
+    - templates
+    - optimize
+    - tags
+    - cache
+    - examples
+    - dedup
+    - mapreduce
+    - pool
 
 `color` is a simple utilities library that provides color print using colorama.Fore.
 `prompt` is the meat of `alana`, including functions for interacting with Anthropic.
 (experimental) `prompt_async` uses AsyncAnthropic. Supports features like streaming.
 `globals` contains model names and prompts.
 `aliases` include alternate names for common functions.
+`embed` has pluggable string embedders and a persistent, memory-mapped embedding cache (used by `data_atlas`).
+`export` writes figures to disk on a background worker with atomic, unique filenames.
+`stream` has the typed events yielded by `astream`, plus stream helpers like `Fanout`, stop predicates for `stop_when`, and a streaming `Redactor`.
+`loop` runs a persistent background event loop, so sync code (and Jupyter) can call the `agen*` coroutines.
+`structured` generates JSON validated against a JSON Schema, dataclass or TypedDict while it streams.
+`tools` runs tool-use loops over plain Python functions, dispatching each turn's tool calls concurrently.
+`sampling` samples several candidates concurrently (best-of-N, self-consistency voting) with early stopping.
+`batching` (opt-in) packs small concurrent `gen`/`agen` calls into one request.
+`scheduler` (opt-in) queues async requests by priority class, with fair sharing and quotas across tenants.
+`jobs` is a durable, SQLite-backed job queue for long generation runs that survive crashes.
+`dataset` applies a prompt template to every row of a CSV/JSONL/Parquet table, writing extracted XML tags as columns.
+`templates` compiles prompt templates once, validates their variables, and hot-reloads registered template files.
+`optimize` searches for a good prompt: concurrent `gen_prompt` candidates, scored on an eval set, then refined.
+`tags` is the linear-time XML tag scanner behind `get_xml` and `remove_xml`, plus `XmlIndex` for span queries over large (or memory-mapped) documents.
+`cache` is a persistent semantic response cache for `gen_msg`, matching near-duplicate prompts by embedding similarity.
+`examples` is a persistent, BM25-indexed bank of generated few-shot examples that `gen_examples_list` can serve from.
+`dedup` finds near-duplicate texts with MinHash + LSH, for generated examples and large example files.
+`mapreduce` runs a prompt over long documents: content-defined chunks mapped concurrently, then reduced in a tree, with per-chunk caching.
+`pool` (opt-in) spreads requests across several API keys and base URLs, balancing load and skipping unhealthy or rate-limited endpoints.
 """
 
 from alana.color import (
@@ -37,12 +75,17 @@ from alana.prompt import (
     respond,
 )
 from alana.prompt_async import (
+    astream,
     agen,
     agen_msg,
     agen_examples,
     agen_examples_list,
     agen_prompt,
 )
+from alana.loop import run
+from alana.structured import gen_structured, agen_structured
+from alana.tools import gen_tools, agen_tools, tool
+from alana.sampling import gen_n, agen_n, vote, avote
 from alana.aliases import (
     grab,
     xml,
@@ -55,3 +98,22 @@ from alana.aliases import (
 import alana.globals
 import alana.color
 import alana.prompt
+import alana.embed
+import alana.export
+import alana.stream
+import alana.loop
+import alana.structured
+import alana.tools
+import alana.sampling
+import alana.batching
+import alana.scheduler
+import alana.jobs
+import alana.dataset
+import alana.templates
+import alana.optimize
+import alana.tags
+import alana.cache
+import alana.examples
+import alana.dedup
+import alana.mapreduce
+import alana.pool
@@ -0,0 +1,218 @@
+import asyncio
+import weakref
+from typing import Any, Dict, List, Optional, Tuple
+
+from alana import globals
+from alana import templates
+from alana.color import red
+from alana.prompt import get_xml, _get_text
+
+# Opt-in micro-batching: small single-turn `gen`/`agen` calls that share a system prompt and model are packed into
+# one request, and the answers are split back out with `get_xml`. Enable with `alana.batching.enable()`.
+
+_CONFIG: Optional[Dict[str, Any]] = None
+_BATCHERS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, MicroBatcher]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+class MicroBatcher:
+    """Collects small requests for `window` seconds, then sends each group (same system/model/settings) as one request.
+
+    Bound to the event loop it was created on; use `submit` from that loop.
+    """
+
+    def __init__(self, window: float = 0.02, max_batch: int = 16) -> None:
+        self.window: float = window
+        self.max_batch: int = max_batch
+        self._pending: Dict[Tuple, List[Tuple[str, int, asyncio.Future]]] = {}
+        self._timers: Dict[Tuple, asyncio.TimerHandle] = {}
+
+    async def submit(
+        self,
+        user: str,
+        system: str = "",
+        model: str = globals.DEFAULT_MODEL,
+        api_key: Optional[str] = None,
+        max_tokens=1024,
+        temperature=1.0,
+    ) -> str:
+        """Queue one request. Returns the text of its response."""
+        loop = asyncio.get_running_loop()
+        key: Tuple = (system, model, api_key, temperature)
+        future: asyncio.Future = loop.create_future()
+        items = self._pending.setdefault(key, [])
+        items.append((user, max_tokens, future))
+        if len(items) >= self.max_batch:
+            self._flush_soon(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self.window, self._flush_soon, key)
+        return await future
+
+    def _flush_soon(self, key: Tuple) -> None:
+        timer: Optional[asyncio.TimerHandle] = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        items = self._pending.pop(key, [])
+        if items:
+            asyncio.ensure_future(self._flush(key, items))
+
+    async def _flush(
+        self, key: Tuple, items: List[Tuple[str, int, asyncio.Future]]
+    ) -> None:
+        system, model, api_key, temperature = key
+        settings: Dict[str, Any] = dict(
+            system=system, model=model, api_key=api_key, temperature=temperature
+        )
+        # NOTE: A packed request asks for the sum of its items' `max_tokens`, which must fit the model's output limit,
+        # so oversized batches are split (in order) into several packed requests.
+        limit: int = globals.MAX_OUTPUT_TOKENS.get(
+            globals.MODELS.get(model, model), 4096
+        )
+        groups: List[List[Tuple[str, int, asyncio.Future]]] = [[]]
+        total: int = 0
+        for item in items:
+            if groups[-1] and total + item[1] > limit:
+                groups.append([])
+                total = 0
+            groups[-1].append(item)
+            total += item[1]
+        await asyncio.gather(*(self._send(group, settings) for group in groups))
+
+    async def _send(
+        self, items: List[Tuple[str, int, asyncio.Future]], settings: Dict[str, Any]
+    ) -> None:
+        missing: List[int] = list(range(len(items)))
+        if len(items) > 1:
+            try:
+                answers: List[Optional[str]] = await _packed(
+                    users=[user for user, _, _ in items],
+                    max_tokens=sum(max_tokens for _, max_tokens, _ in items),
+                    **settings,
+                )
+                missing = []
+                for i, answer in enumerate(answers):
+                    if answer is None:
+                        missing.append(i)
+                    elif not items[i][2].done():
+                        items[i][2].set_result(answer)
+            except Exception as e:
+                red(var=f"`MicroBatcher`: batched call failed ({e}); falling back.")
+            if missing:
+                red(
+                    var=f"`MicroBatcher`: {len(missing)}/{len(items)} answers missing; falling back to individual calls."
+                )
+        await asyncio.gather(
+            *(
+                _single(
+                    user=items[i][0],
+                    max_tokens=items[i][1],
+                    future=items[i][2],
+                    **settings,
+                )
+                for i in missing
+            )
+        )
+
+
+async def _packed(
+    users: List[str], max_tokens: int, **settings: Any
+) -> List[Optional[str]]:
+    from alana.prompt_async import agen_msg
+
+    packed: str = templates.builtin("user", "batch").render(
+        n=len(users),
+        items="\n".join(
+            f'<item id="{i}">\n{user}\n</item>' for i, user in enumerate(users)
+        ),
+    )
+    output = await agen_msg(
+        user=packed, max_tokens=max_tokens, stream_action=None, **settings
+    )
+    text: str = _get_text(output)
+    answers: List[Optional[str]] = []
+    for i in range(len(users)):
+        found: List[str] = get_xml(tag=f"answer_{i}", content=text)
+        answers.append(found[-1].strip() if found else None)
+    return answers
+
+
+async def _single(
+    user: str, max_tokens: int, future: asyncio.Future, **settings: Any
+) -> None:
+    from alana.prompt_async import agen_msg
+
+    try:
+        output = await agen_msg(
+            user=user, max_tokens=max_tokens, stream_action=None, **settings
+        )
+        if not future.done():
+            future.set_result(_get_text(output))
+    except Exception as e:
+        if not future.done():
+            future.set_exception(e)
+
+
+def enable(
+    window: float = 0.02,
+    max_batch: int = 16,
+    max_chars: int = 4000,
+    max_item_tokens: int = 512,
+) -> None:
+    """Turn on micro-batching for small single-turn `gen`/`agen` calls.
+
+    Args:
+        window (float, optional): Seconds to wait for more requests before sending a batch. Defaults to 0.02.
+        max_batch (int, optional): Send immediately once this many requests are waiting. Defaults to 16.
+        max_chars (int, optional): Only batch `user` prompts up to this many characters. Defaults to 4000.
+        max_item_tokens (int, optional): Only batch requests with `max_tokens` up to this. Defaults to 512.
+
+    Notes:
+        - Only calls with `user` set, no `messages`, and no extra API kwargs are batched. Everything else is untouched.
+        - Batched calls don't stream; `stream_action` gets the whole answer at once.
+        - From sync code, batching only helps when several threads call `gen` concurrently.
+    """
+    global _CONFIG
+    _CONFIG = dict(
+        window=window,
+        max_batch=max_batch,
+        max_chars=max_chars,
+        max_item_tokens=max_item_tokens,
+    )
+    _BATCHERS.clear()
+
+
+def disable() -> None:
+    """Turn off micro-batching."""
+    global _CONFIG
+    _CONFIG = None
+    _BATCHERS.clear()
+
+
+def batch_eligible(
+    user: Optional[str],
+    messages: Optional[List[Any]],
+    max_tokens: int,
+    kwargs: Dict[str, Any],
+) -> bool:
+    """Whether a `gen`/`agen` call should go through the micro-batcher."""
+    return (
+        _CONFIG is not None
+        and user is not None
+        and messages is None
+        and not kwargs
+        and len(user) <= _CONFIG["max_chars"]
+        and max_tokens <= _CONFIG["max_item_tokens"]
+    )
+
+
+async def batched(user: str, **settings: Any) -> str:
+    """Submit to the running loop's `MicroBatcher` (created on first use)."""
+    loop = asyncio.get_running_loop()
+    batcher: Optional[MicroBatcher] = _BATCHERS.get(loop)
+    if batcher is None:
+        batcher = _BATCHERS[loop] = MicroBatcher(
+            window=(_CONFIG or {}).get("window", 0.02),
+            max_batch=(_CONFIG or {}).get("max_batch", 16),
+        )
+    return await batcher.submit(user=user, **settings)
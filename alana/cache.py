@@ -0,0 +1,354 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from array import array
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from alana.embed import Embedder, hash_embed
+
+# Semantic response cache: near-duplicate prompts get the stored response of an earlier prompt.
+# Prompts are embedded and searched with an IVF index (k-means lists stored contiguously in a memory-mapped float32
+# matrix). Only the `nprobe` lists nearest the query are scanned, so a lookup touches a few thousand rows, not all.
+
+
+def normalize(messages: List[Any]) -> str:
+    """The text of a conversation, lowercased with whitespace collapsed. This is what gets embedded."""
+    parts: List[str] = []
+    for message in messages:
+        content: Any = message["content"]
+        if not isinstance(content, str):
+            content = " ".join(
+                (
+                    block.get("text", "")
+                    if isinstance(block, dict)
+                    else getattr(block, "text", "")
+                )
+                for block in content
+            )
+        parts.append(f"{message['role']}: {content}")
+    return " ".join(" ".join(parts).lower().split())
+
+
+def scope_key(**settings: Any) -> str:
+    """Hash of everything besides the prompt that must match exactly for a cached response to be reused."""
+    return hashlib.sha1(
+        json.dumps(settings, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class _Buffer:
+    """Growable (ids, vectors) pair for rows not yet in the on-disk index."""
+
+    def __init__(self, dim: int) -> None:
+        self.ids: np.ndarray = np.empty(16, dtype=np.int64)
+        self.vectors: np.ndarray = np.empty((16, dim), dtype=np.float32)
+        self.n: int = 0
+
+    def append(self, row: int, vector: np.ndarray) -> None:
+        if self.n == len(self.ids):
+            self.ids = np.resize(self.ids, 2 * self.n)
+            self.vectors = np.concatenate([self.vectors, np.empty_like(self.vectors)])
+        self.ids[self.n] = row
+        self.vectors[self.n] = vector
+        self.n += 1
+
+
+def _kmeans(
+    sample: np.ndarray, k: int, iterations: int = 10, seed: int = 0
+) -> np.ndarray:
+    """Spherical k-means (cosine) on unit vectors. Returns (k, dim) unit centroids."""
+    rng = np.random.default_rng(seed)
+    centroids: np.ndarray = sample[rng.choice(len(sample), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign: np.ndarray = np.argmax(sample @ centroids.T, axis=1)
+        order: np.ndarray = np.argsort(assign, kind="stable")
+        counts: np.ndarray = np.bincount(assign, minlength=k)
+        present: np.ndarray = np.flatnonzero(counts)
+        starts: np.ndarray = np.concatenate([[0], np.cumsum(counts)[:-1]])[present]
+        sums: np.ndarray = np.add.reduceat(sample[order], starts, axis=0)
+        norms: np.ndarray = np.linalg.norm(sums, axis=1, keepdims=True)
+        # NOTE: Empty lists keep their old centroid.
+        centroids[present] = sums / np.maximum(norms, 1e-12)
+    return centroids
+
+
+class SemanticCache:
+    """Persistent cache from prompts to responses, matched by embedding similarity.
+
+    Args:
+        path (str): Directory for the cache files (created if needed).
+        embed_fn (Optional[Embedder], optional): Embedder for prompts (see `alana.embed`). Defaults to `hash_embed`,
+            which matches near-verbatim prompts; use e.g. `sentence_transformer_embedder()` for paraphrases.
+        threshold (float, optional): Minimum cosine similarity for a hit, unless a call passes its own. Defaults to 0.95.
+        nprobe (int, optional): Index lists scanned per lookup. More is slower and finds more. Defaults to 8.
+        train_size (int, optional): Entries before the IVF index is first built (until then every row is scanned). Defaults to 1024.
+
+    Layout of `path`:
+        - `meta.json`: `{"dim": ...}`
+        - `vectors.f32`: raw float32 rows, in insertion order
+        - `entries.jsonl`: line i is `{"scope": ..., "prompt": ..., "value": ...}` for row i
+        - `ivf.f32` and `ivf.npz`: the index (rows sorted by list, and the centroids, row ids and list offsets)
+
+    Example:
+        >>> cache = SemanticCache("~/.alana/semantic", embed_fn=sentence_transformer_embedder())
+        >>> gen(user="What's the capital of France?", semantic_cache=cache)
+        >>> gen(user="what is the capital of france", semantic_cache=cache, similarity=0.9)  # Cached.
+        >>> cache.stats()
+
+    Notes:
+        - Rows are only appended. Rows added after the index was built are assigned to the nearest list in memory, and
+          the index is rebuilt (k-means over a sample, then a sorted copy of the rows) once they outnumber indexed rows.
+        - A hit needs the same scope (model, system prompt and settings in `gen_msg`) as well as a similar prompt.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        embed_fn: Optional[Embedder] = None,
+        threshold: float = 0.95,
+        nprobe: int = 8,
+        train_size: int = 1024,
+    ) -> None:
+        self.path: str = os.path.expanduser(path)
+        os.makedirs(self.path, exist_ok=True)
+        self.embed_fn: Embedder = embed_fn or hash_embed
+        self.threshold: float = threshold
+        self.nprobe: int = nprobe
+        self.train_size: int = train_size
+        self._meta_path: str = os.path.join(self.path, "meta.json")
+        self._vectors_path: str = os.path.join(self.path, "vectors.f32")
+        self._entries_path: str = os.path.join(self.path, "entries.jsonl")
+        self._ivf_path: str = os.path.join(self.path, "ivf.f32")
+        self._ivf_meta_path: str = os.path.join(self.path, "ivf.npz")
+        self.dim: Optional[int] = None
+        self._lock = threading.Lock()
+        self._n: int = 0
+        self._line_offsets: array = array("q")
+        self._scope_ids: Dict[str, int] = {}
+        self._scopes: np.ndarray = np.empty(1024, dtype=np.int32)
+        self._centroids: Optional[np.ndarray] = None
+        self._ivf_ids: np.ndarray = np.empty(0, dtype=np.int64)
+        self._ivf_offsets: List[int] = [0]
+        self._ivf_vectors: Optional[np.ndarray] = None
+        self._pending: Dict[int, _Buffer] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+        self._latencies: Deque[float] = deque(maxlen=10_000)
+        self._load()
+
+    def __len__(self) -> int:
+        return self._n
+
+    def _scope_id(self, scope: str) -> int:
+        return self._scope_ids.setdefault(scope, len(self._scope_ids))
+
+    def _set_scope(self, row: int, scope: str) -> None:
+        if row == len(self._scopes):
+            self._scopes = np.resize(self._scopes, 2 * len(self._scopes))
+        self._scopes[row] = self._scope_id(scope)
+
+    def _load(self) -> None:
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self.dim = json.load(f)["dim"]
+        if os.path.exists(self._entries_path):
+            with open(self._entries_path, "r+b") as f:
+                position: int = 0
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # NOTE: A crash mid-append can leave a partial last line. Drop it.
+                        f.truncate(position)
+                        break
+                    self._set_scope(len(self._line_offsets), json.loads(line)["scope"])
+                    self._line_offsets.append(position)
+                    position += len(line)
+        self._n = len(self._line_offsets)
+        if self.dim is None:
+            return
+        expected: int = self._n * self.dim * 4
+        if (
+            os.path.exists(self._vectors_path)
+            and os.path.getsize(self._vectors_path) > expected
+        ):
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(expected)
+        built: int = 0
+        if os.path.exists(self._ivf_meta_path):
+            with np.load(self._ivf_meta_path) as ivf:
+                built = int(ivf["built"])
+                if built <= self._n:
+                    self._centroids = ivf["centroids"]
+                    self._ivf_ids = ivf["ids"]
+                    self._ivf_offsets = ivf["offsets"].tolist()
+                else:
+                    built = 0
+        if built:
+            self._ivf_vectors = self._map(self._ivf_path, built)
+        if self._n > built:
+            tail: np.ndarray = self._map(self._vectors_path, self._n)[built:]
+            for row, vector in enumerate(tail, start=built):
+                self._buffer(vector).append(row, vector)
+
+    def _map(self, path: str, rows: int) -> np.ndarray:
+        # NOTE: A plain ndarray view of the map; slicing `np.memmap` itself is slow enough to matter per lookup.
+        return np.asarray(
+            np.memmap(path, dtype=np.float32, mode="r", shape=(rows, self.dim))  # type: ignore
+        )
+
+    def _buffer(self, vector: np.ndarray) -> _Buffer:
+        """The pending buffer of the list nearest `vector` (list 0 if there is no index yet)."""
+        nearest: int = (
+            0 if self._centroids is None else int(np.argmax(self._centroids @ vector))
+        )
+        if nearest not in self._pending:
+            self._pending[nearest] = _Buffer(self.dim)  # type: ignore
+        return self._pending[nearest]
+
+    def _embed(self, text: str) -> np.ndarray:
+        vector: np.ndarray = np.asarray(self.embed_fn([text]), dtype=np.float32)[0]
+        norm: float = float(np.linalg.norm(vector))
+        return vector / norm if norm > 0 else vector
+
+    def search(self, text: str, scope: str = "") -> Tuple[float, int]:
+        """The most similar cached prompt in `scope`, as (cosine similarity, row). (-inf, -1) if there is none."""
+        return self._search(self._embed(text), scope)
+
+    def _search(self, query: np.ndarray, scope: str) -> Tuple[float, int]:
+        scope_id: Optional[int] = self._scope_ids.get(scope)
+        if scope_id is None or self.dim is None:
+            return float("-inf"), -1
+        segments: List[Tuple[np.ndarray, np.ndarray]] = []
+        lists: List[int] = list(self._pending)
+        if self._centroids is not None:
+            nprobe: int = min(self.nprobe, len(self._centroids))
+            lists = np.argpartition(-(self._centroids @ query), nprobe - 1)[
+                :nprobe
+            ].tolist()
+            for i in lists:
+                start, end = self._ivf_offsets[i], self._ivf_offsets[i + 1]
+                segments.append((self._ivf_ids[start:end], self._ivf_vectors[start:end]))  # type: ignore
+        for i in lists:
+            buffer: Optional[_Buffer] = self._pending.get(i)
+            if buffer is not None:
+                segments.append((buffer.ids[: buffer.n], buffer.vectors[: buffer.n]))
+        best: Tuple[float, int] = (float("-inf"), -1)
+        for ids, vectors in segments:
+            if len(ids) == 0:
+                continue
+            scores: np.ndarray = vectors @ query
+            if len(self._scope_ids) > 1:
+                scores[self._scopes[ids] != scope_id] = -np.inf
+            i: int = int(np.argmax(scores))
+            if scores[i] > best[0]:
+                best = (float(scores[i]), int(ids[i]))
+        return best
+
+    def _value(self, row: int) -> str:
+        with open(self._entries_path, "rb") as f:
+            f.seek(self._line_offsets[row])
+            return json.loads(f.readline())["value"]
+
+    def get(
+        self, text: str, scope: str = "", threshold: Optional[float] = None
+    ) -> Optional[str]:
+        """The value cached for the most similar prompt in `scope`, if its similarity is at least `threshold`."""
+        started: float = time.perf_counter()
+        query: np.ndarray = self._embed(text)
+        with self._lock:
+            similarity, row = self._search(query, scope)
+            hit: bool = row >= 0 and similarity >= (
+                self.threshold if threshold is None else threshold
+            )
+            value: Optional[str] = self._value(row) if hit else None
+            self.hits += hit
+            self.misses += not hit
+            self._latencies.append(time.perf_counter() - started)
+        return value
+
+    def put(self, text: str, value: str, scope: str = "") -> None:
+        """Cache `value` (a string, e.g. a message's JSON) for the prompt `text` in `scope`."""
+        vector: np.ndarray = self._embed(text)
+        with self._lock:
+            if self.dim is None:
+                self.dim = int(vector.shape[0])
+                with open(self._meta_path, "w") as f:
+                    json.dump({"dim": self.dim}, f)
+            elif vector.shape[0] != self.dim:
+                raise ValueError(
+                    f"`SemanticCache`: embedding dim {vector.shape[0]} does not match cached dim {self.dim}."
+                )
+            with open(self._vectors_path, "ab") as f:
+                f.write(vector.tobytes())
+            line: bytes = (
+                json.dumps({"scope": scope, "prompt": text, "value": value}) + "\n"
+            ).encode("utf-8")
+            with open(self._entries_path, "ab") as f:
+                position: int = f.tell()
+                f.write(line)
+            self._line_offsets.append(position)
+            self._set_scope(self._n, scope)
+            self._buffer(vector).append(self._n, vector)
+            self._n += 1
+            built: int = len(self._ivf_ids)
+            if (self._centroids is None and self._n >= self.train_size) or (
+                self._centroids is not None and self._n - built > built
+            ):
+                self._rebuild()
+
+    def rebuild(self) -> None:
+        """Retrain the index on every row now. Happens automatically as the cache grows."""
+        with self._lock:
+            self._rebuild()
+
+    def _rebuild(self, batch_size: int = 16_384, seed: int = 0) -> None:
+        if self.dim is None or self._n == 0:
+            return
+        n: int = self._n
+        vectors: np.ndarray = self._map(self._vectors_path, n)
+        n_lists: int = max(1, min(n, int(2 * np.sqrt(n))))
+        rng = np.random.default_rng(seed)
+        sample: np.ndarray = np.asarray(
+            vectors[np.sort(rng.choice(n, min(n, 16 * n_lists), replace=False))]
+        )
+        centroids: np.ndarray = _kmeans(sample, n_lists, seed=seed)
+        assign: np.ndarray = np.concatenate(
+            [
+                np.argmax(vectors[start : start + batch_size] @ centroids.T, axis=1)
+                for start in range(0, n, batch_size)
+            ]
+        )
+        ids: np.ndarray = np.argsort(assign, kind="stable")
+        offsets: List[int] = np.searchsorted(
+            assign[ids], np.arange(n_lists + 1)
+        ).tolist()
+        self._ivf_vectors = None
+        with open(self._ivf_path + ".tmp", "wb") as f:
+            for start in range(0, n, batch_size):
+                f.write(np.asarray(vectors[ids[start : start + batch_size]]).tobytes())
+        with open(self._ivf_meta_path + ".tmp", "wb") as f:
+            np.savez(f, centroids=centroids, ids=ids, offsets=offsets, built=n)
+        os.replace(self._ivf_path + ".tmp", self._ivf_path)
+        os.replace(self._ivf_meta_path + ".tmp", self._ivf_meta_path)
+        self._centroids, self._ivf_ids, self._ivf_offsets = centroids, ids, offsets
+        self._ivf_vectors = self._map(self._ivf_path, n)
+        self._pending = {}
+
+    def stats(self) -> Dict[str, Any]:
+        """Entries, hit rate, and lookup latency (embedding + search) percentiles over recent lookups."""
+        latencies: np.ndarray = np.asarray(self._latencies) * 1000
+        lookups: int = self.hits + self.misses
+        return {
+            "entries": self._n,
+            "indexed": len(self._ivf_ids),
+            "lists": 0 if self._centroids is None else len(self._centroids),
+            "lookups": lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+        }
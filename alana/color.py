@@ -1,11 +1,12 @@
-import os
-from typing import Any, List, Dict, Optional
+from typing import Any, Callable, List, Dict, Literal, Optional
 import logging
 from colorama import Fore, Style
 import numpy as np
 from plotly.graph_objs._figure import Figure
 from scipy.sparse._matrix import spmatrix
 
+from alana.export import export
+
 # Hacky utils. Lower standard of quality than the `prompt` module.
 # Designed for quickly iterating in Colab.
 
@@ -27,32 +28,123 @@ def log(loud: bool, output: str, logger: Optional[logging.Logger] = None) -> Non
         logger.info(msg=output)
 
 
-def _make_filename(title: str, extension: str) -> str:
-    filename = f"{title}.{extension}"
-    counter = 1
-    # Check if the file exists and update the filename if necessary
-    while os.path.exists(path=filename):
-        filename: str = f"{title}_{counter}.{extension}"
-        counter += 1
-    return filename
+def _bucket_starts(n: int, n_buckets: int) -> np.ndarray:
+    """Start indices of `n_buckets` (nearly) equal, non-empty buckets over range(n)."""
+    return np.unique(np.linspace(0, n, num=n_buckets, endpoint=False).astype(np.int64))
+
+
+def _first_arg_per_bucket(
+    values: np.ndarray, starts: np.ndarray, extreme: np.ufunc = np.maximum
+) -> np.ndarray:
+    """Index of the first maximum (or, with `extreme=np.minimum`, minimum) of `values` within each bucket (buckets given by `starts`)."""
+    extremes = extreme.reduceat(values, starts)
+    counts = np.diff(np.append(starts, len(values)))
+    hits = np.flatnonzero(values == np.repeat(extremes, counts))
+    buckets = np.searchsorted(starts, hits, side="right") - 1
+    _, first = np.unique(buckets, return_index=True)
+    return hits[first]
 
 
-def heatmap(array: np.ndarray, title: Optional[str] = None, save: bool = False) -> None:
+def _lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets over x-sorted points. Returns the indices to keep.
+
+    Vectorized variant: each bucket's triangle is anchored on the *mean* of the previous bucket instead of the
+    previously selected point, so there is no sequential Python loop. Computes in float32 for float16/float32 input
+    (no upcast copy of float32 data), and keeps at most three n-length temporaries.
+    """
+    n = len(x)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    starts = 1 + _bucket_starts(n - 2, n_out - 2)
+    counts = np.diff(np.append(starts, n - 1))
+    dtype = np.result_type(x.dtype, y.dtype, np.float32)
+    xf = x.astype(dtype, copy=False)
+    yf = y.astype(dtype, copy=False)
+    mean_x = (np.add.reduceat(xf[1:-1], starts - 1, dtype=np.float64) / counts).astype(
+        dtype
+    )
+    mean_y = (np.add.reduceat(yf[1:-1], starts - 1, dtype=np.float64) / counts).astype(
+        dtype
+    )
+    prev_x = np.concatenate(([xf[0]], mean_x[:-1]))
+    prev_y = np.concatenate(([yf[0]], mean_y[:-1]))
+    next_x = np.concatenate((mean_x[1:], [xf[-1]]))
+    next_y = np.concatenate((mean_y[1:], [yf[-1]]))
+    # NOTE: Twice the triangle area, (prev_x - next_x) * (y - prev_y) + (x - prev_x) * (next_y - prev_y), built in place.
+    area = yf[1:-1] - np.repeat(prev_y, counts)
+    area *= np.repeat(prev_x - next_x, counts)
+    term = xf[1:-1] - np.repeat(prev_x, counts)
+    term *= np.repeat(next_y - prev_y, counts)
+    area += term
+    np.abs(area, out=area)
+    chosen = 1 + _first_arg_per_bucket(area, starts - 1)
+    return np.concatenate(([0], chosen, [n - 1]))
+
+
+def _minmax(y: np.ndarray, n_out: int) -> np.ndarray:
+    """Keep the min and max of each of `n_out // 2` buckets (in order). Returns the indices to keep."""
+    n = len(y)
+    if n <= n_out or n_out < 2:
+        return np.arange(n)
+    starts = _bucket_starts(n, n_out // 2)
+    argmax = _first_arg_per_bucket(y, starts)
+    argmin = _first_arg_per_bucket(y, starts, extreme=np.minimum)
+    return np.unique(np.concatenate((argmin, argmax)))
+
+
+def _block_mean(array: np.ndarray, max_cells: int):
+    """Block-mean pool a 2D array down to roughly `max_cells` cells.
+
+    Returns (pooled float32 array, row start indices, column start indices). Accumulates in float32 block by
+    block, so float16/float32 inputs are never upcast as a whole.
+    """
+    rows, cols = array.shape
+    factor = int(np.ceil(np.sqrt(rows * cols / max_cells)))
+    row_starts = np.arange(0, rows, factor)
+    col_starts = np.arange(0, cols, factor)
+    pooled = np.add.reduceat(array, row_starts, axis=0, dtype=np.float32)
+    pooled = np.add.reduceat(pooled, col_starts, axis=1, dtype=np.float32)
+    row_counts = np.diff(np.append(row_starts, rows)).astype(np.float32)
+    col_counts = np.diff(np.append(col_starts, cols)).astype(np.float32)
+    pooled /= np.outer(row_counts, col_counts)
+    return pooled, row_starts, col_starts
+
+
+def heatmap(
+    array: np.ndarray,
+    title: Optional[str] = None,
+    save: bool = False,
+    max_cells: int = 250_000,
+) -> None:
+    """Plot a 2D array with `px.imshow`.
+
+    Arrays with more than `max_cells` cells are block-mean pooled first. Axis values (and so the hover) are the
+    original row/column index at the start of each block. With `save=True`, the PNG is written in the background
+    (see `alana.export`).
+    """
     import plotly.express as px
 
     if title is None:
         title = "heatmap"
+    array = np.asarray(array)
+    if array.size > max_cells:
+        img, y, x = _block_mean(array=array, max_cells=max_cells)
+    else:
+        img, y, x = array, np.arange(array.shape[0]), np.arange(array.shape[1])
+        if (
+            img.dtype == np.float16
+        ):  # NOTE: plotly can't serialize float16. Fine to cast, it's small.
+            img = img.astype(np.float32)
     fig: Figure = px.imshow(
-        img=array,
+        img=img,
         labels=dict(x="Column", y="Row", color="Value"),
-        x=np.arange(array.shape[1]),
-        y=np.arange(array.shape[0]),
+        x=x,
+        y=y,
         color_continuous_scale="Viridis",
         title=title,
     )
     if save:
-        filename = _make_filename(title, ".png")
-        fig.write_image(filename)
+        export(fig=fig, title=title)
     fig.show()
 
 
@@ -63,33 +155,120 @@ def scatter(
     y_label: str = "Y",
     title: Optional[str] = None,
     save: bool = False,
+    max_points: int = 100_000,
+    downsample: Literal["lttb", "minmax"] = "lttb",
 ) -> None:
+    """Scatter plot of `y` over `x`.
+
+    Above `max_points`, points are sorted by x, downsampled with LTTB (or per-bucket min/max) and rendered with
+    WebGL (`scattergl`). The hover shows each kept point's original index. With `save=True`, the PNG is written in
+    the background (see `alana.export`).
+    """
     import plotly.express as px
 
     if title is None:
         title = f"Scatterplot of {y_label} over {x_label}"
-    fig: Figure = px.scatter(x=x, y=y, labels={"x": x_label, "y": y_label}, title=title)
+    x, y = np.asarray(x), np.asarray(y)
+    if len(x) > max_points:
+        order: Optional[np.ndarray] = None
+        if np.any(x[1:] < x[:-1]):
+            order = np.argsort(x, kind="stable")
+        xs = x if order is None else x[order]
+        ys = y if order is None else y[order]
+        if downsample == "minmax":
+            keep = _minmax(y=ys, n_out=max_points)
+        else:
+            keep = _lttb(x=xs, y=ys, n_out=max_points)
+        index = keep if order is None else order[keep]
+        fig: Figure = px.scatter(
+            x=xs[keep],
+            y=ys[keep],
+            hover_data={"index": index},
+            labels={"x": x_label, "y": y_label},
+            title=title,
+            render_mode="webgl",
+        )
+    else:
+        fig = px.scatter(x=x, y=y, labels={"x": x_label, "y": y_label}, title=title)
     if save:
-        filename: str = _make_filename(title=title, extension=".png")
-        fig.write_image(filename)
+        export(fig=fig, title=title)
     fig.show()
 
 
+def _project(embeddings: np.ndarray, n_components: int = 50, batch_size: int = 1024):
+    """Reduce `embeddings` to at most `n_components` dims with IncrementalPCA, one batch at a time."""
+    from sklearn.decomposition import IncrementalPCA
+
+    n, dim = embeddings.shape
+    n_components = min(n_components, dim, n)
+    if n_components == dim:
+        return np.asarray(embeddings, dtype=np.float32)
+    batch_size = max(batch_size, n_components)
+    pca = IncrementalPCA(n_components=n_components, batch_size=batch_size)
+    for start in range(0, n, batch_size):
+        batch = embeddings[start : start + batch_size]
+        if (
+            len(batch) >= n_components
+        ):  # NOTE: partial_fit needs n_samples >= n_components
+            pca.partial_fit(batch)
+    reduced = np.empty((n, n_components), dtype=np.float32)
+    for start in range(0, n, batch_size):
+        reduced[start : start + batch_size] = pca.transform(
+            embeddings[start : start + batch_size]
+        )
+    return reduced
+
+
 def data_atlas(
     strings: List[str],
     color_data: Optional[List[Any]] = None,
     color_data_name: str = "color",
     variable_size=True,
     hover_data: Optional[Dict[str, List[Any]]] = None,
+    embeddings: Optional[np.ndarray] = None,
+    embed_fn: Optional[Callable[[List[str]], np.ndarray]] = None,
+    cache_dir: Optional[str] = None,
+    batch_size: int = 1024,
 ):
-    """Mostly written by ChatGPT, but hey it works!"""
+    """Mostly written by ChatGPT, but hey it works!
+
+    By default, vectorizes `strings` with TF-IDF. Pass `embeddings` (one row per string) to plot precomputed
+    embeddings, or `embed_fn` (see `alana.embed`) to compute them. With `cache_dir`, embeddings are cached on disk
+    keyed by string hash, so repeated atlases over a growing dataset only embed the new strings (`cache_dir` alone
+    embeds with `alana.embed.hash_embed`).
+    """
     import plotly.express as px
-    from sklearn.feature_extraction.text import TfidfVectorizer
     from sklearn.manifold import TSNE
 
-    # Vectorization using TF-IDF
-    vectorizer = TfidfVectorizer(stop_words="english")
-    X: spmatrix = vectorizer.fit_transform(raw_documents=strings)
+    if cache_dir is not None and embeddings is not None:
+        red(var="`data_atlas`: `embeddings` were given, so `cache_dir` is ignored.")
+    # NOTE: TF-IDF isn't cacheable per string, so asking for a cache means embedding.
+    if cache_dir is not None and embed_fn is None:
+        from alana.embed import hash_embed
+
+        embed_fn = hash_embed
+    if embeddings is None and embed_fn is None:
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        # Vectorization using TF-IDF
+        vectorizer = TfidfVectorizer(stop_words="english")
+        X: spmatrix = vectorizer.fit_transform(raw_documents=strings)
+        features = X.toarray()  # type: ignore https://docs.scipy.org/doc//scipy-1.3.1/reference/generated/scipy.sparse.spmatrix.toarray.html
+    else:
+        from alana.embed import embed
+
+        if embeddings is None:
+            embeddings = embed(
+                strings=strings,
+                embed_fn=embed_fn,
+                cache_dir=cache_dir,
+                batch_size=batch_size,
+            )
+        if len(embeddings) != len(strings):
+            raise ValueError(
+                f"`data_atlas`: got {len(embeddings)} embeddings for {len(strings)} strings."
+            )
+        features = _project(embeddings=embeddings, batch_size=batch_size)
 
     # Dimensionality Reduction using t-SNE
     perplexity_value: float = max(
@@ -98,7 +277,7 @@ def data_atlas(
     tsne = TSNE(
         n_components=2, random_state=42, perplexity=perplexity_value, n_iter=1000
     )
-    embedding = tsne.fit_transform(X.toarray())  # type: ignore https://docs.scipy.org/doc//scipy-1.3.1/reference/generated/scipy.sparse.spmatrix.toarray.html
+    embedding = tsne.fit_transform(features)
 
     # Plotting the result using Plotly
     fig: Figure = px.scatter(
@@ -0,0 +1,197 @@
+import re
+import json
+import zlib
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Near-duplicate detection with MinHash + LSH banding. Each text becomes a signature of `num_perm` minimum hashes of its
+# word shingles; texts whose signatures agree on a whole band of rows land in the same bucket, and only those candidate
+# pairs are compared. Roughly linear in the number of texts, instead of comparing all pairs.
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+_PRIME: int = (1 << 31) - 1  # Shingle hashes are < 2^31, so `a * h + b` fits in uint64.
+
+
+def _shingles(text: str, shingle: int) -> np.ndarray:
+    words: List[str] = _TOKEN_PATTERN.findall(text.lower())
+    grams: List[str] = [
+        " ".join(words[i : i + shingle])
+        for i in range(max(1, len(words) - shingle + 1))
+    ]
+    return np.fromiter(
+        (zlib.crc32(gram.encode("utf-8")) & _PRIME for gram in grams),
+        dtype=np.uint64,
+        count=len(grams),
+    )
+
+
+def minhash(
+    texts: Sequence[str],
+    num_perm: int = 128,
+    shingle: int = 3,
+    seed: int = 0,
+    batch_size: int = 1024,
+) -> np.ndarray:
+    """MinHash signatures of `texts` over word `shingle`-grams, as a (len(texts), num_perm) uint32 array.
+
+    The fraction of equal columns between two rows estimates the Jaccard similarity of their shingle sets.
+    """
+    rng = np.random.default_rng(seed)
+    a: np.ndarray = rng.integers(1, _PRIME, size=num_perm, dtype=np.uint64)[:, None]
+    b: np.ndarray = rng.integers(0, _PRIME, size=num_perm, dtype=np.uint64)[:, None]
+    signatures: np.ndarray = np.empty((len(texts), num_perm), dtype=np.uint32)
+    for start in range(0, len(texts), batch_size):
+        hashes: List[np.ndarray] = [
+            _shingles(text, shingle) for text in texts[start : start + batch_size]
+        ]
+        flat: np.ndarray = np.concatenate(hashes)
+        offsets: np.ndarray = np.cumsum([0] + [len(h) for h in hashes[:-1]])
+        # NOTE: Permutations are applied 32 at a time to bound memory at 32 x (shingles in the batch) x 8 bytes.
+        for p in range(0, num_perm, 32):
+            values: np.ndarray = (a[p : p + 32] * flat + b[p : p + 32]) % _PRIME
+            signatures[start : start + len(hashes), p : p + 32] = np.minimum.reduceat(
+                values, offsets, axis=1
+            ).T
+    return signatures
+
+
+def _bands(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """(bands, rows) with bands * rows == num_perm: the most rows whose LSH S-curve midpoint is still below `threshold`.
+
+    Erring low means more candidate pairs (all verified afterwards) and fewer missed duplicates.
+    """
+    return max(
+        (
+            (num_perm // rows, rows)
+            for rows in range(1, num_perm + 1)
+            if num_perm % rows == 0 and (rows / num_perm) ** (1 / rows) <= threshold
+        ),
+        key=lambda br: br[1],
+        default=(num_perm, 1),
+    )
+
+
+def duplicate_groups(signatures: np.ndarray, threshold: float = 0.8) -> np.ndarray:
+    """Group near-duplicates: returns, for each row, the index of the first row in its group.
+
+    Rows sharing a bucket in any band are compared to the bucket's first row, and joined if their estimated Jaccard
+    similarity is at least `threshold`.
+    """
+    n, num_perm = signatures.shape
+    bands, rows = _bands(num_perm, threshold)
+    parent: np.ndarray = np.arange(n)
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for band in range(bands):
+        block: np.ndarray = np.ascontiguousarray(
+            signatures[:, band * rows : (band + 1) * rows]
+        )
+        keys: np.ndarray = block.view(
+            np.dtype((np.void, block.dtype.itemsize * rows))
+        ).ravel()
+        _, inverse = np.unique(keys, return_inverse=True)
+        order: np.ndarray = np.argsort(inverse, kind="stable")
+        starts: np.ndarray = np.flatnonzero(
+            np.diff(inverse[order], prepend=-1, append=-1)
+        )
+        for lo, hi in zip(starts[:-1].tolist(), starts[1:].tolist()):
+            if hi - lo < 2:
+                continue
+            members: np.ndarray = order[lo:hi]
+            similar: np.ndarray = (
+                signatures[members[1:]] == signatures[members[0]]
+            ).mean(axis=1) >= threshold
+            first: int = find(int(members[0]))
+            for member in members[1:][similar].tolist():
+                root: int = find(member)
+                if root != first:
+                    # NOTE: The smaller index wins, so each group is represented by its first occurrence.
+                    parent[max(root, first)] = min(root, first)
+                    first = min(root, first)
+    return np.fromiter((find(i) for i in range(n)), dtype=np.int64, count=n)
+
+
+def dedup(
+    texts: Sequence[str],
+    threshold: float = 0.8,
+    num_perm: int = 128,
+    shingle: int = 3,
+    seed: int = 0,
+) -> List[str]:
+    """`texts` without near-duplicates (estimated Jaccard similarity of word shingles >= `threshold`), keeping first occurrences in order.
+
+    Example:
+        >>> dedup(["the cat sat on the mat today", "the cat sat on the mat today!", "a dog"])
+        ['the cat sat on the mat today', 'a dog']
+    """
+    if not texts:
+        return []
+    groups: np.ndarray = duplicate_groups(
+        minhash(texts, num_perm=num_perm, shingle=shingle, seed=seed), threshold
+    )
+    return [text for i, text in enumerate(texts) if groups[i] == i]
+
+
+def _read_texts(path: str, field: Optional[str]) -> Iterator[str]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)[field] if field else line.rstrip("\n")
+
+
+def dedup_file(
+    input_path: str,
+    output_path: str,
+    threshold: float = 0.8,
+    field: Optional[str] = None,
+    num_perm: int = 128,
+    shingle: int = 3,
+    seed: int = 0,
+    batch_size: int = 10_000,
+) -> Dict[str, int]:
+    """Copy `input_path` to `output_path` without near-duplicate lines. See `dedup`.
+
+    Args:
+        input_path (str): One example per line, or a .jsonl file with the text under `field`.
+        output_path (str): Where to write the kept lines, unchanged and in order.
+        threshold (float, optional): Minimum estimated Jaccard similarity to count as a duplicate. Defaults to 0.8.
+        field (Optional[str], optional): JSON field holding the text, for .jsonl input. Defaults to None (plain lines).
+        batch_size (int, optional): Lines read at a time while signing. Only signatures (`num_perm` x 4 bytes per line) stay in memory.
+
+    Returns:
+        Dict[str, int]: Line counts: "read" and "kept".
+    """
+    batch: List[str] = []
+    signatures: List[np.ndarray] = []
+    for text in _read_texts(input_path, field):
+        batch.append(text)
+        if len(batch) == batch_size:
+            signatures.append(
+                minhash(batch, num_perm=num_perm, shingle=shingle, seed=seed)
+            )
+            batch = []
+    if batch:
+        signatures.append(minhash(batch, num_perm=num_perm, shingle=shingle, seed=seed))
+    if not signatures:
+        open(output_path, "w").close()
+        return {"read": 0, "kept": 0}
+    groups: np.ndarray = duplicate_groups(np.concatenate(signatures), threshold)
+    kept: int = 0
+    with open(input_path, encoding="utf-8") as f, open(
+        output_path, "w", encoding="utf-8"
+    ) as out:
+        i: int = 0
+        for line in f:
+            if not line.strip():
+                continue
+            if groups[i] == i:
+                out.write(line if line.endswith("\n") else line + "\n")
+                kept += 1
+            i += 1
+    return {"read": len(groups), "kept": kept}
@@ -0,0 +1,173 @@
+import os
+import re
+import json
+import hashlib
+from typing import Callable, Dict, List, Optional
+import numpy as np
+
+# Embedding helpers shared by `data_atlas` and anything else that wants vectors for strings.
+# An "embedder" is any callable mapping a list of strings to a (len(strings), dim) array.
+
+Embedder = Callable[[List[str]], np.ndarray]
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def string_key(string: str) -> str:
+    """Return the cache key (sha1 hex digest) for `string`."""
+    return hashlib.sha1(string.encode("utf-8")).hexdigest()
+
+
+def hash_embed(strings: List[str], dim: int = 256) -> np.ndarray:
+    """Stub embedder. Hashes word unigrams and bigrams into `dim` buckets and L2-normalizes.
+
+    No model required, deterministic across processes. Good for tests and quick looks; not semantic!
+    """
+    output = np.zeros((len(strings), dim), dtype=np.float32)
+    for row, string in enumerate(strings):
+        tokens: List[str] = _TOKEN_PATTERN.findall(string.lower())
+        for gram in tokens + [a + " " + b for a, b in zip(tokens, tokens[1:])]:
+            digest: bytes = hashlib.blake2b(
+                gram.encode("utf-8"), digest_size=8
+            ).digest()
+            value = int.from_bytes(digest, "little")
+            output[row, value % dim] += 1.0 if (value >> 63) else -1.0
+    norms = np.linalg.norm(output, axis=1, keepdims=True)
+    np.divide(output, norms, out=output, where=norms > 0)
+    return output
+
+
+def sentence_transformer_embedder(
+    model_name: str = "all-MiniLM-L6-v2", batch_size: int = 64
+) -> Embedder:
+    """Return an embedder backed by a local `sentence_transformers` model (must be installed)."""
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name)
+
+    def embed_fn(strings: List[str]) -> np.ndarray:
+        return model.encode(
+            strings, batch_size=batch_size, convert_to_numpy=True
+        ).astype(np.float32, copy=False)
+
+    return embed_fn
+
+
+class EmbeddingCache:
+    """Persistent embedding cache, keyed by string hash.
+
+    Layout of `path` (a directory):
+        - `meta.json`: `{"dim": ...}`
+        - `keys.txt`: one sha1 per line; line i is row i of `vectors.f32`
+        - `vectors.f32`: raw float32 rows, opened as a read-only `np.memmap`
+
+    Rows are only ever appended, so growing datasets only pay for new strings.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        os.makedirs(path, exist_ok=True)
+        self._keys_path: str = os.path.join(path, "keys.txt")
+        self._vectors_path: str = os.path.join(path, "vectors.f32")
+        self._meta_path: str = os.path.join(path, "meta.json")
+        self.dim: Optional[int] = None
+        self._rows: Dict[str, int] = {}
+        self._vectors: Optional[np.memmap] = None
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, string: str) -> bool:
+        return string_key(string) in self._rows
+
+    def _load(self) -> None:
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self.dim = json.load(f)["dim"]
+        if os.path.exists(self._keys_path):
+            with open(self._keys_path) as f:
+                for line in f:
+                    key = line.strip()
+                    if key:
+                        self._rows.setdefault(key, len(self._rows))
+        if self.dim is not None and os.path.exists(self._vectors_path):
+            # NOTE: A crash between the two appends can leave extra vector rows behind. Drop them.
+            expected: int = len(self._rows) * self.dim * 4
+            if os.path.getsize(self._vectors_path) > expected:
+                with open(self._vectors_path, "r+b") as f:
+                    f.truncate(expected)
+        self._open()
+
+    def _open(self) -> None:
+        if self.dim is None or len(self._rows) == 0:
+            self._vectors = None
+            return
+        self._vectors = np.memmap(
+            self._vectors_path,
+            dtype=np.float32,
+            mode="r",
+            shape=(len(self._rows), self.dim),
+        )
+
+    def _append(self, keys: List[str], vectors: np.ndarray) -> None:
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[0] != len(keys):
+            raise ValueError(
+                f"`EmbeddingCache`: embedder returned shape {vectors.shape} for {len(keys)} strings."
+            )
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+            with open(self._meta_path, "w") as f:
+                json.dump({"dim": self.dim}, f)
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(
+                f"`EmbeddingCache`: embedding dim {vectors.shape[1]} does not match cached dim {self.dim}."
+            )
+        with open(self._vectors_path, "ab") as f:
+            f.write(vectors.tobytes())
+        with open(self._keys_path, "a") as f:
+            f.write("".join(key + "\n" for key in keys))
+        for key in keys:
+            self._rows[key] = len(self._rows)
+
+    def embed(
+        self, strings: List[str], embed_fn: Embedder, batch_size: int = 1024
+    ) -> np.ndarray:
+        """Return a (len(strings), dim) float32 array, calling `embed_fn` only on strings not yet cached."""
+        keys: List[str] = [string_key(string) for string in strings]
+        missing: Dict[str, str] = {}
+        for key, string in zip(keys, strings):
+            if key not in self._rows and key not in missing:
+                missing[key] = string
+        missing_keys: List[str] = list(missing)
+        for start in range(0, len(missing_keys), batch_size):
+            batch_keys: List[str] = missing_keys[start : start + batch_size]
+            self._append(batch_keys, embed_fn([missing[key] for key in batch_keys]))
+        if missing_keys:
+            self._open()
+        if self._vectors is None:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.asarray(self._vectors[[self._rows[key] for key in keys]])
+
+
+def embed(
+    strings: List[str],
+    embed_fn: Optional[Embedder] = None,
+    cache_dir: Optional[str] = None,
+    batch_size: int = 1024,
+) -> np.ndarray:
+    """Embed `strings` in batches with `embed_fn` (default: `hash_embed`). If `cache_dir` is set, reuse an `EmbeddingCache` there."""
+    if embed_fn is None:
+        embed_fn = hash_embed
+    if cache_dir is not None:
+        return EmbeddingCache(cache_dir).embed(
+            strings=strings, embed_fn=embed_fn, batch_size=batch_size
+        )
+    batches: List[np.ndarray] = [
+        np.asarray(embed_fn(strings[start : start + batch_size]), dtype=np.float32)
+        for start in range(0, len(strings), batch_size)
+    ]
+    if not batches:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.concatenate(batches, axis=0)
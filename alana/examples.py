@@ -0,0 +1,232 @@
+import os
+import re
+import json
+import math
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+# A persistent bank of generated few-shot examples, searchable with BM25, so `gen_examples_list` can reuse examples
+# generated for similar instructions instead of calling the model again.
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+@dataclass(frozen=True)
+class Hit:
+    """One search result. `coverage` is the IDF-weighted share of the query's terms found in the entry (0 to 1)."""
+
+    id: int
+    instruction: str
+    example: str
+    score: float
+    coverage: float
+
+
+class ExampleBank:
+    """Generated examples keyed by the instruction they were generated for, in an append-only JSONL log.
+
+    Args:
+        path (str): The log file (created if needed). Each line adds an example (`{"id", "instruction", "example"}`) or
+            removes one (`{"remove": id}`).
+        k1 (float, optional): BM25 term-frequency saturation. Defaults to 1.5.
+        b (float, optional): BM25 length normalization. Defaults to 0.75.
+
+    Example:
+        >>> bank = ExampleBank("examples.jsonl")
+        >>> gen_examples_list("Write a haiku about a season.", n_examples=5, bank=bank)  # Calls the model, stores the examples.
+        >>> gen_examples_list("write a haiku about a season", n_examples=5, bank=bank)  # Served from the bank.
+
+    Notes:
+        - Each entry is indexed on its instruction plus the example text. The index lives in memory and is rebuilt from the
+          log on load.
+        - `compact` rewrites the log without removed entries and exact duplicates.
+    """
+
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75) -> None:
+        self.path: str = os.path.expanduser(path)
+        self.k1: float = k1
+        self.b: float = b
+        self._lock = threading.Lock()
+        self._entries: Dict[int, Tuple[str, str]] = {}
+        self._next_id: int = 0
+        # Inverted index: term -> (entry ids, term frequencies). Removed entries stay in postings and are skipped.
+        self._postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        self._df: Dict[str, int] = {}  # Live entries per term, for IDF.
+        self._arrays: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._lengths: List[int] = []
+        self._length_array: Optional[np.ndarray] = None
+        self._total_length: int = 0
+        self._removed: Set[int] = set()
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # NOTE: A crash mid-append can leave a partial last line.
+                if "remove" in record:
+                    self._remove(record["remove"])
+                else:
+                    self._index(record["id"], record["instruction"], record["example"])
+
+    def _index(self, id: int, instruction: str, example: str) -> None:
+        self._next_id = max(self._next_id, id + 1)
+        while len(self._lengths) <= id:
+            self._lengths.append(0)
+        terms: List[str] = tokenize(instruction + " " + example)
+        for term, count in Counter(terms).items():
+            ids, counts = self._postings.setdefault(term, ([], []))
+            ids.append(id)
+            counts.append(count)
+            self._df[term] = self._df.get(term, 0) + 1
+            self._arrays.pop(term, None)
+        self._lengths[id] = len(terms)
+        self._length_array = None
+        self._total_length += len(terms)
+        self._entries[id] = (instruction, example)
+
+    def _remove(self, id: int) -> None:
+        if id in self._entries:
+            instruction, example = self._entries.pop(id)
+            for term in set(tokenize(instruction + " " + example)):
+                self._df[term] -= 1
+            self._total_length -= self._lengths[id]
+            self._removed.add(id)
+
+    def _append(self, records: List[dict]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+
+    def add(self, instruction: str, examples: Iterable[str]) -> List[int]:
+        """Store `examples` under `instruction`. Returns their ids."""
+        with self._lock:
+            records: List[dict] = []
+            for example in examples:
+                records.append(
+                    {
+                        "id": self._next_id,
+                        "instruction": instruction,
+                        "example": example,
+                    }
+                )
+                self._index(self._next_id, instruction, example)
+            self._append(records)
+        return [record["id"] for record in records]
+
+    def remove(self, ids: Iterable[int]) -> None:
+        """Remove entries by id (appends tombstones to the log; see `compact`)."""
+        with self._lock:
+            ids = [id for id in ids if id in self._entries]
+            for id in ids:
+                self._remove(id)
+            self._append([{"remove": id} for id in ids])
+
+    def _idf(self, term: str) -> float:
+        n: int = self._df.get(term, 0)
+        total: int = len(self._entries)
+        return math.log(1 + (total - n + 0.5) / (n + 0.5))
+
+    def _posting_arrays(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        if term not in self._arrays:
+            ids, counts = self._postings[term]
+            self._arrays[term] = (
+                np.asarray(ids, dtype=np.int64),
+                np.asarray(counts, dtype=np.float32),
+            )
+        return self._arrays[term]
+
+    def search(self, instruction: str, k: int = 5) -> List[Hit]:
+        """The `k` entries that best match `instruction` under BM25, best first."""
+        with self._lock:
+            if not self._entries:
+                return []
+            terms: List[str] = list(dict.fromkeys(tokenize(instruction)))
+            if self._length_array is None:
+                self._length_array = np.asarray(self._lengths, dtype=np.float32)
+            lengths: np.ndarray = self._length_array
+            average: float = self._total_length / len(self._entries)
+            scores: np.ndarray = np.zeros(len(lengths), dtype=np.float32)
+            covered: np.ndarray = np.zeros(len(lengths), dtype=np.float32)
+            weights: float = 0.0
+            for term in terms:
+                idf: float = self._idf(term)
+                weights += idf
+                if term not in self._postings:
+                    continue
+                ids, counts = self._posting_arrays(term)
+                norm: np.ndarray = self.k1 * (
+                    1 - self.b + self.b * lengths[ids] / average
+                )
+                scores[ids] += idf * counts * (self.k1 + 1) / (counts + norm)
+                covered[ids] += idf
+            if self._removed:
+                scores[list(self._removed)] = -np.inf
+            top: np.ndarray = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+            top = top[np.lexsort((top, -scores[top]))]  # Ties in insertion order.
+            return [
+                Hit(
+                    id=int(id),
+                    instruction=self._entries[id][0],
+                    example=self._entries[id][1],
+                    score=float(scores[id]),
+                    coverage=float(covered[id] / weights) if weights else 0.0,
+                )
+                for id in top.tolist()
+                if scores[id] > 0
+            ]
+
+    def examples(
+        self, instruction: str, k: int = 5, min_coverage: float = 0.8
+    ) -> Optional[List[str]]:
+        """The top `k` stored examples for `instruction`, or None if fewer than `k` cover at least `min_coverage` of it."""
+        hits: List[Hit] = [
+            hit for hit in self.search(instruction, k=k) if hit.coverage >= min_coverage
+        ]
+        if len(hits) < k:
+            return None
+        return [hit.example for hit in hits]
+
+    def compact(self) -> int:
+        """Rewrite the log with only live, distinct entries, and rebuild the index. Returns the number of records dropped."""
+        with self._lock:
+            seen: Set[Tuple[str, str]] = set()
+            records: List[dict] = []
+            for id, entry in sorted(self._entries.items()):
+                if entry not in seen:
+                    seen.add(entry)
+                    records.append(
+                        {"id": id, "instruction": entry[0], "example": entry[1]}
+                    )
+            before: int = 0
+            if os.path.exists(self.path):
+                with open(self.path, encoding="utf-8") as f:
+                    before = sum(1 for line in f if line.strip())
+            with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(record) + "\n" for record in records)
+            os.replace(self.path + ".tmp", self.path)
+            self._entries, self._postings, self._arrays = {}, {}, {}
+            self._df = {}
+            self._lengths, self._length_array = [], None
+            self._total_length, self._removed = 0, set()
+            self._next_id = 0
+            # NOTE: Ids are kept. Gaps left by removed entries are empty rows, which never score.
+            for record in records:
+                self._index(record["id"], record["instruction"], record["example"])
+        return before - len(records)
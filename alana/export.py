@@ -0,0 +1,211 @@
+import os
+import re
+import atexit
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Figure export. Images are rendered on one background worker, so `save=True` doesn't block the caller,
+# and the renderer (kaleido) session is reused across figures.
+
+_COUNTERS: Dict[Tuple[str, str], int] = {}
+_COUNTERS_LOCK = threading.Lock()
+
+
+def _initial_counter(title: str, extension: str) -> int:
+    """Scan the target directory once for existing `title[_N].extension` files. Returns the next free N."""
+    directory: str = os.path.dirname(title) or "."
+    base: str = os.path.basename(title)
+    pattern = re.compile(rf"{re.escape(base)}(?:_(\d+))?\.{re.escape(extension)}")
+    counter = 0
+    if os.path.isdir(directory):
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                match = pattern.fullmatch(entry.name)
+                if match:
+                    counter = max(counter, int(match.group(1) or 0) + 1)
+    return counter
+
+
+def reserve_filename(title: str, extension: str = "png") -> str:
+    """Atomically reserve (create, empty) and return a fresh `title.extension` or `title_N.extension` filename.
+
+    Uses `O_EXCL`, so concurrent callers (threads or processes) never get the same name, plus a cached per-prefix
+    counter, so the directory is only scanned the first time a prefix is seen.
+    """
+    extension = extension.lstrip(".")
+    key: Tuple[str, str] = (title, extension)
+    with _COUNTERS_LOCK:
+        counter: int = _COUNTERS.get(key, -1)
+        if counter < 0:
+            counter = _initial_counter(title=title, extension=extension)
+        while True:
+            filename: str = (
+                f"{title}.{extension}"
+                if counter == 0
+                else f"{title}_{counter}.{extension}"
+            )
+            counter += 1
+            try:
+                fd: int = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            os.close(fd)
+            _COUNTERS[key] = counter
+            return filename
+
+
+def _release(filenames: Sequence[str]) -> None:
+    """Remove reserved files that were never written (still empty)."""
+    for filename in filenames:
+        try:
+            if os.path.getsize(filename) == 0:
+                os.remove(filename)
+        except OSError:
+            pass
+
+
+def _write_images(figs: Sequence[Any], filenames: Sequence[str], **kwargs: Any) -> None:
+    """Write several figures in one renderer session when plotly supports it.
+
+    If writing fails, the reserved files that are still empty are removed before the error is raised.
+    """
+    try:
+        import plotly.io as pio
+
+        if len(figs) > 1 and hasattr(pio, "write_images"):
+            pio.write_images(fig=list(figs), file=list(filenames), **kwargs)
+            return
+        for fig, filename in zip(figs, filenames):
+            fig.write_image(filename, **kwargs)
+    except BaseException:
+        _release(filenames)
+        raise
+
+
+class Exporter:
+    """A single background thread that renders and writes figures, fed by a bounded queue.
+
+    `submit` blocks when `max_pending` jobs are already waiting (backpressure), so a plotting loop can't pile up
+    unbounded figure JSON in memory.
+    """
+
+    def __init__(self, max_pending: int = 32) -> None:
+        self._queue: "queue.Queue[Tuple[Callable[[], None], Future]]" = queue.Queue(
+            maxsize=max_pending
+        )
+        self._thread = threading.Thread(
+            target=self._work, name="alana-export", daemon=True
+        )
+        self._thread.start()
+
+    def _work(self) -> None:
+        while True:
+            action, future = self._queue.get()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        action()
+                    except BaseException as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(None)
+            finally:
+                self._queue.task_done()
+
+    def _submit(self, action: Callable[[], None]) -> Future:
+        future: Future = Future()
+        self._queue.put((action, future))
+        return future
+
+    def submit(self, fig: Any, filename: str, **kwargs: Any) -> Future:
+        """Queue `fig.write_image(filename, **kwargs)`. Returns a Future that resolves once the file is written."""
+        return self._submit(lambda: _write_images([fig], [filename], **kwargs))
+
+    def submit_many(
+        self, figs: Sequence[Any], filenames: Sequence[str], **kwargs: Any
+    ) -> Future:
+        """Queue a batch of figures, rendered together in one renderer session."""
+        if len(figs) != len(filenames):
+            raise ValueError(
+                f"`submit_many`: got {len(figs)} figures but {len(filenames)} filenames."
+            )
+        figs, filenames = list(figs), list(filenames)
+        return self._submit(lambda: _write_images(figs, filenames, **kwargs))
+
+    def join(self) -> None:
+        """Block until every queued export has been written (or failed)."""
+        self._queue.join()
+
+
+_EXPORTER: Optional[Exporter] = None
+_EXPORTER_LOCK = threading.Lock()
+
+
+def get_exporter() -> Exporter:
+    """Return the shared `Exporter`, starting it on first use."""
+    global _EXPORTER
+    with _EXPORTER_LOCK:
+        if _EXPORTER is None:
+            _EXPORTER = Exporter()
+            atexit.register(_EXPORTER.join)  # NOTE: Don't lose queued images at exit.
+        return _EXPORTER
+
+
+def _report(filenames: Sequence[str]) -> Callable[[Future], None]:
+    """A done-callback that prints a failed export, since callers like `heatmap(save=True)` don't wait on the Future."""
+
+    def report(future: Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            from alana.color import (
+                red,
+            )  # NOTE: Imported here, as `alana.color` imports this module.
+
+            error: BaseException = future.exception()  # type: ignore
+            red(
+                var=f"`export`: failed to write {list(filenames)}: {type(error).__name__}: {error}"
+            )
+
+    return report
+
+
+def export(fig: Any, title: str, extension: str = "png", **kwargs: Any) -> Future:
+    """Reserve a fresh filename for `title` and write `fig` to it in the background. Returns a Future.
+
+    A failed write is printed as it happens, and also raised by `future.result()`.
+    """
+    filename: str = reserve_filename(title=title, extension=extension)
+    try:
+        future: Future = get_exporter().submit(fig, filename, **kwargs)
+    except BaseException:
+        _release([filename])
+        raise
+    future.add_done_callback(_report([filename]))
+    return future
+
+
+def export_many(
+    figs: Sequence[Any], titles: Sequence[str], extension: str = "png", **kwargs: Any
+) -> Tuple[List[str], Future]:
+    """Batch version of `export`. Returns (reserved filenames, Future for the whole batch)."""
+    if len(figs) != len(titles):
+        raise ValueError(
+            f"`export_many`: got {len(figs)} figures but {len(titles)} titles."
+        )
+    filenames: List[str] = []
+    try:
+        for title in titles:
+            filenames.append(reserve_filename(title=title, extension=extension))
+        future: Future = get_exporter().submit_many(figs, filenames, **kwargs)
+    except BaseException:
+        _release(filenames)
+        raise
+    future.add_done_callback(_report(filenames))
+    return filenames, future
+
+
+def wait() -> None:
+    """Block until all background exports have finished."""
+    if _EXPORTER is not None:
+        _EXPORTER.join()
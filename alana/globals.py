@@ -14,7 +14,19 @@ MODELS: Dict[str, str] = {
 
 DEFAULT_MODEL = "claude-3-opus-20240229"
 
-SYSTEM: Dict[Literal["few_shot", "gen_prompt", "pretty_print"], str] = {}
+# Output token limit (`max_tokens`) per backend model. Unlisted models are assumed to allow 4096.
+MAX_OUTPUT_TOKENS: Dict[str, int] = {
+    "claude-3-opus-20240229": 4096,
+    "claude-3-sonnet-20240229": 4096,
+    "claude-3-haiku-20240307": 4096,
+    "claude-2.1": 4096,
+    "claude-2.0": 4096,
+    "claude-instant-1.2": 4096,
+}
+
+SYSTEM: Dict[
+    Literal["few_shot", "gen_prompt", "pretty_print", "structured", "judge"], str
+] = {}
 
 SYSTEM.update(
     {
@@ -43,7 +55,7 @@ When writing the system prompt, consider the following components:
 3. Role (optional). Consider telling the model to inhabit a role (e.g. an expert programmer) to improve its response.
 
 When writing the user prompt, consider the following components:
-1. Input data. If the user intends to provide any data to the model, you will use <input_data/> XML tags to surround a {input_data} placeholder variable. i.e. <input_data>{input_data}</input_data>. The user will provide the data using the Python string.format function.
+1. Input data. If the user intends to provide any data to the model, you will use <input_data/> XML tags to surround a {input_data} placeholder variable. i.e. <input_data>{input_data}</input_data>. The user will fill in the placeholder programmatically; it is the ONLY placeholder, so other curly braces in the prompt are fine.
 2. Clear instructions. Consider writing step-by-step instructions for the model to follow to complete the task.
 3. Output formatting. Specify the final output format that the model should conform to.
 4. Few-shot examples (optional). You might include some examples of the intended behavior. Enclose each example in <example/> XML tags.
@@ -144,7 +156,40 @@ SYSTEM.update(
     }
 )
 
-USER: Dict[Literal["few_shot", "gen_prompt", "pretty_print"], str] = {
+SYSTEM.update(
+    {
+        "structured": """Respond with a single JSON object and nothing else. No prose, no markdown code fences.
+
+The JSON object MUST conform to this JSON Schema:
+<schema>
+{schema}
+</schema>
+"""
+    }
+)
+
+SYSTEM.update(
+    {
+        "judge": """You are a strict, impartial evaluator. You will be given a task, an input, and a response to that input. Grade how well the response accomplishes the task for that input.
+
+Think briefly in <reasoning/> XML tags, then give an integer score from 0 (useless) to 10 (perfect) in <score/> XML tags.
+"""
+    }
+)
+
+USER: Dict[
+    Literal[
+        "few_shot",
+        "gen_prompt",
+        "pretty_print",
+        "batch",
+        "optimize",
+        "judge",
+        "map",
+        "reduce",
+    ],
+    str,
+] = {
     "few_shot": """The user's task is as follows:
 <description>{instruction}</description>
 
@@ -170,11 +215,65 @@ Now:
 Be sure that you faithfully reproduce the data in the raw string, and only change the formatting.
 
 Produce your final output in <pretty/> XML tags.
+""",
+    "batch": """You will receive {n} independent requests, each enclosed in <item id="..."/> XML tags. Handle each one on its own, exactly as if it were the only message you received.
+
+{items}
+
+Respond to EVERY item. Enclose your full response to the item with id N in <answer_N/> XML tags (e.g. <answer_0>...</answer_0> for id 0). Output nothing outside of the answer tags.
+""",
+    "optimize": """{instruction}
+
+A previous attempt at this prompt scored {score} on average (0 to 1, higher is better):
+<previous_system_prompt>
+{system}
+</previous_system_prompt>
+<previous_user_prompt>
+{user}
+</previous_user_prompt>
+
+Here are the inputs where it did worst, with its responses and their scores:
+{feedback}
+
+Write an improved prompt that fixes these failures while keeping what already works.
+""",
+    "judge": """<task>
+{criteria}
+</task>
+
+<input>
+{input}
+</input>
+
+<response>
+{output}
+</response>
+
+Grade the response.
+""",
+    "map": """Here is one part of a longer document:
+
+<document_part>
+{chunk}
+</document_part>
+
+{instruction}
+
+Only use this part of the document. Enclose your result in <result/> XML tags.
+""",
+    "reduce": """Here are results computed from consecutive parts of a longer document, in order:
+
+{results}
+
+{instruction}
+
+Combine these into a single result for the whole span they cover. Enclose it in <result/> XML tags.
 """,
 }
 
 
 def get_prompts(
-    function_name: Literal["few_shot", "gen_prompt", "pretty_print"], str
+    function_name: Literal["few_shot", "gen_prompt", "pretty_print"],
 ) -> Tuple[str, str]:
+    """Return the (system, user) prompt templates used by `function_name`."""
     return (SYSTEM[function_name], USER[function_name])
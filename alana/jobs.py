@@ -0,0 +1,410 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import asyncio
+import hashlib
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set
+from anthropic.types import Message, MessageParam
+
+from alana import globals
+from alana.color import red
+from alana.prompt import _get_text
+
+# Durable job queue for long generation runs. Jobs live in a SQLite file, so a crashed run picks up where it left off
+# without re-billing finished items. Processing is at-least-once: a job whose worker dies is retried once its lease
+# expires, or right away when its run is known to be dead (same host, and its process has exited or it was an earlier
+# run in this process; see `requeue_stale`).
+
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    request TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_until REAL,
+    owner TEXT,
+    result TEXT,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+"""
+
+
+# Runs (`JobQueue.arun`) active in this process, by id.
+_ACTIVE_RUNS: Set[str] = set()
+
+
+def _owner_alive(owner: str) -> bool:
+    """Whether the run `owner` ("host:pid:run") may still be working. Unknown (another host, Windows) counts as alive."""
+    host, pid, run = owner.rsplit(":", 2)
+    if host != socket.gethostname():
+        return True
+    if int(pid) == os.getpid():
+        return run in _ACTIVE_RUNS
+    # NOTE: `os.kill(pid, 0)` would terminate the process on Windows.
+    if os.name == "nt":
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def request_key(request: Dict[str, Any]) -> str:
+    """Default idempotency key: a hash of the request parameters."""
+    return hashlib.sha256(
+        json.dumps(request, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def _record(key: str, message: Message) -> Dict[str, Any]:
+    return {
+        "key": key,
+        "text": _get_text(message),
+        "model": message.model,
+        "stop_reason": message.stop_reason,
+        "input_tokens": message.usage.input_tokens,
+        "output_tokens": message.usage.output_tokens,
+    }
+
+
+class JsonlSink:
+    """Appends one JSON object per completed job to `path`, flushed as it goes."""
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class ParquetSink:
+    """Writes completed jobs to a Parquet file in row groups of `batch_size` (requires `pyarrow`).
+
+    Parquet files can't be appended to, so each run writes a new file; use `JobQueue.export` for the full result set.
+    """
+
+    def __init__(self, path: str, batch_size: int = 1000) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self.path: str = path
+        self.batch_size: int = batch_size
+        self._rows: List[Dict[str, Any]] = []
+        self._schema = pa.schema(
+            [
+                ("key", pa.string()),
+                ("text", pa.string()),
+                ("model", pa.string()),
+                ("stop_reason", pa.string()),
+                ("input_tokens", pa.int64()),
+                ("output_tokens", pa.int64()),
+            ]
+        )
+        self._writer = pq.ParquetWriter(path, self._schema)
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self._rows.append(record)
+        if len(self._rows) >= self.batch_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._rows:
+            self._writer.write_table(
+                self._pa.Table.from_pylist(self._rows, schema=self._schema)
+            )
+            self._rows = []
+
+    def close(self) -> None:
+        self._flush()
+        self._writer.close()
+
+
+def open_sink(path: str) -> Any:
+    """A `ParquetSink` for `.parquet` paths, otherwise a `JsonlSink`."""
+    if path.endswith(".parquet"):
+        return ParquetSink(path)
+    return JsonlSink(path)
+
+
+class JobQueue:
+    """A SQLite-backed queue of `gen_msg`-style requests.
+
+    Args:
+        path (str): SQLite file. Created if missing.
+        lease_seconds (float, optional): How long a worker owns a job before others may retry it. Defaults to 600.
+        max_attempts (int, optional): Attempts before a job is marked "failed". Defaults to 3.
+
+    Example:
+        >>> queue = JobQueue("jobs.db")
+        >>> queue.add_many({"user": f"Summarize: {doc}", "max_tokens": 256} for doc in docs)
+        >>> queue.run(workers=16, sink="results.jsonl")  # Re-run after a crash to finish the rest.
+        {'done': 100000}
+    """
+
+    def __init__(
+        self, path: str, lease_seconds: float = 600, max_attempts: int = 3
+    ) -> None:
+        self.path: str = path
+        self.lease_seconds: float = lease_seconds
+        self.max_attempts: int = max_attempts
+        self._db: sqlite3.Connection = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        columns: List[str] = [
+            row[1] for row in self._db.execute("PRAGMA table_info(jobs)")
+        ]
+        # NOTE: Queues created before runs recorded their owner lack the column.
+        if "owner" not in columns:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    def add(
+        self,
+        user: Optional[str] = None,
+        messages: Optional[List[MessageParam]] = None,
+        key: Optional[str] = None,
+        **params: Any,
+    ) -> str:
+        """Enqueue one request (`user`/`messages` plus any `agen_msg` parameters). Returns its key.
+
+        Adding a key that is already queued (or done) is a no-op, so re-running the script that fills the queue is safe.
+        """
+        return self.add_many([dict(user=user, messages=messages, key=key, **params)])[0]
+
+    def add_many(self, requests: Iterable[Dict[str, Any]]) -> List[str]:
+        """Enqueue many requests in one transaction. Each may carry a `key`. Returns the keys."""
+        keys: List[str] = []
+        rows: List[tuple] = []
+        for request in requests:
+            request = {k: v for k, v in request.items() if v is not None}
+            key: str = request.pop("key", None) or request_key(request)
+            keys.append(key)
+            rows.append((key, json.dumps(request), time.time()))
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT OR IGNORE INTO jobs (key, request, updated) VALUES (?, ?, ?)",
+                rows,
+            )
+        return keys
+
+    def counts(self) -> Dict[str, int]:
+        """Number of jobs per status ("pending", "running", "done", "failed")."""
+        return dict(
+            self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        )
+
+    def requeue_running(self) -> int:
+        """Put every "running" job back to "pending". Only call this when no other process is working the queue."""
+        return self._db.execute(
+            "UPDATE jobs SET status = 'pending', lease_until = NULL WHERE status = 'running'"
+        ).rowcount
+
+    def requeue_stale(self) -> int:
+        """Put "running" jobs whose run is known to be dead back to "pending". Safe while other processes work the queue.
+
+        A run is known to be dead if it was on this host and its process has exited, or it was an earlier run in this
+        process. Jobs of runs on other hosts keep their lease.
+        """
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            stale: List[tuple] = [
+                (key, owner)
+                for key, owner in self._db.execute(
+                    "SELECT key, owner FROM jobs WHERE status = 'running' AND owner IS NOT NULL"
+                ).fetchall()
+                if not _owner_alive(owner)
+            ]
+            self._db.executemany(
+                "UPDATE jobs SET status = 'pending', lease_until = NULL, owner = NULL"
+                " WHERE key = ? AND owner = ?",
+                stale,
+            )
+        return len(stale)
+
+    def retry_failed(self) -> int:
+        """Put every "failed" job back to "pending" with a fresh attempt budget."""
+        return self._db.execute(
+            "UPDATE jobs SET status = 'pending', attempts = 0, error = NULL WHERE status = 'failed'"
+        ).rowcount
+
+    def result(self, key: str) -> Optional[Message]:
+        """The `Message` for a finished job, or None."""
+        row = self._db.execute(
+            "SELECT result FROM jobs WHERE key = ? AND status = 'done'", (key,)
+        ).fetchone()
+        return None if row is None else Message.model_validate_json(row[0])
+
+    def results(self) -> Iterator[Dict[str, Any]]:
+        """Yield a record (key, text, model, stop_reason, token counts) for every finished job."""
+        for key, result in self._db.execute(
+            "SELECT key, result FROM jobs WHERE status = 'done' ORDER BY rowid"
+        ):
+            yield _record(key, Message.model_validate_json(result))
+
+    def export(self, path: str) -> int:
+        """Write every finished job to a fresh JSONL or Parquet file. Returns the number of records."""
+        if os.path.exists(path):
+            os.remove(path)
+        sink = open_sink(path)
+        n: int = 0
+        try:
+            for record in self.results():
+                sink.write(record)
+                n += 1
+        finally:
+            sink.close()
+        return n
+
+    def _claim(self, owner: Optional[str] = None) -> Optional[tuple]:
+        now: float = time.time()
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            row = self._db.execute(
+                "SELECT key, request FROM jobs WHERE status = 'pending'"
+                " OR (status = 'running' AND lease_until < ?) ORDER BY rowid LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is not None:
+                self._db.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, owner = ?,"
+                    " updated = ? WHERE key = ?",
+                    (now + self.lease_seconds, owner, now, row[0]),
+                )
+        return row
+
+    def _finish(self, key: str, message: Message) -> None:
+        self._db.execute(
+            "UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_until = NULL, updated = ? WHERE key = ?",
+            (message.model_dump_json(), time.time(), key),
+        )
+
+    def _release(self, key: str) -> None:
+        """Hand a claimed job back untried (its run was cancelled)."""
+        self._db.execute(
+            "UPDATE jobs SET status = 'pending', attempts = attempts - 1, lease_until = NULL, owner = NULL,"
+            " updated = ? WHERE key = ?",
+            (time.time(), key),
+        )
+
+    def _fail(self, key: str, error: BaseException) -> None:
+        self._db.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,"
+            " error = ?, lease_until = NULL, updated = ? WHERE key = ?",
+            (self.max_attempts, f"{type(error).__name__}: {error}", time.time(), key),
+        )
+
+    async def arun(
+        self,
+        workers: int = 8,
+        sink: Optional[str] = None,
+        model: str = globals.DEFAULT_MODEL,
+        api_key: Optional[str] = None,
+        **defaults: Any,
+    ) -> Dict[str, int]:
+        """Process the queue with `workers` concurrent `agen_msg` calls until nothing is left to claim.
+
+        Args:
+            workers (int, optional): Number of concurrent workers. Defaults to 8.
+            sink (Optional[str], optional): A .jsonl or .parquet path; each finished job is written there as it completes.
+            model (str, optional): Default model for jobs that don't set one. Defaults to globals.DEFAULT_MODEL.
+            api_key (Optional[str], optional): The API key to use for authentication. Defaults to None.
+            **defaults: Default `agen_msg` parameters for jobs that don't set them (e.g. `system`, `priority`).
+
+        Returns:
+            Dict[str, int]: `counts()` after the run.
+
+        Notes:
+            - Each result is committed to the database as soon as it arrives; a restart skips finished jobs.
+            - On start, jobs left "running" by a crashed run are requeued (see `requeue_stale`). A cancelled run puts
+              its jobs in flight back to "pending".
+            - Errors are recorded and the job is retried, up to `max_attempts` times in total.
+            - The sink sees each job at least once per run that finishes it; use `export` for an exact, deduplicated copy.
+        """
+        from alana.prompt_async import agen_msg
+
+        requeued: int = self.requeue_stale()
+        if requeued:
+            red(
+                var=f"`JobQueue`: requeued {requeued} jobs left running by a crashed run."
+            )
+        owner: str = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:12]}"
+        _ACTIVE_RUNS.add(owner)
+        output = open_sink(sink) if sink is not None else None
+        in_flight: List[int] = [0]
+
+        async def worker() -> None:
+            while True:
+                claimed: Optional[tuple] = self._claim(owner)
+                if claimed is None:
+                    if in_flight[0] == 0:
+                        return
+                    await asyncio.sleep(
+                        0.05
+                    )  # A job in flight may fail and become pending again.
+                    continue
+                key, request = claimed
+                params: Dict[str, Any] = {
+                    "model": model,
+                    "api_key": api_key,
+                    **defaults,
+                    **json.loads(request),
+                }
+                in_flight[0] += 1
+                try:
+                    message: Message = await agen_msg(stream_action=None, **params)
+                except Exception as e:
+                    red(var=f"`JobQueue`: job {key[:12]} failed: {e}")
+                    self._fail(key, e)
+                    continue
+                except asyncio.CancelledError:
+                    self._release(key)
+                    raise
+                finally:
+                    in_flight[0] -= 1
+                self._finish(key, message)
+                if output is not None:
+                    output.write(_record(key, message))
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(workers)))
+        finally:
+            _ACTIVE_RUNS.discard(owner)
+            if output is not None:
+                output.close()
+        return self.counts()
+
+    def run(
+        self,
+        workers: int = 8,
+        sink: Optional[str] = None,
+        model: str = globals.DEFAULT_MODEL,
+        api_key: Optional[str] = None,
+        **defaults: Any,
+    ) -> Dict[str, int]:
+        """Sync version of `arun`. Runs on the shared background event loop (see `alana.loop`)."""
+        from alana.loop import run
+
+        return run(
+            self.arun(
+                workers=workers, sink=sink, model=model, api_key=api_key, **defaults
+            )
+        )
+
+    def close(self) -> None:
+        self._db.close()
@@ -0,0 +1,65 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Coroutine, Optional, TypeVar
+
+# A persistent event loop on a daemon thread. Lets sync code (and Jupyter, which already runs a loop) use the
+# `agen*` coroutines without spinning up and tearing down a loop (and its connection pool) on every call.
+
+T = TypeVar("T")
+
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_THREAD: Optional[threading.Thread] = None
+_LOCK = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Return the background event loop, starting its thread on first use."""
+    global _LOOP, _THREAD
+    with _LOCK:
+        if _LOOP is None or _LOOP.is_closed():
+            loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def _run() -> None:
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+
+            _THREAD = threading.Thread(target=_run, name="alana-loop", daemon=True)
+            _THREAD.start()
+            ready.wait()
+            _LOOP = loop
+        return _LOOP
+
+
+def in_loop_thread() -> bool:
+    """Whether the caller is running on the background loop's thread."""
+    return _THREAD is not None and threading.current_thread() is _THREAD
+
+
+def submit(coro: Coroutine[Any, Any, T]) -> "Future[T]":
+    """Schedule `coro` on the background loop. Returns a `concurrent.futures.Future`.
+
+    Example:
+        >>> future = submit(agen(user="Hello, Claude!", stream_action=None))
+        >>> future.result()
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run(coro: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+    """Run `coro` on the background loop and block until it finishes. Works inside Jupyter.
+
+    Raises:
+        RuntimeError: If called from the background loop itself (that would deadlock). `await` the coroutine instead.
+
+    Example:
+        >>> text = run(agen(user="Hello, Claude!"))
+    """
+    if in_loop_thread():
+        coro.close()
+        raise RuntimeError(
+            "`alana.loop.run` called from the background loop; `await` the coroutine instead."
+        )
+    return submit(coro).result(timeout=timeout)
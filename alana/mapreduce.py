@@ -0,0 +1,298 @@
+import re
+import zlib
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, MutableMapping, Optional
+
+from alana import globals
+from alana import templates
+from alana.dataset import cache_key
+from alana.prompt import get_xml
+
+# Map-reduce over documents too long for one call: split into chunks, run the map prompt over every chunk concurrently,
+# then combine the results `fan_in` at a time until one is left (so depth grows with log(chunks)). Chunk boundaries are
+# content-defined, and every call is cached by the hash of its prompt, so re-running on an edited document only pays
+# for the chunks (and the reduce path) that changed.
+
+# Preferred places to cut, coarsest first: paragraphs, lines, sentences, words.
+_BOUNDARIES = [
+    re.compile(r"\n\s*\n"),
+    re.compile(r"\n"),
+    re.compile(r"(?<=[.!?])\s+"),
+    re.compile(r"\s+"),
+]
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count: ~4 characters per token (as in `alana.scheduler.estimate_tokens`)."""
+    return (len(text) + 3) // 4
+
+
+def _units(
+    text: str, max_tokens: int, count_tokens: Callable[[str], int], level: int = 0
+) -> List[str]:
+    """`text` cut at the coarsest boundaries that keep every piece within `max_tokens`. Concatenates back to `text`."""
+    if count_tokens(text) <= max_tokens:
+        return [text]
+    if level == len(_BOUNDARIES):
+        step: int = max(1, len(text) * max_tokens // count_tokens(text))
+        return [text[i : i + step] for i in range(0, len(text), step)]
+    ends: List[int] = [m.end() for m in _BOUNDARIES[level].finditer(text)]
+    units: List[str] = []
+    for start, end in zip([0] + ends, ends + [len(text)]):
+        if start < end:
+            units += _units(text[start:end], max_tokens, count_tokens, level + 1)
+    return units
+
+
+def _tail(text: str, max_tokens: int, count_tokens: Callable[[str], int]) -> str:
+    """The longest suffix of `text` starting at a word boundary and within `max_tokens`."""
+    starts: List[int] = [m.end() for m in re.finditer(r"\s+", text)]
+    lo, hi = 0, len(starts)
+    while lo < hi:
+        mid: int = (lo + hi) // 2
+        if count_tokens(text[starts[mid] :]) <= max_tokens:
+            hi = mid
+        else:
+            lo = mid + 1
+    return text[starts[lo] :] if lo < len(starts) else ""
+
+
+def chunk(
+    text: str,
+    max_tokens: int = 2000,
+    overlap: int = 200,
+    count_tokens: Optional[Callable[[str], int]] = None,
+) -> List[str]:
+    """Split `text` into chunks of at most `max_tokens`, each starting with up to `overlap` tokens from the end of the previous one.
+
+    Args:
+        text (str): The document.
+        max_tokens (int, optional): Token budget per chunk, overlap included. Defaults to 2000.
+        overlap (int, optional): Tokens of context repeated from the previous chunk. Defaults to 200.
+        count_tokens (Optional[Callable[[str], int]], optional): Token counter, e.g. a real tokenizer's. Defaults to `estimate_tokens`.
+
+    Returns:
+        List[str]: The chunks, in order.
+
+    Notes:
+        - Chunks are cut at paragraph breaks where possible, then lines, sentences and words.
+        - Where to cut is decided by hashing the pieces' content, not by absolute position, so an edit only moves the
+          boundaries around it, and the chunks elsewhere stay identical (and cached).
+    """
+    count: Callable[[str], int] = count_tokens or estimate_tokens
+    if overlap >= max_tokens:
+        raise ValueError("`chunk`: `overlap` must be smaller than `max_tokens`.")
+    budget: int = max_tokens - overlap
+    units: List[str] = _units(text, budget, count)
+    sizes: List[int] = [count(unit) for unit in units]
+    # NOTE: Past a quarter of the budget, cut after about one piece in `divisor` (chosen by content hash), aiming for
+    # chunks of about half the budget. Cuts at the budget itself are then rare.
+    divisor: int = max(1, round(budget * len(units) / (4 * max(1, sum(sizes)))))
+    bodies: List[str] = []
+    current: List[str] = []
+    size: int = 0
+    for unit, tokens in zip(units, sizes):
+        if current and size + tokens > budget:
+            bodies.append("".join(current))
+            current, size = [], 0
+        current.append(unit)
+        size += tokens
+        if size >= budget // 4 and zlib.crc32(unit.encode("utf-8")) % divisor == 0:
+            bodies.append("".join(current))
+            current, size = [], 0
+    if current:
+        bodies.append("".join(current))
+    if not overlap:
+        return bodies
+    return bodies[:1] + [
+        _tail(previous, overlap, count) + body
+        for previous, body in zip(bodies, bodies[1:])
+    ]
+
+
+@dataclass
+class MapReduce:
+    """Result of `map_reduce`/`amap_reduce`."""
+
+    output: str
+    chunks: List[str] = field(repr=False)
+    mapped: List[str] = field(repr=False)
+    levels: int = 0
+    calls: int = 0
+    cached_calls: int = 0
+
+
+async def amap_reduce(
+    document: str,
+    instruction: str,
+    reduce_instruction: Optional[str] = None,
+    chunk_tokens: int = 2000,
+    overlap: int = 200,
+    fan_in: int = 4,
+    count_tokens: Optional[Callable[[str], int]] = None,
+    system: str = "",
+    model: str = globals.DEFAULT_MODEL,
+    api_key: Optional[str] = None,
+    max_tokens: int = 1024,
+    temperature=0.0,
+    concurrency: int = 8,
+    cache: Optional[MutableMapping[str, str]] = None,
+    priority: str = "batch",
+    **kwargs: Any,
+) -> MapReduce:
+    """Experimental. Run `instruction` over every chunk of `document` concurrently, then combine the results in a tree.
+
+    Args:
+        document (str): The long input.
+        instruction (str): What to do with each chunk (e.g. "List every person mentioned, with their role.").
+        reduce_instruction (Optional[str], optional): How to combine results. Defaults to `instruction`.
+        chunk_tokens (int, optional): Token budget per chunk. See `chunk`. Defaults to 2000.
+        overlap (int, optional): Tokens repeated from the previous chunk. Defaults to 200.
+        fan_in (int, optional): Results combined per reduce call. Defaults to 4.
+        count_tokens (Optional[Callable[[str], int]], optional): Token counter for chunking. Defaults to `estimate_tokens`.
+        system (str, optional): System prompt for every call. Defaults to "".
+        model (str, optional): The name of the model to use. Defaults to `globals.DEFAULT_MODEL`.
+        api_key (Optional[str], optional): The API key to use for authentication. Defaults to None.
+        max_tokens (int, optional): The maximum number of tokens per call. Defaults to 1024.
+        temperature (float, optional): Defaults to 0.0, so cached results are what a re-run would give.
+        concurrency (int, optional): Maximum calls in flight. Defaults to 8.
+        cache (Optional[MutableMapping[str, str]], optional): Cache for every call, keyed by a hash of its prompt and settings (`kwargs` included), e.g. `shelve.open(...)`. Defaults to None.
+        priority (str, optional): Priority class for `alana.scheduler`, if one is configured. Defaults to "batch".
+        **kwargs: Additional keyword arguments for every call (e.g. `tenant`).
+
+    Returns:
+        MapReduce: The final `output`, the `chunks` and their `mapped` results, the number of reduce `levels`, and call counts.
+
+    Example:
+        >>> cache = shelve.open("contract.cache")
+        >>> result = map_reduce(contract, "List every obligation of the supplier.", cache=cache)
+        >>> print(result.output)
+        >>> result = map_reduce(edited_contract, "List every obligation of the supplier.", cache=cache)  # Only changed chunks are re-run.
+    """
+    from alana.prompt_async import agen
+
+    if fan_in < 2:
+        raise ValueError("`amap_reduce`: `fan_in` must be at least 2.")
+    semaphore = asyncio.Semaphore(concurrency)
+    counts: Dict[str, int] = {"calls": 0, "cached_calls": 0}
+
+    async def call(kind: str, user: str) -> str:
+        key: str = cache_key(
+            user,
+            kind=kind,
+            system=system,
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            **kwargs,
+        )
+        if cache is not None and key in cache:
+            counts["cached_calls"] += 1
+            return cache[key]
+        async with semaphore:
+            counts["calls"] += 1
+            text: str = await agen(
+                user=user,
+                system=system,
+                model=model,
+                api_key=api_key,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream_action=None,
+                priority=priority,
+                **kwargs,
+            )
+        found: List[str] = get_xml(tag="result", content=text)
+        result: str = found[-1].strip() if found else text.strip()
+        if cache is not None:
+            cache[key] = result
+        return result
+
+    chunks: List[str] = chunk(document, chunk_tokens, overlap, count_tokens)
+    mapped: List[str] = list(
+        await asyncio.gather(
+            *(
+                call(
+                    "map",
+                    templates.builtin("user", "map").render(
+                        chunk=piece, instruction=instruction
+                    ),
+                )
+                for piece in chunks
+            )
+        )
+    )
+
+    def reduce(group: List[str]) -> Awaitable[str]:
+        return call(
+            "reduce",
+            templates.builtin("user", "reduce").render(
+                results="\n".join(f"<part>\n{r}\n</part>" for r in group),
+                instruction=reduce_instruction or instruction,
+            ),
+        )
+
+    results: List[str] = mapped
+    levels: int = 0
+    while len(results) > 1:
+        # NOTE: Groups are consecutive, so the reduce prompts only change along the path from an edited chunk to the root.
+        results = list(
+            await asyncio.gather(
+                *(
+                    reduce(results[i : i + fan_in])
+                    for i in range(0, len(results), fan_in)
+                )
+            )
+        )
+        levels += 1
+    return MapReduce(
+        output=results[0] if results else "",
+        chunks=chunks,
+        mapped=mapped,
+        levels=levels,
+        **counts,
+    )
+
+
+def map_reduce(
+    document: str,
+    instruction: str,
+    reduce_instruction: Optional[str] = None,
+    chunk_tokens: int = 2000,
+    overlap: int = 200,
+    fan_in: int = 4,
+    count_tokens: Optional[Callable[[str], int]] = None,
+    system: str = "",
+    model: str = globals.DEFAULT_MODEL,
+    api_key: Optional[str] = None,
+    max_tokens: int = 1024,
+    temperature=0.0,
+    concurrency: int = 8,
+    cache: Optional[MutableMapping[str, str]] = None,
+    priority: str = "batch",
+    **kwargs: Any,
+) -> MapReduce:
+    """Sync version of `amap_reduce`. Runs on the shared background event loop (see `alana.loop`)."""
+    from alana.loop import run
+
+    return run(
+        amap_reduce(
+            document=document,
+            instruction=instruction,
+            reduce_instruction=reduce_instruction,
+            chunk_tokens=chunk_tokens,
+            overlap=overlap,
+            fan_in=fan_in,
+            count_tokens=count_tokens,
+            system=system,
+            model=model,
+            api_key=api_key,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            concurrency=concurrency,
+            cache=cache,
+            priority=priority,
+            **kwargs,
+        )
+    )
@@ -0,0 +1,314 @@
+import json
+import asyncio
+import statistics
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from alana import globals
+from alana import templates
+from alana.color import red
+from alana.dataset import cache_key
+from alana.prompt import get_xml
+
+# Prompt search: generate candidate prompts with `agen_prompt`, run each over an eval set, score, refine, repeat.
+
+
+@dataclass
+class PromptCandidate:
+    """One generated prompt and how it did on the eval set."""
+
+    system: str
+    user: str
+    round: int
+    score: float = float("-inf")
+    scores: List[float] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list, repr=False)
+
+    @property
+    def template(self) -> templates.Template:
+        """The user prompt as a template over `{input_data}`."""
+        return _user_template(self.user)
+
+
+@dataclass
+class Optimization:
+    """Result of `optimize_prompt`/`aoptimize_prompt`. `candidates` is sorted best first."""
+
+    best: PromptCandidate
+    candidates: List[PromptCandidate]
+    calls: int = 0
+    cached_calls: int = 0
+
+
+def _user_template(user: str) -> templates.Template:
+    if "{input_data}" not in user:
+        user += "\n\n<input_data>{input_data}</input_data>"
+    return templates.compile_template(user, variables=["input_data"])
+
+
+def _first(value: Any) -> str:
+    if isinstance(value, list):
+        return value[0] if value else ""
+    return value
+
+
+async def aoptimize_prompt(
+    instruction: str,
+    eval_inputs: Sequence[str],
+    metric: Optional[Callable[[str, str], float]] = None,
+    criteria: Optional[str] = None,
+    k: int = 4,
+    rounds: int = 2,
+    model: str = globals.DEFAULT_MODEL,
+    prompt_model: Optional[str] = None,
+    judge_model: Optional[str] = None,
+    api_key: Optional[str] = None,
+    max_tokens: int = 1024,
+    temperature=1.0,
+    concurrency: int = 8,
+    cache: Optional[MutableMapping[str, str]] = None,
+    priority: str = "batch",
+    **kwargs: Any,
+) -> Optimization:
+    """Experimental. Search for a good prompt for `instruction` by generating, evaluating and refining candidates.
+
+    Args:
+        instruction (str): What the prompt should get the model to do (as for `gen_prompt`).
+        eval_inputs (Sequence[str]): Inputs filled into each candidate's `{input_data}`. Keep it small (5-20).
+        metric (Optional[Callable[[str, str], float]], optional): `metric(input, output)` -> score in [0, 1]. If None, an LLM judge grades against `criteria`.
+        criteria (Optional[str], optional): What the judge should look for. Defaults to `instruction`.
+        k (int, optional): Candidates generated concurrently per round. Defaults to 4.
+        rounds (int, optional): Rounds of generation. Rounds after the first refine the best prompt so far using its worst cases. Defaults to 2.
+        model (str, optional): Model the prompt is being written for (runs the eval set). Defaults to globals.DEFAULT_MODEL.
+        prompt_model (Optional[str], optional): Model that writes the candidates. Defaults to `model`.
+        judge_model (Optional[str], optional): Model that grades outputs. Defaults to `model`.
+        api_key (Optional[str], optional): The API key to use for authentication. Defaults to None.
+        max_tokens (int, optional): The maximum number of tokens per call. Defaults to 1024.
+        temperature (float, optional): Temperature for generating candidates (evals and judging use 0). Defaults to 1.0.
+        concurrency (int, optional): Maximum calls in flight. Defaults to 8.
+        cache (Optional[MutableMapping[str, str]], optional): Cache for every sub-call (candidates, evals, judgments), keyed by its prompt and settings (`kwargs` included), e.g. `shelve.open(...)`. Re-running a search with the same cache is free. Defaults to None.
+        priority (str, optional): Priority class for `alana.scheduler`, if one is configured. Defaults to "batch".
+        **kwargs: Additional keyword arguments for every call (e.g. `tenant`).
+
+    Returns:
+        Optimization: The best candidate, all candidates sorted by score, and call counts.
+
+    Example:
+        >>> result = optimize_prompt(
+        ...     "Classify the sentiment of a product review as positive or negative.",
+        ...     eval_inputs=reviews,
+        ...     metric=lambda review, output: float(get_xml("answer", output) == [labels[review]]),
+        ... )
+        >>> print(result.best.score, result.best.user)
+    """
+    from alana.prompt_async import agen, agen_prompt
+
+    semaphore = asyncio.Semaphore(concurrency)
+    counts: Dict[str, int] = {"calls": 0, "cached_calls": 0}
+    settings: Dict[str, Any] = dict(api_key=api_key, priority=priority, **kwargs)
+
+    async def cached(key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        if cache is not None and key in cache:
+            counts["cached_calls"] += 1
+            return json.loads(cache[key])
+        async with semaphore:
+            counts["calls"] += 1
+            value: Any = await call()
+        if cache is not None:
+            cache[key] = json.dumps(value)
+        return value
+
+    async def generate(request: str, round: int, i: int) -> PromptCandidate:
+        async def call() -> Dict[str, str]:
+            prompts = await agen_prompt(
+                instruction=request,
+                model=prompt_model or model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream_action=None,
+                **settings,
+            )
+            return {
+                "system": _first(prompts["system"]),
+                "user": _first(prompts["user"]),
+            }
+
+        # NOTE: `sample` keeps the K candidates of a round distinct in the cache.
+        prompts: Dict[str, str] = await cached(
+            cache_key(
+                request,
+                kind="prompt",
+                model=prompt_model or model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                sample=i,
+                **kwargs,
+            ),
+            call,
+        )
+        return PromptCandidate(
+            system=prompts["system"], user=prompts["user"], round=round
+        )
+
+    async def run_one(candidate: PromptCandidate, input_data: str) -> str:
+        user: str = candidate.template.render(input_data=input_data)
+
+        async def call() -> str:
+            return await agen(
+                user=user,
+                system=candidate.system,
+                model=model,
+                max_tokens=max_tokens,
+                temperature=0.0,
+                stream_action=None,
+                **settings,
+            )
+
+        return await cached(
+            cache_key(
+                user,
+                kind="eval",
+                system=candidate.system,
+                model=model,
+                max_tokens=max_tokens,
+                **kwargs,
+            ),
+            call,
+        )
+
+    async def judge(input_data: str, output: str) -> float:
+        user: str = templates.builtin("user", "judge").render(
+            criteria=criteria or instruction, input=input_data, output=output
+        )
+
+        async def call() -> str:
+            return await agen(
+                user=user,
+                system=templates.builtin("system", "judge").render(),
+                model=judge_model or model,
+                max_tokens=max_tokens,
+                temperature=0.0,
+                stream_action=None,
+                **settings,
+            )
+
+        text: str = await cached(
+            cache_key(
+                user,
+                kind="judge",
+                model=judge_model or model,
+                max_tokens=max_tokens,
+                **kwargs,
+            ),
+            call,
+        )
+        found: List[str] = get_xml(tag="score", content=text)
+        try:
+            return min(1.0, max(0.0, float(found[-1].strip()) / 10))
+        except (IndexError, ValueError):
+            red(var="`aoptimize_prompt`: judge gave no <score/>; counting 0.")
+            return 0.0
+
+    async def evaluate(candidate: PromptCandidate) -> PromptCandidate:
+        candidate.outputs = list(
+            await asyncio.gather(*(run_one(candidate, x) for x in eval_inputs))
+        )
+        if metric is not None:
+            candidate.scores = [
+                metric(x, out) for x, out in zip(eval_inputs, candidate.outputs)
+            ]
+        else:
+            candidate.scores = list(
+                await asyncio.gather(
+                    *(judge(x, out) for x, out in zip(eval_inputs, candidate.outputs))
+                )
+            )
+        candidate.score = (
+            statistics.fmean(candidate.scores) if candidate.scores else 0.0
+        )
+        return candidate
+
+    async def attempt(request: str, round: int, i: int) -> Optional[PromptCandidate]:
+        try:
+            return await evaluate(await generate(request, round, i))
+        except Exception as e:
+            red(var=f"`aoptimize_prompt`: candidate {i} of round {round} failed: {e}")
+            return None
+
+    candidates: List[PromptCandidate] = []
+    for round in range(rounds):
+        request: str = instruction
+        if candidates:
+            best: PromptCandidate = max(candidates, key=lambda c: c.score)
+            worst: List[Tuple[float, str, str]] = sorted(
+                zip(best.scores, eval_inputs, best.outputs)
+            )[:3]
+            request = templates.builtin("user", "optimize").render(
+                instruction=instruction,
+                score=f"{best.score:.2f}",
+                system=best.system,
+                user=best.user,
+                feedback="\n".join(
+                    f"<case score={score:.2f}>\n<input>{x}</input>\n<response>{out}</response>\n</case>"
+                    for score, x, out in worst
+                ),
+            )
+        found = await asyncio.gather(*(attempt(request, round, i) for i in range(k)))
+        candidates += [c for c in found if c is not None]
+    if not candidates:
+        raise RuntimeError("`aoptimize_prompt`: every candidate failed.")
+    candidates.sort(key=lambda c: c.score, reverse=True)
+    return Optimization(best=candidates[0], candidates=candidates, **counts)
+
+
+def optimize_prompt(
+    instruction: str,
+    eval_inputs: Sequence[str],
+    metric: Optional[Callable[[str, str], float]] = None,
+    criteria: Optional[str] = None,
+    k: int = 4,
+    rounds: int = 2,
+    model: str = globals.DEFAULT_MODEL,
+    prompt_model: Optional[str] = None,
+    judge_model: Optional[str] = None,
+    api_key: Optional[str] = None,
+    max_tokens: int = 1024,
+    temperature=1.0,
+    concurrency: int = 8,
+    cache: Optional[MutableMapping[str, str]] = None,
+    priority: str = "batch",
+    **kwargs: Any,
+) -> Optimization:
+    """Sync version of `aoptimize_prompt`. Runs on the shared background event loop (see `alana.loop`)."""
+    from alana.loop import run
+
+    return run(
+        aoptimize_prompt(
+            instruction=instruction,
+            eval_inputs=eval_inputs,
+            metric=metric,
+            criteria=criteria,
+            k=k,
+            rounds=rounds,
+            model=model,
+            prompt_model=prompt_model,
+            judge_model=judge_model,
+            api_key=api_key,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            concurrency=concurrency,
+            cache=cache,
+            priority=priority,
+            **kwargs,
+        )
+    )
@@ -0,0 +1,304 @@
+import os
+import time
+import asyncio
+import weakref
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from anthropic import (
+    Anthropic,
+    AsyncAnthropic,
+    APIConnectionError,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+)
+
+# Client pooling across several API keys and/or base URLs (e.g. local proxies or gateways). Once `configure`d, every
+# request made by `gen_msg`/`agen_msg`/`astream` (and so every helper built on them) without an explicit `api_key`
+# leases an endpoint from the pool:
+#   - "least_outstanding" picks the endpoint with the fewest requests in flight (per unit of `weight`);
+#     "tokens" picks the one with the most rate-limit headroom left, minus what is already in flight
+#   - headroom is read from the `anthropic-ratelimit-*` response headers of every response, via an HTTP event hook
+#   - a 429 rests the endpoint until its `retry-after`; `eject_after` consecutive failures (connection errors, 5xx)
+#     eject it for `cooldown` seconds
+# Nothing changes (and one client per key is used, as before) until `configure` is called.
+
+Strategy = Literal["least_outstanding", "tokens"]
+
+_RETRYABLE_STATUS = {500, 502, 503, 504, 529}
+
+# Errors meaning the connection dropped. The SDK raises `APIConnectionError` for most, but a body cut off mid-stream
+# can surface as the HTTP library's own transport error.
+_DISCONNECTS: Tuple[type, ...] = (APIConnectionError,)
+try:
+    import httpx
+
+    _DISCONNECTS += (httpx.TransportError,)
+except ImportError:
+    pass
+
+
+@dataclass
+class Endpoint:
+    """One API key + base URL in a `ClientPool`, with its live load and health."""
+
+    api_key: Optional[str] = None
+    base_url: Optional[str] = None
+    weight: float = 1.0
+    name: str = ""
+    outstanding: int = 0
+    reserved: int = 0  # Estimated tokens of the requests in flight.
+    served: int = 0
+    failures: int = 0  # Consecutive.
+    ejected_until: float = 0.0
+    limited_until: float = 0.0
+    requests_remaining: Optional[int] = None
+    tokens_remaining: Optional[int] = None
+    tokens_reset: float = 0.0
+    _client: Optional[Anthropic] = field(default=None, repr=False)
+    _async_clients: (
+        "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncAnthropic]"
+    ) = field(default_factory=weakref.WeakKeyDictionary, repr=False)
+
+    def available_at(self) -> float:
+        return max(self.ejected_until, self.limited_until)
+
+    def headroom(self, now: float) -> float:
+        """Rate-limit tokens left for new requests, or infinity if unknown (no headers yet, or the window has reset)."""
+        if self.tokens_remaining is None or now >= self.tokens_reset:
+            return float("inf")
+        return self.tokens_remaining - self.reserved
+
+
+def _parse_reset(value: Optional[str], now: float) -> float:
+    """Monotonic time of an RFC 3339 `anthropic-ratelimit-*-reset` header. Defaults to one minute from now."""
+    try:
+        reset = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+        return now + max(0.0, reset.timestamp() - time.time())
+    except ValueError:
+        return now + 60.0
+
+
+class ClientPool:
+    """Spreads requests across several API endpoints. See the module comment.
+
+    Args:
+        endpoints (Sequence[Union[str, Dict[str, Any], Endpoint]]): API keys, or dicts of `Endpoint` fields
+            (`api_key`, `base_url`, `weight`, `name`).
+        strategy (Strategy, optional): "least_outstanding" or "tokens". Defaults to "least_outstanding".
+        eject_after (int, optional): Consecutive failures before an endpoint is ejected. Defaults to 3.
+        cooldown (float, optional): Seconds an ejected endpoint is skipped. Defaults to 30.0.
+        **client_kwargs: Passed to every `Anthropic`/`AsyncAnthropic` client (e.g. `max_retries`, `timeout`).
+
+    Notes:
+        - If every endpoint is ejected or rate-limited, the one available soonest is used anyway, so requests never fail
+          just because of the pool.
+        - The SDK's own retries happen within one endpoint; their responses still count towards its health.
+    """
+
+    def __init__(
+        self,
+        endpoints: Sequence[Union[str, Dict[str, Any], Endpoint]],
+        strategy: Strategy = "least_outstanding",
+        eject_after: int = 3,
+        cooldown: float = 30.0,
+        **client_kwargs: Any,
+    ) -> None:
+        if not endpoints:
+            raise ValueError("`ClientPool`: no endpoints given.")
+        self.endpoints: List[Endpoint] = []
+        for i, endpoint in enumerate(endpoints):
+            if isinstance(endpoint, str):
+                endpoint = Endpoint(api_key=endpoint)
+            elif isinstance(endpoint, dict):
+                endpoint = Endpoint(**endpoint)
+            endpoint.name = endpoint.name or f"endpoint-{i}"
+            self.endpoints.append(endpoint)
+        self.strategy: Strategy = strategy
+        self.eject_after: int = eject_after
+        self.cooldown: float = cooldown
+        self.client_kwargs: Dict[str, Any] = client_kwargs
+        self._lock = threading.Lock()
+
+    def _key(self, endpoint: Endpoint, now: float) -> Any:
+        load: float = endpoint.outstanding / endpoint.weight
+        # NOTE: Ties go to the endpoint that has served least, so sequential calls are spread round-robin.
+        served: float = endpoint.served / endpoint.weight
+        if self.strategy == "tokens":
+            return (-endpoint.headroom(now) / endpoint.weight, load, served)
+        return (load, -endpoint.headroom(now), served)
+
+    def pick(self) -> Endpoint:
+        """The endpoint the next request should use (without leasing it)."""
+        now: float = time.monotonic()
+        healthy: List[Endpoint] = [e for e in self.endpoints if e.available_at() <= now]
+        if not healthy:
+            return min(self.endpoints, key=Endpoint.available_at)
+        return min(healthy, key=lambda e: self._key(e, now))
+
+    @contextmanager
+    def lease(self, cost: int = 0) -> Iterator[Endpoint]:
+        """Pick an endpoint and count a request of about `cost` tokens against it until the block exits.
+
+        Connection errors raised inside the block count as failures of the endpoint (error responses are counted as
+        they arrive, by `observe`).
+        """
+        with self._lock:
+            endpoint: Endpoint = self.pick()
+            endpoint.outstanding += 1
+            endpoint.reserved += cost
+            endpoint.served += 1
+        try:
+            yield endpoint
+        except _DISCONNECTS:
+            self._failure(endpoint)
+            raise
+        finally:
+            with self._lock:
+                endpoint.outstanding -= 1
+                endpoint.reserved -= cost
+
+    def _failure(self, endpoint: Endpoint) -> None:
+        with self._lock:
+            endpoint.failures += 1
+            if endpoint.failures >= self.eject_after:
+                endpoint.ejected_until = time.monotonic() + self.cooldown
+                endpoint.failures = 0
+
+    def observe(self, endpoint: Endpoint, status_code: int, headers: Any) -> None:
+        """Update `endpoint`'s health and rate-limit headroom from one HTTP response."""
+        now: float = time.monotonic()
+        if status_code in _RETRYABLE_STATUS:
+            self._failure(endpoint)
+            return
+        with self._lock:
+            if status_code < 400:
+                endpoint.failures = 0
+            if status_code == 429:
+                try:
+                    wait: float = float(headers.get("retry-after", 1))
+                except ValueError:
+                    wait = 1.0
+                endpoint.limited_until = now + wait
+            if headers.get("anthropic-ratelimit-requests-remaining") is not None:
+                endpoint.requests_remaining = int(
+                    headers["anthropic-ratelimit-requests-remaining"]
+                )
+            # NOTE: Newer keys report input and output tokens separately; input tokens are the usual bottleneck.
+            for prefix in ("tokens", "input-tokens"):
+                if headers.get(f"anthropic-ratelimit-{prefix}-remaining") is not None:
+                    endpoint.tokens_remaining = int(
+                        headers[f"anthropic-ratelimit-{prefix}-remaining"]
+                    )
+                    endpoint.tokens_reset = _parse_reset(
+                        headers.get(f"anthropic-ratelimit-{prefix}-reset"), now
+                    )
+                    break
+
+    def client(self, endpoint: Endpoint) -> Anthropic:
+        """The (cached) `Anthropic` client for `endpoint`."""
+        if endpoint._client is None:
+
+            def hook(response: Any) -> None:
+                self.observe(endpoint, response.status_code, response.headers)
+
+            endpoint._client = Anthropic(
+                api_key=endpoint.api_key or os.environ.get("ANTHROPIC_API_KEY"),
+                base_url=endpoint.base_url,
+                http_client=DefaultHttpxClient(event_hooks={"response": [hook]}),
+                **self.client_kwargs,
+            )
+        return endpoint._client
+
+    def async_client(self, endpoint: Endpoint) -> AsyncAnthropic:
+        """The (cached) `AsyncAnthropic` client for `endpoint` on the running event loop."""
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        if loop not in endpoint._async_clients:
+
+            async def hook(response: Any) -> None:
+                self.observe(endpoint, response.status_code, response.headers)
+
+            endpoint._async_clients[loop] = AsyncAnthropic(
+                api_key=endpoint.api_key or os.environ.get("ANTHROPIC_API_KEY"),
+                base_url=endpoint.base_url,
+                http_client=DefaultAsyncHttpxClient(event_hooks={"response": [hook]}),
+                **self.client_kwargs,
+            )
+        return endpoint._async_clients[loop]
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """A snapshot of every endpoint's load and health."""
+        now: float = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "name": e.name,
+                    "outstanding": e.outstanding,
+                    "served": e.served,
+                    "healthy": e.available_at() <= now,
+                    "requests_remaining": e.requests_remaining,
+                    "tokens_remaining": e.tokens_remaining,
+                }
+                for e in self.endpoints
+            ]
+
+
+_POOL: Optional[ClientPool] = None
+
+
+def configure(
+    endpoints: Sequence[Union[str, Dict[str, Any], Endpoint]],
+    strategy: Strategy = "least_outstanding",
+    eject_after: int = 3,
+    cooldown: float = 30.0,
+    **client_kwargs: Any,
+) -> ClientPool:
+    """Install a `ClientPool` under `gen_msg`/`agen_msg`/`astream` (replacing any previous one) and return it.
+
+    Example:
+        >>> alana.pool.configure([os.environ["KEY_A"], {"api_key": os.environ["KEY_B"], "base_url": "http://localhost:8080"}])
+        >>> gen("Hi!")  # Served by whichever endpoint has the fewest requests in flight.
+    """
+    global _POOL
+    _POOL = ClientPool(
+        endpoints=endpoints,
+        strategy=strategy,
+        eject_after=eject_after,
+        cooldown=cooldown,
+        **client_kwargs,
+    )
+    return _POOL
+
+
+def get_pool() -> Optional[ClientPool]:
+    """Return the installed `ClientPool`, or None."""
+    return _POOL
+
+
+def disable() -> None:
+    """Remove the installed `ClientPool`."""
+    global _POOL
+    _POOL = None
+
+
+@contextmanager
+def lease(api_key: Optional[str] = None, cost: int = 0) -> Iterator[Optional[Endpoint]]:
+    """`ClientPool.lease` on the installed pool, or None if there is no pool or an explicit `api_key` was passed."""
+    if _POOL is None or api_key is not None:
+        yield None
+        return
+    with _POOL.lease(cost=cost) as endpoint:
+        yield endpoint
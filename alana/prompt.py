@@ -1,4 +1,3 @@
-import re
 import os
 from typing import List, Dict, Optional, Union, Literal, Any
 from anthropic import Anthropic
@@ -6,6 +5,15 @@ from anthropic.types import Message, MessageParam
 
 from alana.color import red, yellow
 from alana import globals
+from alana import templates
+from alana import tags
+from alana.cache import SemanticCache, normalize, scope_key
+from alana.stream import TagsClosed
+from alana.examples import ExampleBank
+from alana.dedup import dedup
+from alana import pool
+from alana import scheduler
+from alana.pool import Endpoint
 
 """
 class RequestParams(TypedDict, total=False):
@@ -28,37 +36,39 @@ def get_xml_pattern(tag: str):
     return rf"<{tag}>(.*?)</{tag}>"
 
 
-def get_xml(tag: str, content: str) -> List[str]:
-    """Return contents of <tag/> XML tags."""
-    pattern: str = get_xml_pattern(tag=tag)
-    matches: List[Any] = re.findall(pattern=pattern, string=content, flags=re.DOTALL)
-    return matches
+def get_xml(tag: str, content: str, lenient: bool = False) -> List[str]:
+    """Return contents of <tag/> XML tags.
 
+    Tags may carry attributes (`<example id="3">`), nested same-name tags are paired correctly (the outermost element is
+    returned), and the scan is linear time (see `alana.tags`). With `lenient=True`, an unclosed trailing tag (e.g. from
+    `max_tokens` truncation) returns everything after it.
+    """
+    return tags.extract(tag=tag, text=content, lenient=lenient)
 
-def remove_xml(tag: str = "reasoning", content: str = "", repl: str = "") -> str:
-    """Return a copy of `content` with <tag/> XML elements (both content and tag) replaced with `repl` (default "")."""
-    if tag.count("<") > 0 or tag.count(">") > 0:
-        raise ValueError("No '>' or '<' allowed in get_xml tag name!")
+
+def remove_xml(
+    tag: str = "reasoning", content: str = "", repl: str = "", lenient: bool = False
+) -> str:
+    """Return a copy of `content` with <tag/> XML elements (both content and tag) replaced with `repl` (default "").
+
+    With `lenient=True`, an unclosed trailing tag is removed along with everything after it.
+    """
     if content == "":
         red(
             var="`remove_xml`: Empty string provided as `content`."
         )  # TODO: Improve error logging
-    pattern: str = (
-        rf"<{tag}>.*?</{tag}>"  # NOTE: Removed group matching, so can't use `get_xml_pattern`
-    )
-    output: str = re.sub(pattern=pattern, repl=repl, string=content, flags=re.DOTALL)
-    return output
+    return tags.remove(tag=tag, text=content, repl=repl, lenient=lenient)
 
 
 def respond(
-    content: str,
+    content: Union[str, List[Any]],
     messages: Optional[List[MessageParam]] = None,
     role: Literal["user", "assistant"] = "user",
 ) -> List[MessageParam]:
     """Append a user message to messages list.
 
     Args:
-        content (str): The newest message content.
+        content (Union[str, List[Any]]): The newest message content. Either a string, or a list of content blocks (e.g. `tool_result`s).
         messages (Optional[List[MessageParam]]): A list of `anthropic.types.MessageParam` objects. The last MessageParam should be from assistant. If `messages` is None, we will populate it with exactly one MessageParam based on `user`.
         role (Literal["user", "assistant"]): Corresponding source for the message!
 
@@ -102,25 +112,75 @@ def _construct_messages(
         return messages
 
 
+def _get_text(output: Message) -> str:
+    """Return the concatenated text blocks of `output` (tool_use and other non-text blocks are skipped)."""
+    return "".join(block.text for block in output.content if block.type == "text")
+
+
 def _append_assistant_message(messages, output) -> None:
     if len(output.content) == 0:
         raise ValueError(
             f"Assistant did not provide a response. Stop reason: {output.stop_reason}. Full API response: {output}"
         )
 
+    existing_assistant_content: str = ""
     if (
         messages[-1]["role"] == "assistant"
     ):  # NOTE: Anthropic API does not allow non-alternating roles (raises Err400). Let's enforce this.
-        # NOTE: messages[-1]["content"] is assistant output, so should be `str`, since Anthropic API (as of Apr 16 2024) only supports text output!
-        existing_assistant_content: str = messages[-1]["content"]
-        assistant_content: str = existing_assistant_content + output.content[0].text
+        # NOTE: A trailing assistant message is a prefill, so messages[-1]["content"] should be `str`.
+        existing_assistant_content = messages[-1]["content"]
         messages.pop()
+
+    if all(block.type == "text" for block in output.content):
+        assistant_content: Union[str, List[Dict[str, Any]]] = (
+            existing_assistant_content + _get_text(output)
+        )
     else:
-        assistant_content = output.content[0].text
+        # Tool use! Keep the content blocks, since `tool_result` blocks must refer back to them.
+        assistant_content = [
+            block.model_dump(exclude_none=True) for block in output.content
+        ]
+        if existing_assistant_content:
+            if assistant_content[0]["type"] == "text":
+                assistant_content[0]["text"] = (
+                    existing_assistant_content + assistant_content[0]["text"]
+                )
+            else:
+                assistant_content.insert(
+                    0, {"type": "text", "text": existing_assistant_content}
+                )
 
     respond(content=assistant_content, messages=messages, role="assistant")
 
 
+_CLIENTS: Dict[Optional[str], Anthropic] = {}
+
+
+def _get_client(
+    api_key: Optional[str] = None, endpoint: Optional[Endpoint] = None
+) -> Anthropic:
+    """Return a cached `Anthropic` client for `api_key` (default: os.environ["ANTHROPIC_API_KEY"]), or for a leased `alana.pool` endpoint."""
+    if endpoint is not None:
+        return pool.get_pool().client(endpoint)  # type: ignore
+    if api_key is None:
+        api_key = os.environ.get("ANTHROPIC_API_KEY")
+    if api_key not in _CLIENTS:
+        _CLIENTS[api_key] = Anthropic(
+            api_key=api_key,
+        )
+    return _CLIENTS[api_key]
+
+
+def _get_backend(model: str, caller: str) -> str:
+    """Resolve a model alias (see `globals.MODELS`), falling back to `globals.DEFAULT_MODEL`."""
+    if model in globals.MODELS:
+        return globals.MODELS[model]
+    red(
+        var=f"{caller}() -- Caution! model string not recognized; reverting to {globals.DEFAULT_MODEL=}."
+    )  # TODO: C'mon we can do better error logging than this
+    return globals.MODELS[globals.DEFAULT_MODEL]
+
+
 def gen(
     user: Optional[str] = None,
     system: str = "",
@@ -161,6 +221,7 @@ def gen(
         - The function raises a ValueError if the roles in the `messages` list are not alternating (e.g., user, assistant, user).
         - If `append` is True and the last message in `messages` is from the assistant, the generated response is appended to the existing assistant's content.
         - The function uses the `gen_msg` function internally to generate Claude's response.
+        - If micro-batching is enabled (`alana.batching.enable()`), small single-turn calls may be packed together with other concurrent calls.
 
     Example:
         >>> user_message = "Hello, Claude!"
@@ -169,6 +230,27 @@ def gen(
         "Hello! How can I assist you today?"
     """
 
+    from alana import batching
+
+    if batching.batch_eligible(
+        user=user, messages=messages, max_tokens=max_tokens, kwargs=kwargs
+    ):
+        from alana.loop import run
+
+        text: str = run(
+            batching.batched(
+                user=user,  # type: ignore
+                system=system,
+                model=model,
+                api_key=api_key,
+                max_tokens=max_tokens,
+                temperature=temperature,
+            )
+        )
+        if loud:
+            yellow(var=text)
+        return text
+
     constructed_messages: List[MessageParam] = _construct_messages(
         user_message=user, messages=messages
     )
@@ -184,7 +266,7 @@ def gen(
     )
     if append == True:
         _append_assistant_message(messages=constructed_messages, output=output)
-    return output.content[0].text
+    return _get_text(output)
 
 
 def gen_msg(
@@ -196,6 +278,9 @@ def gen_msg(
     max_tokens=1024,
     temperature=1.0,
     loud=True,
+    use_loop=False,
+    semantic_cache: Optional[SemanticCache] = None,
+    similarity: Optional[float] = None,
     **kwargs: Any,
 ) -> Message:
     """Generate a response from Claude using the Anthropic API.
@@ -209,7 +294,10 @@ def gen_msg(
         max_tokens (int, optional): The maximum number of tokens to generate in the response. Defaults to 1024.
         temperature (float, optional): The temperature value for controlling the randomness of the generated response.
         loud (bool, optional): Whether to print verbose output. Defaults to True.
-        **kwargs: Additional keyword arguments to pass to the Anthropic API.
+        use_loop (bool, optional): Route the request through `agen_msg` on the shared background event loop (see `alana.loop`), so sync and async callers share one connection pool. Defaults to False.
+        semantic_cache (Optional[SemanticCache], optional): Reuse the stored response of a similar earlier prompt (same model, system prompt and settings) from this `alana.cache.SemanticCache`, and store new responses in it. Defaults to None.
+        similarity (Optional[float], optional): Minimum cosine similarity for a `semantic_cache` hit at this call site. Defaults to the cache's `threshold`.
+        **kwargs: Additional keyword arguments to pass to the Anthropic API. A non-empty `stop_when` (client-side stop predicates, see `alana.prompt_async.astream`) overrides `use_loop` to True, as do `priority` and `tenant` when `alana.scheduler` is configured (they are dropped otherwise).
 
     Returns:
         Message: The Message object produced by the Anthropic API, containing the generated response.
@@ -217,7 +305,8 @@ def gen_msg(
     Notes:
         - If the `model` parameter is not recognized, the function reverts to using the default model specified in `globals.DEFAULT_MODEL`.
         - If `api_key` is None, the function attempts to retrieve the API key from the environment variable "ANTHROPIC_API_KEY".
-        - The function creates an instance of the Anthropic client using the provided `api_key`.
+        - Clients are created once per `api_key` and reused, so repeated calls share a connection pool.
+        - If a client pool is configured (`alana.pool.configure([...])`) and no `api_key` is passed, the request goes to the pool's least loaded healthy endpoint.
         - Stream not supported yet! If the `stream` keyword argument is provided, the function disables streaming and sets `stream` to False. (TODO: Support stream)
         - The function uses the `messages.create` method of the Anthropic client to generate Claude's response.
         - If `loud` is True, the generated message is printed using the `yellow` function for verbose output.
@@ -234,35 +323,76 @@ def gen_msg(
         user_message=user, messages=messages
     )
 
-    backend: str = globals.MODELS[globals.DEFAULT_MODEL]
-    if model in globals.MODELS:
-        backend = globals.MODELS[model]
-    else:
-        red(
-            var=f"gen() -- Caution! model string not recognized; reverting to {globals.DEFAULT_MODEL=}."
-        )  # TODO: C'mon we can do better error logging than this
-
-    if api_key is None:
-        api_key = os.environ.get("ANTHROPIC_API_KEY")
-    client = Anthropic(
-        api_key=api_key,
-    )
+    backend: str = _get_backend(model=model, caller="gen")
 
     if "stream" in kwargs:
         red(var="Streaming not supported! Disabling...")
         kwargs["stream"] = False
-
-    message: Message = client.messages.create(  # TODO: Enable streaming support
-        max_tokens=max_tokens,
-        messages=constructed_messages,
-        system=system,
-        model=backend,
-        temperature=temperature,
-        **kwargs,
-    )
-    if loud:
-        yellow(var=message)
-
+    if kwargs.get("stop_when"):
+        # NOTE: Stop predicates need the stream, which only the async path has.
+        use_loop = True
+    # NOTE: `priority` and `tenant` are not API arguments. The scheduler is async, so scheduled calls take the loop.
+    scheduling: Dict[str, Any] = {
+        k: kwargs.pop(k) for k in ("priority", "tenant") if k in kwargs
+    }
+    if scheduling and scheduler.get_scheduler() is not None:
+        use_loop = True
+
+    if semantic_cache is not None:
+        prompt_text: str = normalize(constructed_messages)
+        scope: str = scope_key(
+            system=system,
+            model=backend,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            **kwargs,
+        )
+        cached: Optional[str] = semantic_cache.get(
+            prompt_text, scope=scope, threshold=similarity
+        )
+        if cached is not None:
+            message = Message.model_validate_json(cached)
+            if loud:
+                yellow(var=message)
+            return message
+
+    if use_loop:
+        from alana.loop import run
+        from alana.prompt_async import agen_msg
+
+        message = run(
+            agen_msg(
+                messages=constructed_messages,
+                system=system,
+                model=model,
+                api_key=api_key,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream_action=None,
+                loud=loud,
+                **scheduling,
+                **kwargs,
+            )
+        )
+    else:
+        with pool.lease(
+            api_key=api_key,
+            cost=scheduler.estimate_tokens(constructed_messages, system, max_tokens),
+        ) as endpoint:
+            client: Anthropic = _get_client(api_key=api_key, endpoint=endpoint)
+            message = client.messages.create(  # TODO: Enable streaming support
+                max_tokens=max_tokens,
+                messages=constructed_messages,
+                system=system,
+                model=backend,
+                temperature=temperature,
+                **kwargs,
+            )
+        if loud:
+            yellow(var=message)
+
+    if semantic_cache is not None:
+        semantic_cache.put(prompt_text, message.model_dump_json(), scope=scope)
     return message
 
 
@@ -273,6 +403,9 @@ def gen_examples_list(
     api_key: Optional[str] = None,
     max_tokens: int = 1024,
     temperature=1.0,
+    bank: Optional[ExampleBank] = None,
+    min_coverage: float = 0.8,
+    dedup_threshold: Optional[float] = None,
     **kwargs: Any,
 ) -> List[str]:
     """Uses Claude to generate a Python list of few-shot examples for a given natural language instruction.
@@ -284,6 +417,9 @@ def gen_examples_list(
         api_key (Optional[str], optional): The API key to use for authentication. Defaults to None.
         max_tokens (int, optional): The maximum number of tokens to generate in the response. Defaults to 1024.
         temperature (float, optional): The temperature value for controlling the randomness of the generated response.
+        bank (Optional[ExampleBank], optional): An `alana.examples.ExampleBank` to serve stored examples from, and to store new ones in. Defaults to None.
+        min_coverage (float, optional): With a `bank`, stored examples are only used if `n_examples` of them match at least this share of the instruction's terms (IDF-weighted). Defaults to 0.8.
+        dedup_threshold (Optional[float], optional): If given, drop near-duplicate examples (estimated Jaccard similarity of word shingles at or above this) with `alana.dedup.dedup`. Defaults to None.
         **kwargs: Additional keyword arguments to pass to the `gen` function (`gen` passes kwargs to the Anthropic API).
 
     Returns:
@@ -296,6 +432,9 @@ def gen_examples_list(
         - The function calls the `gen` function to generate the model's output based on the constructed system and user messages, along with the specified `model`, `api_key`, `max_tokens`, `temperature`, and any additional keyword arguments.
         - The generated model output is expected to be in XML format, with each example enclosed in `<example/>` tags.
         - The function uses the `get_xml` function to extract the content within the `<example/>` tags and returns it as a Python list of strings.
+        - Generation stops as soon as `n_examples` `<example/>` tags are closed (pass your own `stop_when` to override).
+          Stop predicates need the stream, so the call goes through the async streaming path on the shared background
+          event loop (see `alana.loop`), as with `gen_msg(..., use_loop=True)`. Pass `stop_when=[]` to use a plain request.
 
     Example:
         >>> instruction = "Write a short story about a magical adventure."
@@ -307,10 +446,19 @@ def gen_examples_list(
             "Deep in the enchanted forest, a group of talking animals gathered around a wise old oak tree to discuss a pressing matter..."
         ]
     """
-    system: str = globals.SYSTEM["few_shot"].format(n_examples=n_examples)
-    user: str = globals.USER["few_shot"].format(instruction=instruction)
+    if bank is not None:
+        stored: Optional[List[str]] = bank.examples(
+            instruction, k=n_examples, min_coverage=min_coverage
+        )
+        if stored is not None:
+            return stored
+    system: str = templates.builtin("system", "few_shot").render(n_examples=n_examples)
+    user: str = templates.builtin("user", "few_shot").render(instruction=instruction)
     if n_examples < 1:
         red(var="Too few examples requested! Trying anyway...")
+    else:
+        # NOTE: Stop once the last example is closed, instead of paying for whatever the model writes after it.
+        kwargs.setdefault("stop_when", [TagsClosed("example", n=n_examples)])
 
     model_output: str = gen(
         user=user,
@@ -321,7 +469,12 @@ def gen_examples_list(
         temperature=temperature,
         **kwargs,
     )
-    return get_xml(tag="example", content=model_output)
+    examples: List[str] = get_xml(tag="example", content=model_output)
+    if dedup_threshold is not None:
+        examples = dedup(examples, threshold=dedup_threshold)
+    if bank is not None:
+        bank.add(instruction, examples)
+    return examples
 
 
 def gen_examples(
@@ -387,7 +540,7 @@ def gen_prompt(
     max_tokens: int = 1024,
     temperature=1.0,
     **kwargs: Any,
-) -> Dict[Literal["system", "user", "full"], Union[str, List]]:
+) -> Dict[Literal["system", "user", "full", "template"], Any]:
     """Meta-prompter! Generate a prompt given an arbitrary instruction.
 
     Args:
@@ -400,10 +553,12 @@ def gen_prompt(
         **kwargs: Additional keyword arguments to pass to the `gen` function.
 
     Returns:
-        Dict[Literal["system", "user", "full"], Union[str, List]]: A dictionary containing the generated prompts.
+        Dict[Literal["system", "user", "full", "template"], Any]: A dictionary containing the generated prompts.
             - "system" (Union[str, List[str]]): The generated system prompt(s).
             - "user" (Union[str, List[str]]): The generated user prompt(s).
             - "full" (str): The full generated output, including both system and user prompts.
+            - "template" (Optional[templates.Template]): The user prompt compiled with `{input_data}` as its only variable, so
+              other braces in it are left alone. Fill it with `prompts["template"].render(input_data=...)`. None if there were several user prompts.
 
     Notes:
         - The function constructs a meta-system prompt using the `globals.SYSTEM["gen_prompt"]` template.
@@ -429,8 +584,10 @@ def gen_prompt(
         Write a story about a robot learning to love.
         </user_prompt>
     """
-    meta_system_prompt: str = globals.SYSTEM["gen_prompt"]
-    meta_prompt: str = globals.USER["gen_prompt"].format(instruction=instruction)
+    meta_system_prompt: str = templates.builtin("system", "gen_prompt").render()
+    meta_prompt: str = templates.builtin("user", "gen_prompt").render(
+        instruction=instruction
+    )
 
     if messages is not None:
         yellow(
@@ -467,7 +624,16 @@ def gen_prompt(
         len(user_prompt) == 1
     ):  # TODO: Find a saner way to handle this. E.g. delegate to a formatter model.
         user_prompt = user_prompt[0]
-    return {"system": system_prompt, "user": user_prompt, "full": full_output}
+    return {
+        "system": system_prompt,
+        "user": user_prompt,
+        "full": full_output,
+        "template": (
+            templates.Template(user_prompt, variables=["input_data"])
+            if isinstance(user_prompt, str)
+            else None
+        ),
+    }
 
 
 def pretty_print(
@@ -510,8 +676,8 @@ def pretty_print(
             "city": "New York"
         }
     """
-    system = globals.SYSTEM["pretty_print"]
-    user = globals.USER["pretty_print"].format(var=f"{var}")
+    system = templates.builtin("system", "pretty_print").render()
+    user = templates.builtin("user", "pretty_print").render(var=f"{var}")
 
     string: str = gen(
         user=user, system=system, model=model, loud=False, **kwargs
@@ -1,18 +1,91 @@
 from anthropic import AsyncAnthropic
 import os
+import asyncio
+import weakref
 from alana import yellow, red
 from alana import globals
-from alana.prompt import get_xml, _append_assistant_message, _construct_messages
-from typing import List, Dict, Literal, Union, Optional, Callable, Any
-from anthropic.types import Message, MessageParam
-
-client = AsyncAnthropic(
-    # This is the default and can be omitted
-    api_key=os.environ.get("ANTHROPIC_API_KEY"),
+from alana import templates
+from alana.prompt import (
+    get_xml,
+    _append_assistant_message,
+    _construct_messages,
+    _get_backend,
+    _get_text,
+)
+from alana.stream import StopPredicate, StreamEvent, TagsClosed
+from alana import batching
+from alana import scheduler
+from alana import pool
+from alana.pool import Endpoint, _DISCONNECTS
+from alana.examples import ExampleBank
+from alana.dedup import dedup
+from typing import (
+    List,
+    Dict,
+    Literal,
+    Union,
+    Optional,
+    Callable,
+    Any,
+    AsyncIterator,
+    Sequence,
 )
+from anthropic.types import Message, MessageParam, TextBlock, Usage
 
+# NOTE: An AsyncAnthropic client's connection pool is bound to the event loop it is used on, so cache one per loop.
+_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Optional[str], AsyncAnthropic]]" = (weakref.WeakKeyDictionary())
 
-async def agen_msg(
+
+def _get_async_client(
+    api_key: Optional[str] = None, endpoint: Optional[Endpoint] = None
+) -> AsyncAnthropic:
+    """Return a cached `AsyncAnthropic` client for `api_key`, or for a leased `alana.pool` endpoint, on the running event loop."""
+    if endpoint is not None:
+        return pool.get_pool().async_client(endpoint)  # type: ignore
+    if api_key is None:
+        api_key = os.environ.get("ANTHROPIC_API_KEY")
+    clients = _CLIENTS.setdefault(asyncio.get_running_loop(), {})
+    if api_key not in clients:
+        clients[api_key] = AsyncAnthropic(
+            api_key=api_key,
+        )
+    return clients[api_key]
+
+
+def _with_prefill(
+    messages: List[MessageParam], prefill: Optional[Any]
+) -> List[MessageParam]:
+    if prefill is None:
+        return messages
+    return messages + [MessageParam(role="assistant", content=prefill)]
+
+
+def _merge_legs(
+    message: Message, before: str, dropped: int, legs: List[Usage]
+) -> Message:
+    """The final `Message` of a resumed stream: the text of every leg, and the usage of all of them.
+
+    `before` is the text yielded before the last leg, and `dropped` the whitespace the last leg repeated (and that was skipped).
+    """
+    content: List[Any] = list(message.content)
+    if content and content[0].type == "text":
+        content[0] = content[0].model_copy(
+            update={"text": before + content[0].text[dropped:]}
+        )
+    else:
+        content.insert(0, TextBlock(type="text", text=before))
+    usage: Usage = message.usage.model_copy(
+        update={
+            "input_tokens": message.usage.input_tokens
+            + sum(leg.input_tokens for leg in legs),
+            "output_tokens": message.usage.output_tokens
+            + sum(leg.output_tokens for leg in legs),
+        }
+    )
+    return message.model_copy(update={"content": content, "usage": usage})
+
+
+async def astream(
     messages: Optional[List[MessageParam]] = None,
     user: Optional[str] = None,
     system: str = "",
@@ -20,54 +93,246 @@ async def agen_msg(
     api_key: Optional[str] = None,
     max_tokens=1024,
     temperature=1.0,
-    stream_action: Optional[Callable] = lambda x: print(x, end="", flush=True),
-    loud=False,
+    stop_when: Optional[Sequence[StopPredicate]] = None,
+    resume: int = 2,
     **kwargs: Any,
-):
-    """Experimental. Async version of gen_msg. Invoke with `asyncio.run(agen_msg)`"""
+) -> AsyncIterator[StreamEvent]:
+    """Experimental. Stream a response from Claude as typed `alana.stream.StreamEvent`s.
+
+    Args:
+        messages (List[MessageParam], optional): A list of `anthropic.types.MessageParam`s representing the conversation history.
+        user (str, optional): Instead of passing a `messages`, you can pass in a single user prompt.
+        system (str, optional): The system message to set the context for Claude. Defaults to "".
+        model (str, optional): The name of the model to use. Defaults to globals.DEFAULT_MODEL.
+        api_key (Optional[str], optional): The API key to use for authentication. Defaults to None.
+        max_tokens (int, optional): The maximum number of tokens to generate in the response. Defaults to 1024.
+        temperature (float, optional): The temperature value for controlling the randomness of the generated response.
+        stop_when (Optional[Sequence[StopPredicate]], optional): Client-side stop predicates (see `alana.stream.TagsClosed`
+            and `alana.stream.Matches`), called with the text so far after each text delta. As soon as one returns True the
+            stream is closed, so no more output tokens are generated. Use fresh predicates for each call. Defaults to None.
+        resume (int, optional): How many times to resume after the connection drops mid-stream. Defaults to 2. 0 disables.
+        **kwargs: Additional keyword arguments to pass to the Anthropic API. `priority` and `tenant` are used by `alana.scheduler` instead.
+
+    Yields:
+        StreamEvent: "message_start", then "text"/"input_json"/"tool_use" events as content arrives, "usage" and
+        "stop_reason" updates, and finally "message_stop" carrying the final `Message`.
+
+    Notes:
+        - This is an async generator, so backpressure is free: nothing more is read from the network until you ask for the next event.
+        - Breaking out of the loop closes the underlying HTTP stream.
+        - To hand one stream to several consumers, wrap it in `alana.stream.Fanout`.
+        - If a scheduler is configured (`alana.scheduler.configure()`), the request waits for a slot first and holds it until the stream ends.
+        - A stream stopped by `stop_when` ends with a "stop_reason" event of "stop_sequence", and its final `Message` is the
+          snapshot so far. Its `usage.output_tokens` is an estimate, since the API only reports usage at the end.
+        - If the connection drops (`APIConnectionError` or an `httpx.TransportError`), the stream is resumed by sending the
+          text so far as an assistant prefill, and continues where it stopped: one "message_start", no repeated text, and a
+          final `Message` holding all the text with usage summed over every leg (interrupted legs' output is estimated).
+          Streams that have started a tool call are not resumed.
+
+    Example:
+        >>> async for event in astream(user="Hello, Claude!"):
+        ...     if event.type == "text":
+        ...         print(event.text, end="")
+    """
     constructed_messages: List[MessageParam] = _construct_messages(
         user_message=user, messages=messages
     )
+    backend: str = _get_backend(model=model, caller="astream")
+    priority: str = kwargs.pop("priority", "interactive")
+    tenant: str = kwargs.pop("tenant", "default")
+
+    prefill: Optional[str] = None
+    if constructed_messages and constructed_messages[-1]["role"] == "assistant":
+        prefill = constructed_messages[-1]["content"]  # type: ignore
+        constructed_messages = constructed_messages[:-1]
+
+    text: str = ""  # Everything yielded so far, across legs.
+    before: str = ""  # What was yielded before the current leg.
+    legs: List[Usage] = []  # Usage of interrupted legs.
+    leg_messages: List[MessageParam] = _with_prefill(constructed_messages, prefill)
+    async with scheduler.slot(
+        priority=priority,
+        tenant=tenant,
+        cost=scheduler.estimate_tokens(constructed_messages, system, max_tokens),
+    ) as ticket:
+        while True:
+            leg_usage: Optional[Usage] = None
+            # Whitespace stripped from the resume prefill (it was already yielded), and how much of it the
+            # continuation repeated and was dropped.
+            skip: str = text[len(text.rstrip()) :] if legs else ""
+            dropped: int = 0
+            resumable: bool = isinstance(prefill, (str, type(None)))
+            try:
+                # NOTE: Each leg leases its own endpoint, so a resumed stream can move off an endpoint that dropped it.
+                with pool.lease(
+                    api_key=api_key,
+                    cost=scheduler.estimate_tokens(leg_messages, system, max_tokens),
+                ) as endpoint:
+                    client: AsyncAnthropic = _get_async_client(
+                        api_key=api_key, endpoint=endpoint
+                    )
+                    async with client.messages.stream(
+                        max_tokens=max(
+                            1, max_tokens - sum(usage.output_tokens for usage in legs)
+                        ),
+                        messages=leg_messages,
+                        system=system,
+                        model=backend,
+                        temperature=temperature,
+                        **kwargs,
+                    ) as s:
+                        stopped: bool = False
+                        async for event in s:
+                            if event.type == "message_start":
+                                leg_usage = event.message.usage
+                                if not legs:
+                                    yield StreamEvent(
+                                        type="message_start", message=event.message
+                                    )
+                            elif event.type == "content_block_delta":
+                                if event.delta.type == "text_delta":
+                                    delta: str = event.delta.text
+                                    if skip:
+                                        n: int = len(delta) - len(delta.lstrip())
+                                        n = min(n, len(skip))
+                                        delta, dropped = delta[n:], dropped + n
+                                        skip = skip[n:] if n and not delta else ""
+                                    if not delta:
+                                        continue
+                                    text += delta
+                                    yield StreamEvent(
+                                        type="text", text=delta, index=event.index
+                                    )
+                                    if stop_when and any(
+                                        predicate(text) for predicate in stop_when
+                                    ):
+                                        stopped = True
+                                        break
+                                elif event.delta.type == "input_json_delta":
+                                    resumable = False
+                                    yield StreamEvent(
+                                        type="input_json",
+                                        text=event.delta.partial_json,
+                                        index=event.index,
+                                    )
+                            elif event.type == "content_block_stop":
+                                block = s.current_message_snapshot.content[event.index]
+                                if block.type == "tool_use":
+                                    yield StreamEvent(
+                                        type="tool_use", block=block, index=event.index
+                                    )
+                            elif event.type == "message_delta":
+                                yield StreamEvent(type="usage", usage=event.usage)
+                                if event.delta.stop_reason is not None:
+                                    yield StreamEvent(
+                                        type="stop_reason",
+                                        stop_reason=event.delta.stop_reason,
+                                    )
+                        if stopped:
+                            # NOTE: Leaving the `async with` closes the HTTP stream, which stops generation server-side.
+                            message: Message = s.current_message_snapshot.model_copy(
+                                update={"stop_reason": "stop_sequence"}
+                            )
+                            message.usage = message.usage.model_copy(
+                                update={
+                                    "output_tokens": max(
+                                        message.usage.output_tokens,
+                                        len(text[len(before) :]) // 4,
+                                    )
+                                }
+                            )
+                        else:
+                            message = await s.get_final_message()
+                break
+            except _DISCONNECTS as e:
+                if len(legs) >= resume or not resumable:
+                    raise
+                red(
+                    var=f"`astream`: connection lost ({type(e).__name__}); resuming after {len(text)} characters."
+                )
+                # NOTE: The API has no usage for a leg cut short, so estimate its output from the text received.
+                legs.append(
+                    Usage(
+                        input_tokens=leg_usage.input_tokens if leg_usage else 0,
+                        output_tokens=max(
+                            leg_usage.output_tokens if leg_usage else 0,
+                            len(text[len(before) :]) // 4,
+                        ),
+                    )
+                )
+                before = text
+                # NOTE: The API rejects a final assistant turn that ends in whitespace, so the prefill is stripped.
+                leg_messages = _with_prefill(
+                    constructed_messages, ((prefill or "") + text).rstrip() or None
+                )
+        if legs:
+            message = _merge_legs(message, before, dropped, legs)
+        ticket.tokens = message.usage.input_tokens + message.usage.output_tokens
+    if stopped:
+        yield StreamEvent(type="stop_reason", stop_reason="stop_sequence")
+    yield StreamEvent(type="message_stop", message=message)
 
-    backend: str = globals.MODELS[globals.DEFAULT_MODEL]
-    if model in globals.MODELS:
-        backend = globals.MODELS[model]
-    else:
-        red(
-            var=f"agen_msg() -- Caution! model string not recognized; reverting to {globals.DEFAULT_MODEL=}."
-        )  # TODO: C'mon we can do better error logging than this
 
-    if (
-        api_key is None
-    ):  # TODO: Factor out the auth stuff into a helper fn., for both gen_msg and async_gen_msg
-        api_key = os.environ.get("ANTHROPIC_API_KEY")
-    client = AsyncAnthropic(
-        api_key=api_key,
-    )
+async def agen_msg(
+    messages: Optional[List[MessageParam]] = None,
+    user: Optional[str] = None,
+    system: str = "",
+    model: str = globals.DEFAULT_MODEL,
+    api_key: Optional[str] = None,
+    max_tokens=1024,
+    temperature=1.0,
+    stream_action: Optional[Callable] = lambda x: print(x, end="", flush=True),
+    loud=False,
+    **kwargs: Any,
+):
+    """Experimental. Async version of gen_msg. Invoke with `await`, or from sync code (including Jupyter) with `alana.run(agen_msg(...))`
 
-    if not stream_action:
-        message: Message = (
-            await client.messages.create(  # TODO: Enable streaming support
-                max_tokens=max_tokens,
-                messages=constructed_messages,
-                system=system,
-                model=backend,
-                temperature=temperature,
-                **kwargs,
-            )
+    If `stream_action` is set, the response is streamed via `astream` and `stream_action` is called on each text delta.
+    Pass `priority` ("interactive", "batch" or "background") and `tenant` to be scheduled by `alana.scheduler`.
+    Pass `stop_when` (see `astream`) to stop generating as soon as a stop predicate is satisfied; this always streams.
+    Streamed responses survive dropped connections (see `resume` in `astream`).
+    """
+    if not stream_action and not kwargs.get("stop_when"):
+        constructed_messages: List[MessageParam] = _construct_messages(
+            user_message=user, messages=messages
         )
+        backend: str = _get_backend(model=model, caller="agen_msg")
+        priority: str = kwargs.pop("priority", "interactive")
+        tenant: str = kwargs.pop("tenant", "default")
+        kwargs.pop("resume", None)  # NOTE: Only streams are resumed (see `astream`).
+        cost: int = scheduler.estimate_tokens(constructed_messages, system, max_tokens)
+        async with scheduler.slot(
+            priority=priority, tenant=tenant, cost=cost
+        ) as ticket:
+            with pool.lease(api_key=api_key, cost=cost) as endpoint:
+                client: AsyncAnthropic = _get_async_client(
+                    api_key=api_key, endpoint=endpoint
+                )
+                message: Message = await client.messages.create(
+                    max_tokens=max_tokens,
+                    messages=constructed_messages,
+                    system=system,
+                    model=backend,
+                    temperature=temperature,
+                    **kwargs,
+                )
+            ticket.tokens = message.usage.input_tokens + message.usage.output_tokens
     else:
-        async with client.messages.stream(
-            max_tokens=max_tokens,
-            messages=constructed_messages,
+        async for event in astream(
+            messages=messages,
+            user=user,
             system=system,
-            model=backend,
+            model=model,
+            api_key=api_key,
+            max_tokens=max_tokens,
             temperature=temperature,
             **kwargs,
-        ) as s:
-            async for text in s.text_stream:
-                stream_action(text)
-        message = await s.get_final_message()
+        ):
+            if event.type == "text":
+                if stream_action:
+                    stream_action(event.text)
+            elif event.type == "message_stop":
+                message = event.message  # type: ignore
 
     if loud:
         yellow(message)
@@ -88,7 +353,26 @@ async def agen(
     loud=False,
     **kwargs: Any,
 ) -> str:
-    """Experimental. Async version of gen. Invoke with `asyncio.run(agen)`"""
+    """Experimental. Async version of gen. Invoke with `await`, or from sync code (including Jupyter) with `alana.run(agen(...))`
+
+    If micro-batching is enabled (`alana.batching.enable()`), small single-turn calls may be packed together with other
+    concurrent calls. `stream_action` then receives the whole answer at once.
+    """
+    if batching.batch_eligible(
+        user=user, messages=messages, max_tokens=max_tokens, kwargs=kwargs
+    ):
+        text: str = await batching.batched(
+            user=user,  # type: ignore
+            system=system,
+            model=model,
+            api_key=api_key,
+            max_tokens=max_tokens,
+            temperature=temperature,
+        )
+        if stream_action:
+            stream_action(text)
+        return text
+
     constructed_messages: List[MessageParam] = _construct_messages(
         user_message=user, messages=messages
     )
@@ -105,7 +389,7 @@ async def agen(
     )
     if append == True:
         _append_assistant_message(messages=constructed_messages, output=output)
-    return output.content[0].text
+    return _get_text(output)
 
 
 async def agen_examples_list(
@@ -115,6 +399,9 @@ async def agen_examples_list(
     api_key: Optional[str] = None,
     max_tokens: int = 1024,
     temperature=1.0,
+    bank: Optional[ExampleBank] = None,
+    min_coverage: float = 0.8,
+    dedup_threshold: Optional[float] = None,
     **kwargs: Any,
 ) -> List[str]:
     """Uses Claude to generate a Python list of few-shot examples for a given natural language instruction.
@@ -126,6 +413,9 @@ async def agen_examples_list(
         api_key (Optional[str], optional): The API key to use for authentication. Defaults to None.
         max_tokens (int, optional): The maximum number of tokens to generate in the response. Defaults to 1024.
         temperature (float, optional): The temperature value for controlling the randomness of the generated response.
+        bank (Optional[ExampleBank], optional): An `alana.examples.ExampleBank` to serve stored examples from, and to store new ones in. Defaults to None.
+        min_coverage (float, optional): With a `bank`, stored examples are only used if `n_examples` of them match at least this share of the instruction's terms (IDF-weighted). Defaults to 0.8.
+        dedup_threshold (Optional[float], optional): If given, drop near-duplicate examples (estimated Jaccard similarity of word shingles at or above this) with `alana.dedup.dedup`. Defaults to None.
         **kwargs: Additional keyword arguments to pass to the `gen` function (`gen` passes kwargs to the Anthropic API).
 
     Returns:
@@ -138,6 +428,8 @@ async def agen_examples_list(
         - The function calls the `gen` function to generate the model's output based on the constructed system and user messages, along with the specified `model`, `api_key`, `max_tokens`, `temperature`, and any additional keyword arguments.
         - The generated model output is expected to be in XML format, with each example enclosed in `<example/>` tags.
         - The function uses the `get_xml` function to extract the content within the `<example/>` tags and returns it as a Python list of strings.
+        - Generation stops as soon as `n_examples` `<example/>` tags are closed (pass your own `stop_when` to override).
+          This always streams (see `agen_msg`). Pass `stop_when=[]` to use a plain request.
 
     Example:
         >>> instruction = "Write a short story about a magical adventure."
@@ -149,10 +441,19 @@ async def agen_examples_list(
             "Deep in the enchanted forest, a group of talking animals gathered around a wise old oak tree to discuss a pressing matter..."
         ]
     """
-    system: str = globals.SYSTEM["few_shot"].format(n_examples=n_examples)
-    user: str = globals.USER["few_shot"].format(instruction=instruction)
+    if bank is not None:
+        stored: Optional[List[str]] = bank.examples(
+            instruction, k=n_examples, min_coverage=min_coverage
+        )
+        if stored is not None:
+            return stored
+    system: str = templates.builtin("system", "few_shot").render(n_examples=n_examples)
+    user: str = templates.builtin("user", "few_shot").render(instruction=instruction)
     if n_examples < 1:
         red(var="Too few examples requested! Trying anyway...")
+    else:
+        # NOTE: Stop once the last example is closed, instead of paying for whatever the model writes after it.
+        kwargs.setdefault("stop_when", [TagsClosed("example", n=n_examples)])
 
     model_output: str = await agen(
         user=user,
@@ -163,7 +464,12 @@ async def agen_examples_list(
         temperature=temperature,
         **kwargs,
     )
-    return get_xml(tag="example", content=model_output)
+    examples: List[str] = get_xml(tag="example", content=model_output)
+    if dedup_threshold is not None:
+        examples = dedup(examples, threshold=dedup_threshold)
+    if bank is not None:
+        bank.add(instruction, examples)
+    return examples
 
 
 async def agen_examples(
@@ -229,7 +535,7 @@ async def agen_prompt(
     max_tokens: int = 1024,
     temperature=1.0,
     **kwargs: Any,
-) -> Dict[Literal["system", "user", "full"], Union[str, List]]:
+) -> Dict[Literal["system", "user", "full", "template"], Any]:
     """Meta-prompter! Generate a prompt given an arbitrary instruction.
 
     Args:
@@ -242,10 +548,12 @@ async def agen_prompt(
         **kwargs: Additional keyword arguments to pass to the `gen` function.
 
     Returns:
-        Dict[Literal["system", "user", "full"], Union[str, List]]: A dictionary containing the generated prompts.
+        Dict[Literal["system", "user", "full", "template"], Any]: A dictionary containing the generated prompts.
             - "system" (Union[str, List[str]]): The generated system prompt(s).
             - "user" (Union[str, List[str]]): The generated user prompt(s).
             - "full" (str): The full generated output, including both system and user prompts.
+            - "template" (Optional[templates.Template]): The user prompt compiled with `{input_data}` as its only variable, so
+              other braces in it are left alone. Fill it with `prompts["template"].render(input_data=...)`. None if there were several user prompts.
 
     Notes:
         - The function constructs a meta-system prompt using the `globals.SYSTEM["gen_prompt"]` template.
@@ -271,8 +579,10 @@ async def agen_prompt(
         Write a story about a robot learning to love.
         </user_prompt>
     """
-    meta_system_prompt: str = globals.SYSTEM["gen_prompt"]
-    meta_prompt: str = globals.USER["gen_prompt"].format(instruction=instruction)
+    meta_system_prompt: str = templates.builtin("system", "gen_prompt").render()
+    meta_prompt: str = templates.builtin("user", "gen_prompt").render(
+        instruction=instruction
+    )
 
     if messages is not None:
         yellow(
@@ -309,4 +619,13 @@ async def agen_prompt(
         len(user_prompt) == 1
     ):  # TODO: Find a saner way to handle this. E.g. delegate to a formatter model.
         user_prompt = user_prompt[0]
-    return {"system": system_prompt, "user": user_prompt, "full": full_output}
+    return {
+        "system": system_prompt,
+        "user": user_prompt,
+        "full": full_output,
+        "template": (
+            templates.Template(user_prompt, variables=["input_data"])
+            if isinstance(user_prompt, str)
+            else None
+        ),
+    }
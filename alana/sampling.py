@@ -0,0 +1,385 @@
+import copy
+import math
+import asyncio
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from anthropic.types import Message, MessageParam, Usage
+
+from alana import globals
+from alana.color import red
+from alana.prompt import _construct_messages, get_xml
+
+# Sampling several candidates for one prompt, concurrently.
+
+
+@dataclass
+class Candidates:
+    """Result of `gen_n`/`agen_n`. Lists are indexed by sample number; cancelled and failed samples have `None` text."""
+
+    texts: List[Optional[str]]
+    scores: List[Optional[float]]
+    best: Optional[int] = None
+    accepted: Optional[int] = None
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_input_tokens: int = 0
+    messages: List[Optional[Message]] = field(default_factory=list, repr=False)
+    errors: List[Optional[Exception]] = field(default_factory=list, repr=False)
+
+    @property
+    def best_text(self) -> Optional[str]:
+        return None if self.best is None else self.texts[self.best]
+
+
+def _cached_system(system: str) -> Union[str, List[Dict[str, Any]]]:
+    """Mark `system` as a cacheable prompt prefix."""
+    if not system:
+        return system
+    return [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+
+
+async def agen_n(
+    n: int = 4,
+    user: Optional[str] = None,
+    messages: Optional[List[MessageParam]] = None,
+    system: str = "",
+    model: str = globals.DEFAULT_MODEL,
+    api_key: Optional[str] = None,
+    max_tokens=1024,
+    temperature=1.0,
+    scorer: Optional[Callable[[str], float]] = None,
+    validator: Optional[Callable[[str], bool]] = None,
+    threshold: Optional[float] = None,
+    cache_prefix: bool = True,
+    stream_action: Optional[Callable[[int, str], Any]] = None,
+    **kwargs: Any,
+) -> Candidates:
+    """Experimental. Sample `n` candidate responses concurrently, optionally stopping early on an acceptable one.
+
+    Args:
+        n (int, optional): Number of candidates. Defaults to 4.
+        user (Optional[str], optional): The user's message content. Defaults to None.
+        messages (Optional[List[MessageParam]], optional): A list of `anthropic.types.MessageParam`. Not modified. Defaults to None.
+        system (str, optional): The system message for Claude. Defaults to "".
+        model (str, optional): The name of the model to use. Defaults to globals.DEFAULT_MODEL.
+        api_key (Optional[str], optional): The API key to use for authentication. Defaults to None.
+        max_tokens (int, optional): The maximum number of tokens to generate per candidate. Defaults to 1024.
+        temperature (float, optional): Sampling temperature. Defaults to 1.0 (you want diversity here).
+        scorer (Optional[Callable[[str], float]], optional): Scores a finished candidate. Highest score is `best`.
+        validator (Optional[Callable[[str], bool]], optional): Accepts or rejects a finished candidate.
+        threshold (Optional[float], optional): With `scorer`, a candidate scoring >= `threshold` is accepted.
+        cache_prefix (bool, optional): Mark `system` for prompt caching, and start the other samples once the first one has begun streaming, so they can read its cache entry. Defaults to True.
+        stream_action (Optional[Callable[[int, str], Any]], optional): Called as `stream_action(i, text_delta)` for each sample.
+        **kwargs: Additional keyword arguments to pass to `astream` (and so to the Anthropic API).
+
+    Returns:
+        Candidates: Texts, scores, usage totals, and the index of the best (and accepted) candidate.
+
+    Notes:
+        - As soon as a candidate is accepted, the remaining streams are cancelled, so they stop generating (and billing) tokens.
+        - Without `scorer`, `best` is the accepted candidate, or else the first to finish.
+        - A sample that raises is logged, and recorded in `errors`, with `None` text; the others carry on. Only if every
+          sample fails is the first error raised.
+        - Each sample gets its own copy of `stop_when`, since stop predicates keep per-stream state.
+        - Usage totals include cancelled and failed samples. Their output tokens are estimated from the text received.
+    """
+    from alana.prompt_async import astream
+
+    constructed_messages: List[MessageParam] = _construct_messages(
+        user_message=user, messages=messages
+    )
+    system_param: Any = _cached_system(system) if cache_prefix else system
+    result = Candidates(
+        texts=[None] * n, scores=[None] * n, messages=[None] * n, errors=[None] * n
+    )
+
+    # For samples that never finish: usage at message_start, output tokens reported, and characters received.
+    opened: List[Optional[Usage]] = [None] * n
+    reported: List[int] = [0] * n
+    received: List[int] = [0] * n
+
+    async def sample(
+        i: int, started: Optional[asyncio.Event]
+    ) -> Tuple[int, Optional[str]]:
+        parts: List[str] = []
+        options: Dict[str, Any] = dict(kwargs)
+        if options.get("stop_when"):
+            options["stop_when"] = copy.deepcopy(options["stop_when"])
+        try:
+            async for event in astream(
+                messages=list(constructed_messages),
+                system=system_param,
+                model=model,
+                api_key=api_key,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **options,
+            ):
+                if event.type == "message_start":
+                    opened[i] = getattr(event.message, "usage", None)
+                    if started is not None:
+                        started.set()
+                elif event.type == "usage" and event.usage is not None:
+                    reported[i] = event.usage.output_tokens
+                elif event.type == "text":
+                    received[i] += len(event.text)
+                    parts.append(event.text)
+                    if stream_action is not None:
+                        stream_action(i, event.text)
+                elif event.type == "message_stop":
+                    result.messages[i] = event.message
+        except Exception as e:
+            # NOTE: One failed sample (rate limit, dropped connection) shouldn't cancel the others.
+            red(var=f"`agen_n`: sample {i} failed: {e}")
+            result.errors[i] = e
+            return i, None
+        finally:
+            if started is not None:
+                started.set()
+        return i, "".join(parts)
+
+    def accept(text: str, score: Optional[float]) -> bool:
+        if validator is not None and not validator(text):
+            return False
+        if threshold is not None and (score is None or score < threshold):
+            return False
+        return validator is not None or threshold is not None
+
+    started: Optional[asyncio.Event] = asyncio.Event() if cache_prefix else None
+    tasks: List[asyncio.Task] = [asyncio.ensure_future(sample(0, started))]
+    if started is not None and n > 1:
+        await started.wait()
+    tasks += [asyncio.ensure_future(sample(i, None)) for i in range(1, n)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            i, text = await next_done
+            if text is None:
+                continue
+            result.texts[i] = text
+            result.scores[i] = scorer(text) if scorer is not None else None
+            if accept(text, result.scores[i]):
+                result.accepted = i
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if all(error is not None for error in result.errors):
+        raise result.errors[0]  # type: ignore
+    for i, message in enumerate(result.messages):
+        usage: Optional[Usage] = message.usage if message is not None else opened[i]
+        if usage is None:
+            continue
+        output_tokens: int = usage.output_tokens
+        if message is None:
+            # NOTE: Cancelled or failed mid-stream: ~4 characters per token, as in `astream`.
+            output_tokens = max(reported[i], received[i] // 4)
+        result.input_tokens += usage.input_tokens
+        result.output_tokens += output_tokens
+        result.cache_read_input_tokens += (
+            getattr(usage, "cache_read_input_tokens", None) or 0
+        )
+    finished: List[int] = [i for i, text in enumerate(result.texts) if text is not None]
+    if scorer is not None and finished:
+        result.best = max(finished, key=lambda i: result.scores[i])  # type: ignore
+    elif result.accepted is not None:
+        result.best = result.accepted
+    elif finished:
+        result.best = finished[0]
+    return result
+
+
+def gen_n(
+    n: int = 4,
+    user: Optional[str] = None,
+    messages: Optional[List[MessageParam]] = None,
+    system: str = "",
+    model: str = globals.DEFAULT_MODEL,
+    api_key: Optional[str] = None,
+    max_tokens=1024,
+    temperature=1.0,
+    scorer: Optional[Callable[[str], float]] = None,
+    validator: Optional[Callable[[str], bool]] = None,
+    threshold: Optional[float] = None,
+    cache_prefix: bool = True,
+    **kwargs: Any,
+) -> Candidates:
+    """Sync version of `agen_n`. Runs on the shared background event loop (see `alana.loop`).
+
+    Example:
+        >>> candidates = gen_n(n=5, user="Write a haiku about tea.", scorer=len)
+        >>> print(candidates.best_text)
+    """
+    from alana.loop import run
+
+    return run(
+        agen_n(
+            n=n,
+            user=user,
+            messages=messages,
+            system=system,
+            model=model,
+            api_key=api_key,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            scorer=scorer,
+            validator=validator,
+            threshold=threshold,
+            cache_prefix=cache_prefix,
+            **kwargs,
+        )
+    )
+
+
+@dataclass
+class Vote:
+    """Result of `vote`/`avote`."""
+
+    answer: Optional[str]
+    distribution: Dict[str, int]
+    n_samples: int
+    unparsed: int
+    p_value: float
+    stopped_early: bool
+    input_tokens: int = 0
+    output_tokens: int = 0
+    tokens_saved: int = 0
+
+
+def _sign_test(leader: int, runner_up: int) -> float:
+    """One-sided sign test: P(leader gets >= `leader` of the top-two votes | both answers equally likely)."""
+    total: int = leader + runner_up
+    if total == 0:
+        return 1.0
+    return sum(math.comb(total, k) for k in range(leader, total + 1)) / 2**total
+
+
+async def avote(
+    user: Optional[str] = None,
+    tag: str = "answer",
+    messages: Optional[List[MessageParam]] = None,
+    system: str = "",
+    model: str = globals.DEFAULT_MODEL,
+    api_key: Optional[str] = None,
+    max_tokens=1024,
+    temperature=1.0,
+    wave_size: int = 3,
+    max_samples: int = 15,
+    confidence: float = 0.95,
+    normalize: Callable[[str], str] = lambda answer: answer.strip().lower(),
+    **kwargs: Any,
+) -> Vote:
+    """Experimental. Self-consistency: sample in waves, majority-vote the `<tag/>` answers, stop once the vote is decisive.
+
+    Args:
+        user (Optional[str], optional): The user's message content. Ask for the final answer in `<tag/>` XML tags!
+        tag (str, optional): XML tag holding the answer (the last one in each sample is used). Defaults to "answer".
+        messages (Optional[List[MessageParam]], optional): A list of `anthropic.types.MessageParam`. Not modified. Defaults to None.
+        system (str, optional): The system message for Claude. Defaults to "".
+        model (str, optional): The name of the model to use. Defaults to globals.DEFAULT_MODEL.
+        api_key (Optional[str], optional): The API key to use for authentication. Defaults to None.
+        max_tokens (int, optional): The maximum number of tokens to generate per sample. Defaults to 1024.
+        temperature (float, optional): Sampling temperature. Defaults to 1.0.
+        wave_size (int, optional): Samples launched concurrently per wave. Defaults to 3.
+        max_samples (int, optional): The fixed-N budget we'd otherwise spend. Defaults to 15.
+        confidence (float, optional): Stop once a sign test of leader vs. runner-up gives p <= 1 - confidence. Defaults to 0.95.
+        normalize (Callable[[str], str], optional): Maps raw answers to vote keys. Defaults to strip + lowercase.
+        **kwargs: Additional keyword arguments to pass to `agen_n`.
+
+    Returns:
+        Vote: The winning answer, vote distribution, the test's p-value, usage, and an estimate of tokens saved vs. `max_samples`.
+
+    Notes:
+        - The test is re-run after every wave without correction, so treat `confidence` as a knob, not a guarantee.
+        - Samples without a `<tag/>` are counted in `unparsed` and don't vote.
+    """
+    votes: Counter = Counter()
+    n_samples, unparsed, input_tokens, output_tokens = 0, 0, 0, 0
+    p_value: float = 1.0
+    while n_samples < max_samples:
+        candidates: Candidates = await agen_n(
+            n=min(wave_size, max_samples - n_samples),
+            user=user,
+            messages=messages,
+            system=system,
+            model=model,
+            api_key=api_key,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            **kwargs,
+        )
+        for text in candidates.texts:
+            n_samples += 1
+            answers: List[str] = get_xml(tag=tag, content=text or "")
+            if answers:
+                votes[normalize(answers[-1])] += 1
+            else:
+                unparsed += 1
+        input_tokens += candidates.input_tokens
+        output_tokens += candidates.output_tokens
+        ranked: List[Tuple[str, int]] = votes.most_common(2)
+        if ranked:
+            p_value = _sign_test(
+                leader=ranked[0][1], runner_up=ranked[1][1] if len(ranked) > 1 else 0
+            )
+            if p_value <= 1 - confidence:
+                break
+    remaining: int = max_samples - n_samples
+    return Vote(
+        answer=votes.most_common(1)[0][0] if votes else None,
+        distribution=dict(votes),
+        n_samples=n_samples,
+        unparsed=unparsed,
+        p_value=p_value,
+        stopped_early=remaining > 0,
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        tokens_saved=(
+            round(remaining * (input_tokens + output_tokens) / n_samples)
+            if n_samples
+            else 0
+        ),
+    )
+
+
+def vote(
+    user: Optional[str] = None,
+    tag: str = "answer",
+    messages: Optional[List[MessageParam]] = None,
+    system: str = "",
+    model: str = globals.DEFAULT_MODEL,
+    api_key: Optional[str] = None,
+    max_tokens=1024,
+    temperature=1.0,
+    wave_size: int = 3,
+    max_samples: int = 15,
+    confidence: float = 0.95,
+    **kwargs: Any,
+) -> Vote:
+    """Sync version of `avote`. Runs on the shared background event loop (see `alana.loop`).
+
+    Example:
+        >>> result = vote(user="Is 'I loved it' positive or negative? Answer in <answer/> tags.", model="haiku")
+        >>> result.answer, result.distribution
+        ('positive', {'positive': 5})
+    """
+    from alana.loop import run
+
+    return run(
+        avote(
+            user=user,
+            tag=tag,
+            messages=messages,
+            system=system,
+            model=model,
+            api_key=api_key,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            wave_size=wave_size,
+            max_samples=max_samples,
+            confidence=confidence,
+            **kwargs,
+        )
+    )
@@ -0,0 +1,283 @@
+import time
+import heapq
+import asyncio
+import itertools
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    AsyncIterator,
+    Deque,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    Union,
+)
+
+# Request scheduling for the async path. `agen_msg`/`astream` take two extra kwargs, `priority` and `tenant`:
+#   - priority classes are served strictly in order: "interactive" > "batch" > "background"
+#   - within a class, tenants share capacity by weighted fair queuing (WFQ), weighted by `tenant_weights`
+#   - each tenant can be capped by concurrency and by a tokens-per-minute quota
+# Nothing is scheduled (and the kwargs are just dropped) until `configure` is called.
+
+Priority = Literal["interactive", "batch", "background"]
+PRIORITIES: Dict[str, int] = {"interactive": 0, "batch": 1, "background": 2}
+
+
+@dataclass
+class Ticket:
+    """Handed out by `Scheduler.slot`. Set `tokens` to the actual usage so the tenant's quota is corrected."""
+
+    priority: str = "interactive"
+    tenant: str = "default"
+    cost: int = 0
+    tokens: Optional[int] = None
+    wait: float = 0.0
+
+
+@dataclass(order=True)
+class _Waiter:
+    rank: int
+    finish: float
+    seq: int
+    start: float = field(compare=False)
+    ticket: Ticket = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    enqueued: float = field(compare=False)
+
+
+class _TokenBucket:
+    def __init__(self, tokens_per_minute: int) -> None:
+        self.capacity: float = float(tokens_per_minute)
+        self.tokens: float = float(tokens_per_minute)
+        self.rate: float = tokens_per_minute / 60.0
+        self.updated: float = time.monotonic()
+
+    def refill(self) -> None:
+        now: float = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def seconds_until(self, cost: float) -> float:
+        self.refill()
+        return max(0.0, (min(cost, self.capacity) - self.tokens) / self.rate)
+
+
+class Scheduler:
+    """Priority + weighted-fair scheduler with per-tenant concurrency and token quotas.
+
+    Args:
+        max_concurrency (int, optional): Requests in flight across all tenants. Defaults to 8.
+        tenant_weights (Optional[Dict[str, float]], optional): WFQ weights. Unlisted tenants get 1.0.
+        tenant_max_concurrency (Optional[Union[int, Dict[str, int]]], optional): Per-tenant in-flight cap (one value for all, or per tenant).
+        tenant_tokens_per_minute (Optional[Union[int, Dict[str, int]]], optional): Per-tenant token quota (input + output).
+
+    Notes:
+        - Uses asyncio primitives, so use it from one event loop (sync callers: see `alana.loop`).
+        - A request's cost is estimated up front (prompt size + `max_tokens`) and corrected with actual usage afterwards.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        tenant_weights: Optional[Dict[str, float]] = None,
+        tenant_max_concurrency: Optional[Union[int, Dict[str, int]]] = None,
+        tenant_tokens_per_minute: Optional[Union[int, Dict[str, int]]] = None,
+    ) -> None:
+        self.max_concurrency: int = max_concurrency
+        self.tenant_weights: Dict[str, float] = tenant_weights or {}
+        self.tenant_max_concurrency = tenant_max_concurrency
+        self.tenant_tokens_per_minute = tenant_tokens_per_minute
+        self._heap: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._virtual_time: Dict[int, float] = {}
+        self._last_finish: Dict[Tuple[int, str], float] = {}
+        self._buckets: Dict[str, _TokenBucket] = {}
+        self._running: int = 0
+        self._tenant_running: Dict[str, int] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._waits: Dict[str, Deque[float]] = {
+            p: deque(maxlen=1000) for p in PRIORITIES
+        }
+        self._served: Dict[str, int] = {}
+
+    def _limit(self, setting: Any, tenant: str) -> Optional[int]:
+        if isinstance(setting, dict):
+            return setting.get(tenant)
+        return setting
+
+    def _bucket(self, tenant: str) -> Optional[_TokenBucket]:
+        tokens_per_minute: Optional[int] = self._limit(
+            self.tenant_tokens_per_minute, tenant
+        )
+        if tokens_per_minute is None:
+            return None
+        if tenant not in self._buckets:
+            self._buckets[tenant] = _TokenBucket(tokens_per_minute)
+        return self._buckets[tenant]
+
+    @asynccontextmanager
+    async def slot(
+        self, priority: Priority = "interactive", tenant: str = "default", cost: int = 1
+    ) -> AsyncIterator[Ticket]:
+        """Wait for a slot, hold it for the duration of the `async with` block."""
+        if priority not in PRIORITIES:
+            raise ValueError(
+                f"`Scheduler`: unknown {priority=}; use one of {list(PRIORITIES)}."
+            )
+        ticket = Ticket(priority=priority, tenant=tenant, cost=cost)
+        rank: int = PRIORITIES[priority]
+        start: float = max(
+            self._virtual_time.get(rank, 0.0),
+            self._last_finish.get((rank, tenant), 0.0),
+        )
+        finish: float = start + cost / self.tenant_weights.get(tenant, 1.0)
+        self._last_finish[(rank, tenant)] = finish
+        waiter = _Waiter(
+            rank=rank,
+            finish=finish,
+            seq=next(self._seq),
+            start=start,
+            ticket=ticket,
+            future=asyncio.get_running_loop().create_future(),
+            enqueued=time.monotonic(),
+        )
+        heapq.heappush(self._heap, waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release(ticket)  # NOTE: Granted and cancelled at the same time.
+            raise
+        try:
+            yield ticket
+        finally:
+            self._release(ticket)
+
+    def _release(self, ticket: Ticket) -> None:
+        self._running -= 1
+        self._tenant_running[ticket.tenant] -= 1
+        bucket: Optional[_TokenBucket] = self._bucket(ticket.tenant)
+        if bucket is not None and ticket.tokens is not None:
+            bucket.refill()
+            bucket.tokens = min(
+                bucket.capacity, bucket.tokens + ticket.cost - ticket.tokens
+            )
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        skipped: List[_Waiter] = []
+        retry_in: Optional[float] = None
+        while self._heap and self._running < self.max_concurrency:
+            waiter: _Waiter = heapq.heappop(self._heap)
+            if waiter.future.done():  # Cancelled while waiting.
+                continue
+            tenant: str = waiter.ticket.tenant
+            cap: Optional[int] = self._limit(self.tenant_max_concurrency, tenant)
+            if cap is not None and self._tenant_running.get(tenant, 0) >= cap:
+                skipped.append(waiter)
+                continue
+            bucket: Optional[_TokenBucket] = self._bucket(tenant)
+            if bucket is not None:
+                wait: float = bucket.seconds_until(waiter.ticket.cost)
+                if wait > 0:
+                    retry_in = wait if retry_in is None else min(retry_in, wait)
+                    skipped.append(waiter)
+                    continue
+                bucket.tokens -= waiter.ticket.cost
+            self._virtual_time[waiter.rank] = max(
+                self._virtual_time.get(waiter.rank, 0.0), waiter.start
+            )
+            self._running += 1
+            self._tenant_running[tenant] = self._tenant_running.get(tenant, 0) + 1
+            self._served[tenant] = self._served.get(tenant, 0) + 1
+            waiter.ticket.wait = time.monotonic() - waiter.enqueued
+            self._waits[waiter.ticket.priority].append(waiter.ticket.wait)
+            waiter.future.set_result(None)
+        for waiter in skipped:
+            heapq.heappush(self._heap, waiter)
+        if retry_in is not None and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                retry_in, self._on_timer
+            )
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Queue depth per priority, in-flight counts, requests served per tenant, and wait-time stats (seconds)."""
+        depth: Dict[str, int] = {p: 0 for p in PRIORITIES}
+        for waiter in self._heap:
+            if not waiter.future.done():
+                depth[waiter.ticket.priority] += 1
+        waits: Dict[str, Dict[str, float]] = {}
+        for priority, samples in self._waits.items():
+            if samples:
+                ordered: List[float] = sorted(samples)
+                waits[priority] = {
+                    "mean": sum(ordered) / len(ordered),
+                    "p50": ordered[len(ordered) // 2],
+                    "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                    "max": ordered[-1],
+                }
+        return {
+            "queue_depth": depth,
+            "running": self._running,
+            "tenant_running": dict(self._tenant_running),
+            "served": dict(self._served),
+            "wait": waits,
+        }
+
+
+_SCHEDULER: Optional[Scheduler] = None
+
+
+def configure(
+    max_concurrency: int = 8,
+    tenant_weights: Optional[Dict[str, float]] = None,
+    tenant_max_concurrency: Optional[Union[int, Dict[str, int]]] = None,
+    tenant_tokens_per_minute: Optional[Union[int, Dict[str, int]]] = None,
+) -> Scheduler:
+    """Install a `Scheduler` under `agen_msg`/`astream` (replacing any previous one) and return it."""
+    global _SCHEDULER
+    _SCHEDULER = Scheduler(
+        max_concurrency=max_concurrency,
+        tenant_weights=tenant_weights,
+        tenant_max_concurrency=tenant_max_concurrency,
+        tenant_tokens_per_minute=tenant_tokens_per_minute,
+    )
+    return _SCHEDULER
+
+
+def get_scheduler() -> Optional[Scheduler]:
+    """Return the installed `Scheduler`, or None."""
+    return _SCHEDULER
+
+
+def disable() -> None:
+    """Remove the installed `Scheduler`."""
+    global _SCHEDULER
+    _SCHEDULER = None
+
+
+def estimate_tokens(messages: List[Any], system: Any, max_tokens: int) -> int:
+    """Rough request cost: ~4 characters per prompt token, plus `max_tokens`."""
+    chars: int = len(str(system)) + sum(len(str(m["content"])) for m in messages)
+    return chars // 4 + max_tokens
+
+
+@asynccontextmanager
+async def slot(
+    priority: Priority = "interactive", tenant: str = "default", cost: int = 1
+) -> AsyncIterator[Ticket]:
+    """`Scheduler.slot` on the installed scheduler, or a no-op if none is installed."""
+    if _SCHEDULER is None:
+        yield Ticket(priority=priority, tenant=tenant, cost=cost)
+        return
+    async with _SCHEDULER.slot(priority=priority, tenant=tenant, cost=cost) as ticket:
+        yield ticket
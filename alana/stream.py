@@ -0,0 +1,336 @@
+import re
+import asyncio
+import dataclasses
+from dataclasses import dataclass
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    List,
+    Literal,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+    Union,
+)
+from anthropic.types import Message, Usage
+
+from alana import tags as tags_module
+
+# Typed stream events, and helpers for consuming them. See `alana.prompt_async.astream`.
+
+EventType = Literal[
+    "message_start",
+    "text",
+    "input_json",
+    "tool_use",
+    "usage",
+    "stop_reason",
+    "message_stop",
+]
+
+
+@dataclass(frozen=True)
+class StreamEvent:
+    """One event from `astream`. Which fields are set depends on `type`:
+
+    - "message_start": `message` (the initial snapshot, with input token usage).
+    - "text": `text` (a text delta) and `index` (content block index).
+    - "input_json": `text` (a partial JSON delta for a tool_use block) and `index`.
+    - "tool_use": `block` (the finished tool_use content block) and `index`.
+    - "usage": `usage` (cumulative usage reported by the API).
+    - "stop_reason": `stop_reason`.
+    - "message_stop": `message` (the final `anthropic.types.Message`). Always the last event.
+    """
+
+    type: EventType
+    text: str = ""
+    index: int = 0
+    block: Any = None
+    usage: Optional[Usage] = None
+    stop_reason: Optional[str] = None
+    message: Optional[Message] = None
+
+
+_DONE = object()
+
+
+class Fanout:
+    """Fan one event stream out to several consumers without copying events.
+
+    Every consumer sees the same `StreamEvent` objects. Each consumer has a bounded buffer of `max_buffer` events; the
+    source is only read as fast as the slowest consumer drains its buffer (backpressure), so every consumer must be
+    iterated to the end.
+
+    Example:
+        >>> fan = Fanout(astream(user="Hi"), n=2)
+        >>> await asyncio.gather(log_events(fan[0]), render_events(fan[1]))
+    """
+
+    def __init__(
+        self, source: AsyncIterator[StreamEvent], n: int = 2, max_buffer: int = 64
+    ) -> None:
+        if n < 1:
+            raise ValueError("`Fanout`: need at least one consumer.")
+        self._source: AsyncIterator[StreamEvent] = source
+        self._queues: List[asyncio.Queue] = [
+            asyncio.Queue(maxsize=max_buffer) for _ in range(n)
+        ]
+        self._pump: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._queues)
+
+    def __getitem__(self, i: int) -> AsyncIterator[StreamEvent]:
+        return self._consume(self._queues[i])
+
+    async def _run(self) -> None:
+        try:
+            async for event in self._source:
+                for queue in self._queues:
+                    await queue.put(event)
+            end: Any = _DONE
+        except Exception as e:
+            end = e
+        for queue in self._queues:
+            await queue.put(end)
+
+    async def _consume(self, queue: asyncio.Queue) -> AsyncIterator[StreamEvent]:
+        if self._pump is None:
+            self._pump = asyncio.ensure_future(self._run())
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+# Stop predicates for `astream(..., stop_when=[...])`: called with the text so far after each text delta; the stream
+# is closed as soon as one returns True. They scan incrementally, so checking every delta stays linear overall.
+StopPredicate = Callable[[str], bool]
+
+
+class TagsClosed:
+    """Stop predicate: True once `n` outermost `<tag>...</tag>` elements have been closed.
+
+    Example:
+        >>> await agen(user=..., stop_when=[TagsClosed("example", n=5)])
+    """
+
+    def __init__(self, tag: str, n: int = 1) -> None:
+        tags_module._check_name(tag)
+        self.tag: str = tag
+        self.n: int = n
+        self._reset()
+
+    def _reset(self) -> None:
+        self.closed: int = 0
+        self._depth: int = 0
+        self._scanned: int = 0
+
+    def __call__(self, text: str) -> bool:
+        if len(text) < self._scanned:  # A new stream.
+            self._reset()
+        for match in tags_module._tag_pattern(self.tag).finditer(text, self._scanned):
+            if match.group(1):
+                if self._depth > 0:
+                    self._depth -= 1
+                    self.closed += self._depth == 0
+            elif not match.group(3).endswith("/"):
+                self._depth += 1
+        # NOTE: Tags can't contain "<", so a tag still being written starts at the last "<" (if no ">" follows it).
+        last_open: int = text.rfind("<", self._scanned)
+        self._scanned = (
+            last_open if last_open > text.rfind(">", self._scanned) else len(text)
+        )
+        return self.closed >= self.n
+
+    def __repr__(self) -> str:
+        return f"TagsClosed({self.tag!r}, n={self.n})"
+
+
+class Matches:
+    """Stop predicate: True once `pattern` matches the text so far.
+
+    Args:
+        pattern (Union[str, Pattern]): Regex to search for.
+        window (Optional[int], optional): Only re-search the last `window` characters before new text, instead of the
+            whole text every delta. Set it when matches are short. Defaults to None (whole text).
+    """
+
+    def __init__(
+        self, pattern: Union[str, Pattern], window: Optional[int] = None
+    ) -> None:
+        self.pattern: Pattern = re.compile(pattern)
+        self.window: Optional[int] = window
+        self._checked: int = 0
+
+    def __call__(self, text: str) -> bool:
+        if len(text) < self._checked:
+            self._checked = 0
+        start: int = 0 if self.window is None else max(0, self._checked - self.window)
+        self._checked = len(text)
+        return self.pattern.search(text, start) is not None
+
+    def __repr__(self) -> str:
+        return f"Matches({self.pattern.pattern!r}, window={self.window})"
+
+
+class Redactor:
+    """Strips `<tag>...</tag>` sections out of streamed text as it arrives, and keeps them aside (e.g. for logging).
+
+    Text outside the tags is passed on immediately, except a trailing fragment that may be the start of a tag (like
+    "<reas"), which is held back until the next delta settles it, up to `max_lookahead` characters.
+
+    Args:
+        tags (Sequence[str], optional): Tags to strip. Defaults to ("reasoning", "thinking").
+        action (Optional[Callable[[str], Any]], optional): Called with the visible text of each delta, so the redactor
+            can be passed as a `stream_action`. Defaults to None.
+        on_section (Optional[Callable[[str, str], Any]], optional): Called with (tag, content) for each stripped section. Defaults to None.
+        lenient (bool, optional): A section still open when the stream ends stays hidden (like `remove_xml(lenient=True)`).
+            Otherwise `flush` releases it as text. Defaults to True.
+        max_lookahead (int, optional): Longest fragment held back as a possible tag. Defaults to 256.
+
+    Example:
+        >>> redactor = Redactor(action=lambda x: print(x, end="", flush=True))
+        >>> await agen(user=..., stream_action=redactor)
+        >>> redactor.flush()
+        >>> redactor.sections  # [("reasoning", "..."), ...]
+    """
+
+    def __init__(
+        self,
+        tags: Sequence[str] = ("reasoning", "thinking"),
+        action: Optional[Callable[[str], Any]] = None,
+        on_section: Optional[Callable[[str, str], Any]] = None,
+        lenient: bool = True,
+        max_lookahead: int = 256,
+    ) -> None:
+        for tag in tags:
+            tags_module._check_name(tag)
+        self.tags: Tuple[str, ...] = tuple(tags)
+        self.action: Optional[Callable[[str], Any]] = action
+        self.on_section: Optional[Callable[[str, str], Any]] = on_section
+        self.lenient: bool = lenient
+        self.max_lookahead: int = max_lookahead
+        self.sections: List[Tuple[str, str]] = []
+        self._pattern: Pattern = re.compile(
+            rf"<(/?)({'|'.join(map(re.escape, self.tags))})(?=[\s/>])([^<>]*)>"
+        )
+        self._pending: str = ""
+        self._inside: Optional[str] = None
+        self._opening: str = ""
+        self._depth: int = 0
+        self._section: List[str] = []
+
+    def _could_be_tag(self, fragment: str) -> bool:
+        """Whether `fragment` (from a "<" to the end of the text so far) may still become one of our tags."""
+        if len(fragment) > self.max_lookahead or not tags_module._PARTIAL_TAG.fullmatch(
+            fragment
+        ):
+            return False
+        name: str = fragment.lstrip("<").lstrip("/")
+        for tag in self.tags:
+            if tag.startswith(name) or (
+                name.startswith(tag) and name[len(tag) :][:1].isspace()
+            ):
+                return True
+        return False
+
+    def feed(self, text: str) -> str:
+        """Take the next delta; return the text that can be shown now."""
+        buffer: str = self._pending + text
+        visible: List[str] = []
+        position: int = 0
+        for match in self._pattern.finditer(buffer):
+            closing, name, rest = match.groups()
+            if self._inside is None:
+                if closing or rest.endswith("/"):
+                    continue  # Stray closing or self-closing tag: leave it in the text.
+                visible.append(buffer[position : match.start()])
+                self._inside, self._opening, self._depth = name, match.group(0), 1
+            elif name == self._inside and not rest.endswith("/"):
+                self._depth += -1 if closing else 1
+                if self._depth == 0:
+                    self._section.append(buffer[position : match.start()])
+                    self._close()
+                    position = match.end()
+                    continue
+                self._section.append(buffer[position : match.end()])
+            else:
+                self._section.append(buffer[position : match.end()])
+            position = match.end()
+        last_open: int = buffer.rfind("<", position)
+        hold: int = (
+            last_open
+            if last_open >= 0 and self._could_be_tag(buffer[last_open:])
+            else len(buffer)
+        )
+        (visible if self._inside is None else self._section).append(
+            buffer[position:hold]
+        )
+        self._pending = buffer[hold:]
+        shown: str = "".join(visible)
+        if shown and self.action is not None:
+            self.action(shown)
+        return shown
+
+    __call__ = feed
+
+    def _close(self, content: Optional[str] = None) -> None:
+        section: Tuple[str, str] = (
+            self._inside,  # type: ignore
+            "".join(self._section) if content is None else content,
+        )
+        self.sections.append(section)
+        if self.on_section is not None:
+            self.on_section(*section)
+        self._inside, self._opening, self._depth, self._section = None, "", 0, []
+
+    def flush(self) -> str:
+        """End of stream: return (and pass to `action`) whatever was held back."""
+        shown: str = ""
+        if self._inside is None:
+            shown = self._pending
+        elif self.lenient:
+            self._close("".join(self._section) + self._pending)
+        else:
+            shown = self._opening + "".join(self._section) + self._pending
+            self._inside, self._opening, self._depth, self._section = None, "", 0, []
+        self._pending = ""
+        if shown and self.action is not None:
+            self.action(shown)
+        return shown
+
+
+async def redact(
+    events: AsyncIterator[StreamEvent],
+    tags: Sequence[str] = ("reasoning", "thinking"),
+    redactor: Optional[Redactor] = None,
+) -> AsyncIterator[StreamEvent]:
+    """Wrap an `astream` iterator so "text" events skip `<tag>...</tag>` sections. See `Redactor`.
+
+    The stripped sections end up in `redactor.sections`. The final `Message` in "message_stop" is left untouched.
+
+    Example:
+        >>> redactor = Redactor()
+        >>> async for event in redact(astream(user=...), redactor=redactor):
+        ...     if event.type == "text":
+        ...         print(event.text, end="")
+    """
+    if redactor is None:
+        redactor = Redactor(tags=tags)
+    async for event in events:
+        if event.type == "text":
+            text: str = redactor.feed(event.text)
+            if text:
+                yield dataclasses.replace(event, text=text)
+            continue
+        if event.type == "message_stop":
+            rest: str = redactor.flush()
+            if rest:
+                yield StreamEvent(type="text", text=rest)
+        yield event
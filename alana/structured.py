@@ -0,0 +1,351 @@
+import json
+import dataclasses
+import typing
+from typing import Any, Dict, List, Optional, Type, TypeVar, Union
+from anthropic.types import MessageParam
+
+from alana import globals
+from alana import templates
+from alana.color import red
+from alana.prompt import _construct_messages, respond
+
+# Structured output: JSON forced via an assistant prefill of "{", validated member-by-member while it streams.
+# NOTE: We use prefill rather than forced tool-use so a failed attempt can be resumed from its last valid member.
+
+T = TypeVar("T")
+
+_JSON_TYPES: Dict[Any, str] = {
+    str: "string",
+    int: "integer",
+    float: "number",
+    bool: "boolean",
+    type(None): "null",
+    list: "array",
+    dict: "object",
+}
+
+
+def _is_typeddict(tp: Any) -> bool:
+    return isinstance(tp, type) and issubclass(tp, dict) and hasattr(tp, "__total__")
+
+
+def schema_of(spec: Any) -> Dict[str, Any]:
+    """Return a JSON Schema for `spec`: a JSON Schema dict (returned as is), a dataclass, a TypedDict, or a type hint."""
+    if isinstance(spec, dict):
+        return spec
+    if dataclasses.is_dataclass(spec) and isinstance(spec, type):
+        hints: Dict[str, Any] = typing.get_type_hints(spec)
+        fields = dataclasses.fields(spec)
+        return {
+            "type": "object",
+            "properties": {f.name: schema_of(hints[f.name]) for f in fields},
+            "required": [
+                f.name
+                for f in fields
+                if f.default is dataclasses.MISSING
+                and f.default_factory is dataclasses.MISSING
+            ],
+            "additionalProperties": False,
+        }
+    if _is_typeddict(spec):
+        hints = typing.get_type_hints(spec)
+        return {
+            "type": "object",
+            "properties": {name: schema_of(hint) for name, hint in hints.items()},
+            "required": sorted(getattr(spec, "__required_keys__", hints.keys())),
+            "additionalProperties": False,
+        }
+    if spec in _JSON_TYPES:
+        return {"type": _JSON_TYPES[spec]}
+    origin = typing.get_origin(spec)
+    args = typing.get_args(spec)
+    if origin is typing.Literal:
+        return {"enum": list(args)}
+    if origin is Union:
+        return {"anyOf": [schema_of(arg) for arg in args]}
+    if origin in (list, tuple, set, frozenset):
+        return {"type": "array", "items": schema_of(args[0]) if args else {}}
+    if origin is dict:
+        return {"type": "object"}
+    return {}
+
+
+def validate(value: Any, schema: Dict[str, Any], path: str = "$") -> Optional[str]:
+    """Check `value` against a (subset of) JSON Schema. Returns an error message, or None if valid.
+
+    Supports: type, enum, anyOf, properties, required, additionalProperties (bool), items.
+    """
+    if "anyOf" in schema:
+        errors: List[str] = []
+        for option in schema["anyOf"]:
+            error: Optional[str] = validate(value, option, path)
+            if error is None:
+                break
+            errors.append(error)
+        else:
+            return f"{path}: matches none of anyOf ({'; '.join(errors)})"
+    if "enum" in schema and value not in schema["enum"]:
+        return f"{path}: {value!r} not in {schema['enum']}"
+    expected = schema.get("type")
+    if expected is not None:
+        types: List[str] = expected if isinstance(expected, list) else [expected]
+        if not any(_is_json_type(value, t) for t in types):
+            return f"{path}: expected {expected}, got {type(value).__name__}"
+    if isinstance(value, dict):
+        properties: Dict[str, Any] = schema.get("properties", {})
+        missing: List[str] = [k for k in schema.get("required", []) if k not in value]
+        if missing:
+            return f"{path}: missing required keys {missing}"
+        for key, item in value.items():
+            if key in properties:
+                error = validate(item, properties[key], f"{path}.{key}")
+                if error is not None:
+                    return error
+            elif schema.get("additionalProperties") is False:
+                return f"{path}: unexpected key {key!r}"
+    if isinstance(value, list) and "items" in schema:
+        for i, item in enumerate(value):
+            error = validate(item, schema["items"], f"{path}[{i}]")
+            if error is not None:
+                return error
+    return None
+
+
+def _is_json_type(value: Any, json_type: str) -> bool:
+    if json_type == "integer":
+        return isinstance(value, int) and not isinstance(value, bool)
+    if json_type == "number":
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if json_type == "boolean":
+        return isinstance(value, bool)
+    if json_type == "string":
+        return isinstance(value, str)
+    if json_type == "null":
+        return value is None
+    if json_type == "array":
+        return isinstance(value, list)
+    if json_type == "object":
+        return isinstance(value, dict)
+    return True
+
+
+class _ObjectScanner:
+    """Incrementally scan a streamed top-level JSON object, validating each member as soon as it is complete.
+
+    `text` starts with the opening "{". `valid_end` is the offset just past the last validated member, i.e. the
+    prefix that is safe to reuse as a prefill when retrying.
+    """
+
+    def __init__(self, schema: Dict[str, Any], text: str = "{") -> None:
+        self.schema: Dict[str, Any] = schema
+        self.properties: Dict[str, Any] = schema.get("properties", {})
+        self.text: str = ""
+        self.data: Dict[str, Any] = {}
+        self.valid_end: int = 0
+        self.done: bool = False
+        self._depth: int = 0
+        self._in_string: bool = False
+        self._escape: bool = False
+        self._member_start: int = 0
+        self.error: Optional[str] = self.feed(text)
+
+    def feed(self, chunk: str) -> Optional[str]:
+        """Consume `chunk`. Returns an error message as soon as a member fails to parse or validate."""
+        start: int = len(self.text)
+        self.text += chunk
+        for i in range(start, len(self.text)):
+            ch: str = self.text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._member_start = i + 1
+                    self.valid_end = i + 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.done = True
+                    self.error = self._member(end=i)
+                    if self.error is None:
+                        self.error = validate(self.data, self.schema)
+                    return self.error
+            elif ch == "," and self._depth == 1:
+                self.error = self._member(end=i)
+                if self.error is not None:
+                    return self.error
+                self._member_start = i + 1
+        return None
+
+    def _member(self, end: int) -> Optional[str]:
+        member: str = self.text[self._member_start : end].strip()
+        if not member:
+            return None
+        try:
+            parsed: Dict[str, Any] = json.loads("{" + member + "}")
+        except json.JSONDecodeError as e:
+            return f"invalid JSON member {member[:80]!r}: {e}"
+        for key, value in parsed.items():
+            if key in self.properties:
+                error: Optional[str] = validate(value, self.properties[key], f"$.{key}")
+                if error is not None:
+                    return error
+            elif self.schema.get("additionalProperties") is False:
+                return f"$: unexpected key {key!r}"
+            self.data[key] = value
+        self.valid_end = end
+        return None
+
+
+def _build(spec: Any, value: Any) -> Any:
+    """Construct dataclass instances (recursively) from parsed JSON. Dicts and lists are used in place, not copied."""
+    if dataclasses.is_dataclass(spec) and isinstance(spec, type):
+        hints: Dict[str, Any] = typing.get_type_hints(spec)
+        return spec(
+            **{
+                f.name: _build(hints[f.name], value[f.name])
+                for f in dataclasses.fields(spec)
+                if f.name in value
+            }
+        )
+    origin = typing.get_origin(spec)
+    args = typing.get_args(spec)
+    if origin is list and args and isinstance(value, list):
+        for i, item in enumerate(value):
+            value[i] = _build(args[0], item)
+    elif origin is Union:
+        for arg in args:
+            if dataclasses.is_dataclass(arg) and isinstance(value, dict):
+                return _build(arg, value)
+    return value
+
+
+async def agen_structured(
+    spec: Union[Type[T], Dict[str, Any]],
+    user: Optional[str] = None,
+    messages: Optional[List[MessageParam]] = None,
+    system: str = "",
+    model: str = globals.DEFAULT_MODEL,
+    api_key: Optional[str] = None,
+    max_tokens=1024,
+    temperature=1.0,
+    max_retries: int = 2,
+    **kwargs: Any,
+) -> Any:
+    """Experimental. Generate a JSON object conforming to `spec`, validated while it streams.
+
+    Args:
+        spec (Union[Type, Dict[str, Any]]): A JSON Schema dict, a dataclass, or a TypedDict.
+        user (Optional[str], optional): The user's message content. Defaults to None.
+        messages (Optional[List[MessageParam]], optional): A list of `anthropic.types.MessageParam`. Not modified. Defaults to None.
+        system (str, optional): Extra system prompt. The JSON instructions (`globals.SYSTEM["structured"]`) are appended to it.
+        model (str, optional): The name of the model to use. Defaults to globals.DEFAULT_MODEL.
+        api_key (Optional[str], optional): The API key to use for authentication. Defaults to None.
+        max_tokens (int, optional): The maximum number of tokens to generate per attempt. Defaults to 1024.
+        temperature (float, optional): The temperature value for controlling the randomness of the generated response.
+        max_retries (int, optional): How many times to resume after a validation error. Defaults to 2.
+        **kwargs: Additional keyword arguments to pass to `astream` (and so to the Anthropic API).
+
+    Returns:
+        An instance of `spec` if it is a dataclass, otherwise the parsed `dict`.
+
+    Raises:
+        ValueError: If `messages` already ends with an assistant turn, or if the output is still invalid after `max_retries` retries.
+
+    Notes:
+        - The assistant turn is prefilled with "{", which forces JSON output.
+        - Each top-level member is parsed and validated as soon as its closing "," or "}" arrives. On the first invalid member, the stream is cut off (no more tokens are paid for).
+        - A retry prefills everything up to the last valid member, so only the failing part is regenerated.
+    """
+    from alana.prompt_async import astream
+
+    schema: Dict[str, Any] = schema_of(spec)
+    constructed_messages: List[MessageParam] = list(
+        _construct_messages(user_message=user, messages=messages)
+    )
+    if constructed_messages[-1]["role"] == "assistant":
+        raise ValueError(
+            "`agen_structured`: `messages` must end with a user turn; the assistant turn is prefilled with JSON."
+        )
+    instructions: str = templates.builtin("system", "structured").render(
+        schema=json.dumps(schema, indent=2)
+    )
+    full_system: str = f"{system}\n\n{instructions}" if system else instructions
+
+    prefix: str = "{"
+    error: Optional[str] = None
+    for attempt in range(max_retries + 1):
+        attempt_system: str = full_system
+        if error is not None:
+            attempt_system += f"\nYour previous output was rejected: {error}\n"
+        scanner = _ObjectScanner(schema=schema, text=prefix)
+        async for event in astream(
+            messages=respond(
+                content=prefix, messages=list(constructed_messages), role="assistant"
+            ),
+            system=attempt_system,
+            model=model,
+            api_key=api_key,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            **kwargs,
+        ):
+            if event.type == "text" and (
+                scanner.feed(event.text) is not None or scanner.done
+            ):
+                break  # NOTE: Leaving the loop closes the HTTP stream.
+        if scanner.done and scanner.error is None:
+            return _build(spec, scanner.data)
+        error = scanner.error or "output ended before the JSON object was closed"
+        red(var=f"`agen_structured`: attempt {attempt + 1} failed: {error}")
+        prefix = scanner.text[: scanner.valid_end].rstrip()
+    raise ValueError(
+        f"`agen_structured`: no valid output after {max_retries + 1} attempts. Last error: {error}"
+    )
+
+
+def gen_structured(
+    spec: Union[Type[T], Dict[str, Any]],
+    user: Optional[str] = None,
+    messages: Optional[List[MessageParam]] = None,
+    system: str = "",
+    model: str = globals.DEFAULT_MODEL,
+    api_key: Optional[str] = None,
+    max_tokens=1024,
+    temperature=1.0,
+    max_retries: int = 2,
+    **kwargs: Any,
+) -> Any:
+    """Sync version of `agen_structured`. Runs on the shared background event loop (see `alana.loop`).
+
+    Example:
+        >>> @dataclass
+        ... class City:
+        ...     name: str
+        ...     population: int
+        >>> gen_structured(City, user="Biggest city in France?")
+        City(name='Paris', population=2102650)
+    """
+    from alana.loop import run
+
+    return run(
+        agen_structured(
+            spec=spec,
+            user=user,
+            messages=messages,
+            system=system,
+            model=model,
+            api_key=api_key,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            max_retries=max_retries,
+            **kwargs,
+        )
+    )
@@ -0,0 +1,501 @@
+import re
+import mmap
+import functools
+from array import array
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Match,
+    Optional,
+    Pattern,
+    Tuple,
+    Union,
+)
+
+import numpy as np
+
+# Single-pass XML-ish tag scanner for model output. Not a full XML parser: it only finds tags and pairs them up.
+# Every pattern here is free of nested quantifiers and can't match across "<", so a scan is linear in the input
+# (the old `<tag>(.*?)</tag>` regex rescans to the end of the string for every unclosed opening tag).
+
+_NAME: str = r"[A-Za-z_][\w.:-]*"
+# NOTE: `(?<!\S)` only tries attribute names at the start of a word, which keeps long unquoted junk linear too.
+_ATTR: Pattern = re.compile(
+    r"""(?<!\S)([^\s=/"']+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'/]+))"""
+)
+_PARTIAL_TAG: Pattern = re.compile(r"</?(?:[A-Za-z_][^<>]*)?")
+_PARTIAL_TAG_BYTES: Pattern = re.compile(_PARTIAL_TAG.pattern.encode())
+
+# What the scanner runs over: a string, or raw bytes (`bytes`, `bytearray`, `mmap.mmap`) scanned without decoding.
+Document = Union[str, bytes, bytearray, mmap.mmap]
+
+
+@dataclass(frozen=True)
+class Tag:
+    """One tag token. `kind` is "open", "close" or "self" (self-closing). `start`/`end` span the whole `<...>`."""
+
+    kind: str
+    name: str
+    start: int
+    end: int
+    attrs: Dict[str, str] = field(default_factory=dict, compare=False)
+
+
+@dataclass(frozen=True)
+class Element:
+    """A matched element. `start`/`end` span the tags too; `content_start`/`content_end` span what's between them.
+
+    `closed` is False for an unclosed element (lenient mode), which then runs to the end of the text.
+    """
+
+    name: str
+    start: int
+    end: int
+    content_start: int
+    content_end: int
+    attrs: Dict[str, str] = field(default_factory=dict, compare=False)
+    closed: bool = True
+    depth: int = 0
+
+
+def parse_attrs(text: str) -> Dict[str, str]:
+    """`' id="3" kind=x'` -> `{"id": "3", "kind": "x"}`."""
+    return {
+        m.group(1): next(g for g in m.groups()[1:] if g is not None)
+        for m in _ATTR.finditer(text)
+    }
+
+
+@functools.lru_cache(maxsize=256)
+def _tag_pattern(name: Optional[str], binary: bool = False) -> Pattern:
+    tag_name: str = _NAME if name is None else re.escape(name)
+    pattern: str = rf"<(/?)({tag_name})(?=[\s/>])([^<>]*)>"
+    return re.compile(pattern.encode() if binary else pattern)
+
+
+def _check_name(tag: str) -> None:
+    if tag.count("<") > 0 or tag.count(">") > 0:
+        raise ValueError("No '>' or '<' allowed in get_xml tag name!")
+
+
+def tokenize(text: str, tag: Optional[str] = None) -> Iterator[Tag]:
+    """Yield the tags in `text` in order (only those named `tag`, if given). Linear time."""
+    for match in _tag_pattern(tag).finditer(text):
+        closing, name, rest = match.groups()
+        self_closing: bool = rest.endswith("/")
+        if self_closing:
+            rest = rest[:-1]
+        yield Tag(
+            kind="close" if closing else "self" if self_closing else "open",
+            name=name,
+            start=match.start(),
+            end=match.end(),
+            attrs=parse_attrs(rest) if rest.strip() and not closing else {},
+        )
+
+
+def _truncated_end(text: Document) -> int:
+    """End of `text` without a trailing partial tag (e.g. "...</answ" from `max_tokens` truncation)."""
+    if isinstance(text, str):
+        last_open: int = text.rfind("<")
+        partial: Pattern = _PARTIAL_TAG
+        after: int = text.rfind(">")
+    else:
+        last_open = text.rfind(b"<")
+        partial = _PARTIAL_TAG_BYTES
+        after = text.rfind(b">")
+    if last_open > after and partial.fullmatch(text, last_open):
+        return last_open
+    return len(text)
+
+
+# (start, end, content_start, content_end, attribute text, closed, depth)
+_Span = Tuple[int, int, int, int, str, bool, int]
+
+
+def _spans(
+    tag: str,
+    text: Document,
+    lenient: bool,
+    self_closing: bool,
+    nested: bool,
+    matches: Optional[Iterable[Match]] = None,
+) -> List[_Span]:
+    """The matching behind `elements`, on plain tuples (this is the hot path of `get_xml`).
+
+    `matches` are the `<tag>`/`</tag>` matches in order, if already known (see `XmlIndex`); by default `text` is scanned.
+    """
+    _check_name(tag)
+    found: List[_Span] = []
+    # Each frame: (opening match, spans completed directly inside it).
+    stack: List[Tuple[Match, List[_Span]]] = []
+    binary: bool = not isinstance(text, str)
+    slash: Any = b"/" if binary else "/"
+    if matches is None:
+        matches = _tag_pattern(tag, binary).finditer(text)
+    for match in matches:
+        if match.group(1):  # Closing tag.
+            if not stack:
+                continue  # Stray closing tag.
+            opening, children = stack.pop()
+            siblings: List[_Span] = stack[-1][1] if stack else found
+            siblings.append(
+                (
+                    opening.start(),
+                    match.end(),
+                    opening.end(),
+                    match.start(),
+                    opening.group(3),
+                    True,
+                    len(stack),
+                )
+            )
+            if nested:
+                siblings.extend(children)
+        elif match.group(3).endswith(slash):
+            if self_closing:
+                (stack[-1][1] if stack else found).append(
+                    (
+                        match.start(),
+                        match.end(),
+                        match.end(),
+                        match.end(),
+                        match.group(3)[:-1],
+                        True,
+                        len(stack),
+                    )
+                )
+        else:
+            stack.append((match, []))
+    if stack:
+        if lenient:
+            opening = stack[0][0]
+            end: int = _truncated_end(text)
+            found.append(
+                (
+                    opening.start(),
+                    end,
+                    min(opening.end(), end),
+                    end,
+                    opening.group(3),
+                    False,
+                    0,
+                )
+            )
+            if nested:
+                found.extend(span for _, children in stack for span in children)
+        else:
+            for _, children in stack:
+                found.extend(children)
+    if nested:
+        found.sort()
+    return found
+
+
+def elements(
+    tag: str,
+    text: str,
+    lenient: bool = False,
+    self_closing: bool = False,
+    nested: bool = False,
+) -> List[Element]:
+    """Find the `<tag>...</tag>` elements in `text` in one pass, pairing nested same-name tags correctly.
+
+    Args:
+        tag (str): Tag name.
+        text (str): Text to scan.
+        lenient (bool, optional): An opening tag that is never closed yields an element running to the end of the text
+            (minus any trailing partial tag). Otherwise it is ignored, and elements inside it are returned. Defaults to False.
+        self_closing (bool, optional): Also return `<tag/>` as an empty element. Defaults to False, since models
+            usually write `<tag/>` to *mention* a tag.
+        nested (bool, optional): Also return elements nested inside other `<tag>` elements. Defaults to False (outermost only).
+
+    Returns:
+        List[Element]: In document order (by start).
+    """
+    return [
+        Element(
+            name=tag,
+            start=start,
+            end=end,
+            content_start=content_start,
+            content_end=content_end,
+            attrs=parse_attrs(attrs) if attrs.strip() else {},
+            closed=closed,
+            depth=depth,
+        )
+        for start, end, content_start, content_end, attrs, closed, depth in _spans(
+            tag, text, lenient, self_closing, nested
+        )
+    ]
+
+
+def extract(
+    tag: str,
+    text: str,
+    lenient: bool = False,
+    self_closing: bool = False,
+    nested: bool = False,
+) -> List[str]:
+    """Contents of the `<tag/>` elements in `text`. See `elements` for the options."""
+    return [
+        text[span[2] : span[3]]
+        for span in _spans(tag, text, lenient, self_closing, nested)
+    ]
+
+
+def remove(tag: str, text: str, repl: str = "", lenient: bool = False) -> str:
+    """`text` with each outermost `<tag/>` element (tags and content) replaced by `repl`."""
+    parts: List[str] = []
+    position: int = 0
+    for start, end, _, _, _, closed, _ in _spans(tag, text, lenient, False, False):
+        parts.append(text[position:start])
+        parts.append(repl)
+        position = end if closed else len(text)
+    parts.append(text[position:])
+    return "".join(parts)
+
+
+class Spans:
+    """The elements of one tag in an `XmlIndex`, as arrays of offsets. Nothing is read from the document until asked.
+
+    Index, slice or mask it like a numpy array (`spans[0]` is an `Element`; `spans[1:]` and
+    `spans[spans.lengths > 100]` are `Spans`). Offsets are characters for a `str` document and bytes otherwise.
+    """
+
+    def __init__(self, index: "XmlIndex", tag: str, rows: np.ndarray) -> None:
+        self.index: XmlIndex = index
+        self.tag: str = tag
+        # One row per element: start, end, content_start, content_end, closed, depth.
+        self.rows: np.ndarray = rows
+
+    @property
+    def starts(self) -> np.ndarray:
+        return self.rows[:, 0]
+
+    @property
+    def ends(self) -> np.ndarray:
+        return self.rows[:, 1]
+
+    @property
+    def content_starts(self) -> np.ndarray:
+        return self.rows[:, 2]
+
+    @property
+    def content_ends(self) -> np.ndarray:
+        return self.rows[:, 3]
+
+    @property
+    def depths(self) -> np.ndarray:
+        return self.rows[:, 5]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Content lengths."""
+        return self.rows[:, 3] - self.rows[:, 2]
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, key: Any) -> Any:
+        if isinstance(key, (int, np.integer)):
+            return self.element(int(key))
+        return Spans(self.index, self.tag, self.rows[key])
+
+    def __iter__(self) -> Iterator[Element]:
+        return (self.element(i) for i in range(len(self.rows)))
+
+    def __repr__(self) -> str:
+        return f"Spans(tag={self.tag!r}, n={len(self.rows)})"
+
+    def element(self, i: int) -> Element:
+        """The `i`th element, with its attributes parsed."""
+        start, end, content_start, content_end, closed, depth = self.rows[i].tolist()
+        attrs: Any = _tag_pattern(self.tag, self.index.binary).match(
+            self.index.doc, start
+        )
+        attrs = attrs.group(3) if attrs else ""
+        if self.index.binary:
+            attrs = attrs.decode(self.index.encoding, errors="replace")
+        attrs = attrs.rstrip("/")
+        return Element(
+            name=self.tag,
+            start=start,
+            end=end,
+            content_start=content_start,
+            content_end=content_end,
+            attrs=parse_attrs(attrs) if attrs.strip() else {},
+            closed=bool(closed),
+            depth=depth,
+        )
+
+    def within(self, start: int, end: int) -> "Spans":
+        """The elements lying entirely inside `[start, end)`, e.g. another element's content span."""
+        return self[(self.rows[:, 0] >= start) & (self.rows[:, 1] <= end)]
+
+    def view(self, i: int) -> Union[str, memoryview]:
+        """Content of the `i`th element without copying, for a bytes/mmap document. A `str` document is sliced."""
+        return self.index.view(int(self.rows[i, 2]), int(self.rows[i, 3]))
+
+    def text(self, i: int) -> str:
+        """Content of the `i`th element, as a (decoded) string."""
+        return self.index.text(int(self.rows[i, 2]), int(self.rows[i, 3]))
+
+    def texts(self) -> List[str]:
+        """Contents of all the elements. This is what `get_xml` returns."""
+        return [self.index.text(s, e) for s, e in self.rows[:, 2:4].tolist()]
+
+    def filter(self, predicate: Callable[[str], bool]) -> "Spans":
+        """The elements whose content passes `predicate`. Reads each content once; keeps only offsets."""
+        return self[
+            np.fromiter(
+                (predicate(text) for text in map(self.text, range(len(self)))),
+                dtype=bool,
+                count=len(self),
+            )
+        ]
+
+
+class XmlIndex:
+    """Every tag in a document, found in one pass and stored as offsets, so queries don't rescan or copy the text.
+
+    Args:
+        doc (Document): A `str`, or `bytes`/`bytearray`/`mmap.mmap` to scan raw (see `XmlIndex.open`).
+        encoding (str, optional): Used to decode contents of a bytes document when they're materialized. Defaults to "utf-8".
+
+    Example:
+        >>> with XmlIndex.open("transcripts.txt") as index:
+        ...     answers = index.find("answer")
+        ...     print(len(answers), answers[answers.lengths > 1000].texts()[:3])
+
+    Notes:
+        - The index holds 8 bytes per tag. Elements are paired per tag name on first `find` and cached.
+        - Results match `get_xml`/`elements` on the same text (for a bytes document, tag names are matched as ASCII).
+        - Close (or drop) any `view`s before closing a mapped file.
+    """
+
+    def __init__(self, doc: Document, encoding: str = "utf-8") -> None:
+        self.doc: Document = doc
+        self.encoding: str = encoding
+        self.binary: bool = not isinstance(doc, str)
+        self._file: Any = None
+        self._offsets: Dict[Any, array] = {}
+        for match in _tag_pattern(None, self.binary).finditer(doc):
+            name: Any = match.group(2)
+            if name not in self._offsets:
+                self._offsets[name] = array("q")
+            self._offsets[name].append(match.start())
+        self._found: Dict[Tuple[str, bool, bool, bool], Spans] = {}
+
+    @classmethod
+    def open(cls, path: str, encoding: str = "utf-8") -> "XmlIndex":
+        """Index a file through a read-only memory map, without reading it into memory. Use as a context manager."""
+        f = open(path, "rb")
+        try:
+            doc: Document = (
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if f.seek(0, 2)
+                else b""  # Empty files can't be mapped.
+            )
+        except Exception:
+            f.close()
+            raise
+        index = cls(doc, encoding=encoding)
+        index._file = f
+        return index
+
+    def close(self) -> None:
+        """Unmap the file opened by `XmlIndex.open`."""
+        if isinstance(self.doc, mmap.mmap):
+            self.doc.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> "XmlIndex":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def tags(self) -> List[str]:
+        """Names of the tags in the document."""
+        return sorted(
+            name.decode(self.encoding) if self.binary else name
+            for name in self._offsets
+        )
+
+    def __contains__(self, tag: str) -> bool:
+        return self._key(tag) in self._offsets
+
+    def _key(self, tag: str) -> Any:
+        return tag.encode(self.encoding) if self.binary else tag
+
+    def find(
+        self,
+        tag: str,
+        lenient: bool = False,
+        self_closing: bool = False,
+        nested: bool = False,
+    ) -> Spans:
+        """The `<tag>...</tag>` elements, as `Spans`. Same options as `elements`."""
+        key: Tuple[str, bool, bool, bool] = (tag, lenient, self_closing, nested)
+        if key not in self._found:
+            _check_name(tag)
+            matches: Optional[Iterable[Match]] = None
+            if re.fullmatch(_NAME, tag, flags=re.ASCII if self.binary else 0):
+                pattern: Pattern = _tag_pattern(tag, self.binary)
+                matches = (
+                    pattern.match(self.doc, offset)
+                    for offset in self._offsets.get(self._key(tag), ())
+                )
+            # NOTE: Names the one-pass scan can't see (e.g. with spaces) fall back to scanning for just that tag.
+            spans: List[_Span] = _spans(
+                tag, self.doc, lenient, self_closing, nested, matches
+            )
+            self._found[key] = Spans(
+                self,
+                tag,
+                np.array(
+                    [span[:4] + span[5:] for span in spans], dtype=np.int64
+                ).reshape(-1, 6),
+            )
+        return self._found[key]
+
+    def count(self, tag: str, **options: bool) -> int:
+        """`len(find(tag, **options))`."""
+        return len(self.find(tag, **options))
+
+    def view(self, start: int, end: int) -> Union[str, memoryview]:
+        """`doc[start:end]`, without copying for a bytes/mmap document."""
+        if self.binary:
+            return memoryview(self.doc)[start:end]
+        return self.doc[start:end]  # type: ignore
+
+    def text(self, start: int, end: int) -> str:
+        """`doc[start:end]` as a string."""
+        if self.binary:
+            return self.doc[start:end].decode(self.encoding, errors="replace")  # type: ignore
+        return self.doc[start:end]  # type: ignore
+
+    def without(
+        self, tag: str, repl: str = "", lenient: bool = False
+    ) -> Iterator[Union[str, memoryview]]:
+        """The document with each outermost `<tag/>` element replaced by `repl`, as a stream of pieces (views for a
+        bytes document, with `repl` encoded). Write them out to get `remove_xml`'s result without building it in memory.
+        """
+        replacement: Any = repl.encode(self.encoding) if self.binary else repl
+        position: int = 0
+        for start, end, _, _, closed, _ in self.find(
+            tag, lenient=lenient
+        ).rows.tolist():
+            yield self.view(position, start)
+            if replacement:
+                yield replacement
+            position = end if closed else len(self.doc)
+        yield self.view(position, len(self.doc))
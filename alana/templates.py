@@ -0,0 +1,217 @@
+import os
+import re
+import string
+import functools
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
+
+from alana import globals
+
+# Compiled prompt templates. A template is parsed once into literal segments and variable slots, so rendering is a
+# single list fill + join, and missing/extra variables are caught before any API call.
+
+# Variables of the built-in `globals.SYSTEM`/`globals.USER` prompts. Braces that aren't listed stay literal
+# (e.g. the JSON in the pretty_print examples, or `{input_data}` in the gen_prompt instructions).
+BUILTIN_VARIABLES: Dict[Tuple[str, str], Tuple[str, ...]] = {
+    ("system", "few_shot"): ("n_examples",),
+    ("system", "gen_prompt"): (),
+    ("system", "pretty_print"): (),
+    ("system", "structured"): ("schema",),
+    ("system", "judge"): (),
+    ("user", "few_shot"): ("instruction",),
+    ("user", "gen_prompt"): ("instruction",),
+    ("user", "pretty_print"): ("var",),
+    ("user", "batch"): ("n", "items"),
+    ("user", "optimize"): ("instruction", "score", "system", "user", "feedback"),
+    ("user", "judge"): ("criteria", "input", "output"),
+    ("user", "map"): ("chunk", "instruction"),
+    ("user", "reduce"): ("results", "instruction"),
+}
+
+
+class Template:
+    """A prompt template compiled into literal segments and variable slots.
+
+    Args:
+        source (str): The template text.
+        variables (Optional[Iterable[str]], optional): If given, only `{name}` placeholders for these names are variables
+            and every other brace is literal text (no `{{` escaping needed). If None, `str.format` syntax is used.
+
+    Example:
+        >>> t = Template("Summarize this JSON {like: this}: <data>{input_data}</data>", variables=["input_data"])
+        >>> t.render(input_data='{"a": 1}')
+        'Summarize this JSON {like: this}: <data>{"a": 1}</data>'
+    """
+
+    def __init__(self, source: str, variables: Optional[Iterable[str]] = None) -> None:
+        self.source: str = source
+        self._parts: List[str] = []
+        self._slots: List[Tuple[int, str, Optional[str], str]] = []
+        if variables is None:
+            for literal, field, spec, conversion in string.Formatter().parse(source):
+                if literal:
+                    self._parts.append(literal)
+                if field is not None:
+                    if not field.isidentifier():
+                        raise ValueError(
+                            f"`Template`: only plain names are supported as placeholders, got {{{field}}}."
+                        )
+                    self._add_slot(field, conversion, spec or "")
+        else:
+            names: List[str] = sorted(set(variables), key=len, reverse=True)
+            position: int = 0
+            if names:
+                pattern = re.compile(
+                    r"\{("
+                    + "|".join(map(re.escape, names))
+                    + r")(?:!([rsa]))?(?::([^{}]*))?\}"
+                )
+                for match in pattern.finditer(source):
+                    if match.start() > position:
+                        self._parts.append(source[position : match.start()])
+                    self._add_slot(match.group(1), match.group(2), match.group(3) or "")
+                    position = match.end()
+            if position < len(source):
+                self._parts.append(source[position:])
+        self.variables: FrozenSet[str] = frozenset(
+            name for _, name, _, _ in self._slots
+        )
+        first_slot: int = self._slots[0][0] if self._slots else len(self._parts)
+        self.static_prefix: str = "".join(self._parts[:first_slot])
+
+    def _add_slot(self, name: str, conversion: Optional[str], spec: str) -> None:
+        self._slots.append((len(self._parts), name, conversion, spec))
+        self._parts.append("")
+
+    def check(self, values: Dict[str, Any]) -> None:
+        """Raise ValueError if `values` is missing a variable or has one the template doesn't use."""
+        missing: FrozenSet[str] = self.variables - values.keys()
+        extra: FrozenSet[str] = values.keys() - self.variables
+        if missing or extra:
+            raise ValueError(
+                f"`Template`: missing variables {sorted(missing)}, unexpected variables {sorted(extra)}."
+            )
+
+    def render(self, **values: Any) -> str:
+        """Fill in the variables. Raises ValueError on missing or unexpected variables."""
+        self.check(values)
+        parts: List[str] = self._parts.copy()
+        for index, name, conversion, spec in self._slots:
+            value: Any = values[name]
+            if conversion == "r":
+                value = repr(value)
+            elif conversion == "a":
+                value = ascii(value)
+            parts[index] = (
+                value if type(value) is str and not spec else format(value, spec)
+            )
+        return "".join(parts)
+
+    __call__ = render
+
+    def blocks(self, **values: Any) -> List[Dict[str, Any]]:
+        """Render as content blocks (e.g. for `system=`), marking the static prefix with `cache_control` for prompt caching."""
+        text: str = self.render(**values)
+        prefix: str = self.static_prefix
+        if not prefix:
+            return [{"type": "text", "text": text}]
+        blocks: List[Dict[str, Any]] = [
+            {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}}
+        ]
+        if len(text) > len(prefix):
+            blocks.append({"type": "text", "text": text[len(prefix) :]})
+        return blocks
+
+    def __repr__(self) -> str:
+        return f"Template(variables={sorted(self.variables)}, source={self.source[:40]!r}...)"
+
+
+@functools.lru_cache(maxsize=256)
+def _compile(source: str, variables: Optional[Tuple[str, ...]]) -> Template:
+    return Template(source, variables=variables)
+
+
+def compile_template(
+    source: str, variables: Optional[Iterable[str]] = None
+) -> Template:
+    """A cached `Template(source, variables)`: each distinct template is parsed once."""
+    return _compile(source, None if variables is None else tuple(sorted(variables)))
+
+
+def builtin(kind: str, name: str) -> Template:
+    """The compiled `globals.SYSTEM[name]` (kind="system") or `globals.USER[name]` (kind="user").
+
+    Reads the globals on every call, so edits to `globals.SYSTEM`/`globals.USER` take effect (and are compiled once).
+    """
+    prompts: Dict[Any, str] = globals.SYSTEM if kind == "system" else globals.USER
+    return compile_template(prompts[name], variables=BUILTIN_VARIABLES.get((kind, name)))  # type: ignore
+
+
+class Registry:
+    """Named templates, registered from strings or loaded from files. File templates are reloaded when the file changes."""
+
+    def __init__(self) -> None:
+        self._templates: Dict[str, Template] = {}
+        self._files: Dict[str, Tuple[str, Optional[Tuple[str, ...]], float]] = {}
+
+    def register(
+        self,
+        name: str,
+        template: Union[str, Template],
+        variables: Optional[Iterable[str]] = None,
+    ) -> Template:
+        """Register a template (or template source) under `name`."""
+        if isinstance(template, str):
+            template = Template(template, variables=variables)
+        self._templates[name] = template
+        self._files.pop(name, None)
+        return template
+
+    def load(
+        self,
+        path: str,
+        name: Optional[str] = None,
+        variables: Optional[Iterable[str]] = None,
+    ) -> Template:
+        """Register the template in `path` under `name` (default: the file name without extension)."""
+        name = name or os.path.splitext(os.path.basename(path))[0]
+        self._files[name] = (
+            path,
+            None if variables is None else tuple(variables),
+            -1.0,
+        )
+        return self.get(name)
+
+    def load_dir(
+        self, directory: str, extensions: Tuple[str, ...] = (".txt", ".md", ".prompt")
+    ) -> List[str]:
+        """`load` every template file in `directory`. Returns the registered names."""
+        names: List[str] = []
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(extensions):
+                names.append(os.path.splitext(filename)[0])
+                self.load(os.path.join(directory, filename), name=names[-1])
+        return names
+
+    def get(self, name: str) -> Template:
+        """The template registered as `name`, re-read first if its file has changed."""
+        if name in self._files:
+            path, variables, loaded_mtime = self._files[name]
+            mtime: float = os.stat(path).st_mtime
+            if mtime != loaded_mtime:
+                with open(path, encoding="utf-8") as f:
+                    self._templates[name] = Template(f.read(), variables=variables)
+                self._files[name] = (path, variables, mtime)
+        return self._templates[name]
+
+    def render(self, template_name: str, /, **values: Any) -> str:
+        """`get(template_name).render(**values)`."""
+        return self.get(template_name).render(**values)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._templates or name in self._files
+
+    def names(self) -> List[str]:
+        return sorted(set(self._templates) | set(self._files))
+
+
+TEMPLATES = Registry()
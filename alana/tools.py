@@ -0,0 +1,299 @@
+import json
+import asyncio
+import inspect
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from anthropic.types import Message, MessageParam
+
+from alana import globals
+from alana.color import red
+from alana.prompt import (
+    gen_msg,
+    respond,
+    _append_assistant_message,
+    _construct_messages,
+    _get_text,
+)
+from alana.structured import schema_of
+
+# Tool-use loop: let Claude call plain Python functions until it produces a final answer.
+
+
+def tool(
+    fn: Optional[Callable] = None,
+    *,
+    pure: bool = False,
+    name: Optional[str] = None,
+    description: Optional[str] = None,
+) -> Any:
+    """Decorator to customize how a function is exposed as a tool. Plain functions work as tools without it.
+
+    Args:
+        pure (bool, optional): The function has no side effects and depends only on its arguments, so results are cached per input. Defaults to False.
+        name (Optional[str], optional): Tool name. Defaults to `fn.__name__`.
+        description (Optional[str], optional): Tool description. Defaults to `fn.__doc__`.
+
+    Example:
+        >>> @tool(pure=True)
+        ... def add(a: int, b: int) -> int:
+        ...     \"\"\"Add two integers.\"\"\"
+        ...     return a + b
+    """
+
+    def decorate(fn: Callable) -> Callable:
+        fn._alana_tool = {"pure": pure, "name": name, "description": description}  # type: ignore
+        return fn
+
+    return decorate if fn is None else decorate(fn)
+
+
+def tool_schema(fn: Callable) -> Dict[str, Any]:
+    """Return the Anthropic tool definition (name, description, input_schema) for `fn`, generated from its signature."""
+    options: Dict[str, Any] = getattr(fn, "_alana_tool", {})
+    hints: Dict[str, Any] = typing.get_type_hints(fn)
+    properties: Dict[str, Any] = {}
+    required: List[str] = []
+    for param in inspect.signature(fn).parameters.values():
+        if param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+            continue
+        properties[param.name] = schema_of(hints.get(param.name, Any))
+        if param.default is param.empty:
+            required.append(param.name)
+    return {
+        "name": options.get("name") or fn.__name__,
+        "description": options.get("description") or inspect.getdoc(fn) or fn.__name__,
+        "input_schema": {
+            "type": "object",
+            "properties": properties,
+            "required": required,
+        },
+    }
+
+
+def _registry(
+    tools: Sequence[Callable],
+) -> Tuple[List[Dict[str, Any]], Dict[str, Callable]]:
+    schemas: List[Dict[str, Any]] = [tool_schema(fn) for fn in tools]
+    return schemas, {schema["name"]: fn for schema, fn in zip(schemas, tools)}
+
+
+def _cache_key(block: Any) -> Tuple[str, str]:
+    return (block.name, json.dumps(block.input, sort_keys=True, default=str))
+
+
+def _tool_result(block: Any, result: Any = None, error: Optional[BaseException] = None):
+    if error is not None:
+        return {
+            "type": "tool_result",
+            "tool_use_id": block.id,
+            "content": f"{type(error).__name__}: {error}",
+            "is_error": True,
+        }
+    return {
+        "type": "tool_result",
+        "tool_use_id": block.id,
+        "content": (
+            result if isinstance(result, str) else json.dumps(result, default=str)
+        ),
+    }
+
+
+def _tool_use_blocks(output: Message) -> List[Any]:
+    return [block for block in output.content if block.type == "tool_use"]
+
+
+def run_tools(
+    blocks: Sequence[Any],
+    functions: Dict[str, Callable],
+    cache: Optional[Dict[Tuple[str, str], Any]] = None,
+    max_workers: int = 8,
+) -> List[Dict[str, Any]]:
+    """Run the tool_use `blocks` from one assistant turn concurrently in a thread pool. Returns `tool_result` blocks in order.
+
+    Results of `pure` tools are looked up in / stored to `cache`. Exceptions become `is_error` results.
+    """
+    cache = {} if cache is None else cache
+
+    def call(block: Any) -> Dict[str, Any]:
+        fn: Optional[Callable] = functions.get(block.name)
+        if fn is None:
+            return _tool_result(block, error=KeyError(f"unknown tool {block.name!r}"))
+        pure: bool = getattr(fn, "_alana_tool", {}).get("pure", False)
+        key: Tuple[str, str] = _cache_key(block)
+        if pure and key in cache:
+            return _tool_result(block, result=cache[key])
+        try:
+            result: Any = fn(**block.input)
+            if inspect.isawaitable(result):
+                # NOTE: Calls only run inline when this thread has no running loop (see below), so this is safe.
+                result = asyncio.run(result)
+        except Exception as e:
+            return _tool_result(block, error=e)
+        if pure:
+            cache[key] = result
+        return _tool_result(block, result=result)
+
+    # NOTE: A running loop here means e.g. Jupyter, or sync `gen_tools` called from async code.
+    try:
+        asyncio.get_running_loop()
+        in_loop: bool = True
+    except RuntimeError:
+        in_loop = False
+    if len(blocks) <= 1 and not in_loop:
+        return [call(block) for block in blocks]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(blocks)))) as pool:
+        return list(pool.map(call, blocks))
+
+
+async def arun_tools(
+    blocks: Sequence[Any],
+    functions: Dict[str, Callable],
+    cache: Optional[Dict[Tuple[str, str], Any]] = None,
+) -> List[Dict[str, Any]]:
+    """Async version of `run_tools`. Coroutine functions are awaited; sync functions run in threads via `asyncio.to_thread`."""
+    cache = {} if cache is None else cache
+
+    async def call(block: Any) -> Dict[str, Any]:
+        fn: Optional[Callable] = functions.get(block.name)
+        if fn is None:
+            return _tool_result(block, error=KeyError(f"unknown tool {block.name!r}"))
+        pure: bool = getattr(fn, "_alana_tool", {}).get("pure", False)
+        key: Tuple[str, str] = _cache_key(block)
+        if pure and key in cache:
+            return _tool_result(block, result=cache[key])
+        try:
+            if inspect.iscoroutinefunction(fn):
+                result: Any = await fn(**block.input)
+            else:
+                result = await asyncio.to_thread(fn, **block.input)
+        except Exception as e:
+            return _tool_result(block, error=e)
+        if pure:
+            cache[key] = result
+        return _tool_result(block, result=result)
+
+    return list(await asyncio.gather(*(call(block) for block in blocks)))
+
+
+def gen_tools(
+    user: Optional[str] = None,
+    tools: Sequence[Callable] = (),
+    messages: Optional[List[MessageParam]] = None,
+    system: str = "",
+    model: str = globals.DEFAULT_MODEL,
+    api_key: Optional[str] = None,
+    max_tokens=1024,
+    temperature=1.0,
+    max_iterations: int = 8,
+    cache: Optional[Dict[Tuple[str, str], Any]] = None,
+    loud=True,
+    **kwargs: Any,
+) -> str:
+    """Run a tool-use loop: call Claude, run any requested tools, send back the results, repeat.
+
+    Args:
+        user (Optional[str], optional): The user's message content. Defaults to None.
+        tools (Sequence[Callable]): Python functions to expose as tools. Schemas are generated from type hints and docstrings (see `tool`).
+        messages (Optional[List[MessageParam]], optional): A list of `anthropic.types.MessageParam`. Assistant turns and `tool_result` turns are appended to it. Defaults to None.
+        system (str, optional): The system message for Claude. Defaults to "".
+        model (str, optional): The name of the model to use. Defaults to globals.DEFAULT_MODEL.
+        api_key (Optional[str], optional): The API key to use for authentication. Defaults to None.
+        max_tokens (int, optional): The maximum number of tokens to generate per turn. Defaults to 1024.
+        temperature (float, optional): The temperature value for controlling the randomness of the generated response.
+        max_iterations (int, optional): Maximum number of model calls. Defaults to 8.
+        cache (Optional[Dict], optional): Cache for `pure` tool results. Pass the same dict to share it across runs. Defaults to None (fresh per run).
+        loud (bool, optional): Whether to print verbose output. Defaults to True.
+        **kwargs: Additional keyword arguments to pass to `gen_msg` (e.g. `tool_choice`).
+
+    Returns:
+        str: The text of Claude's final response.
+
+    Notes:
+        - All tool_use blocks from one assistant turn are independent, so they run concurrently in a thread pool.
+        - If `max_iterations` is reached while Claude still wants tools, we warn and return the last text.
+
+    Example:
+        >>> def get_weather(city: str) -> str:
+        ...     \"\"\"Get the current weather in a city.\"\"\"
+        ...     return "Sunny, 24C"
+        >>> gen_tools(user="What's the weather in Paris?", tools=[get_weather])
+        "It's sunny and 24C in Paris."
+    """
+    schemas, functions = _registry(tools)
+    constructed_messages: List[MessageParam] = _construct_messages(
+        user_message=user, messages=messages
+    )
+    cache = {} if cache is None else cache
+    for _ in range(max_iterations):
+        output: Message = gen_msg(
+            messages=constructed_messages,
+            system=system,
+            model=model,
+            api_key=api_key,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            loud=loud,
+            tools=schemas,
+            **kwargs,
+        )
+        _append_assistant_message(messages=constructed_messages, output=output)
+        blocks: List[Any] = _tool_use_blocks(output)
+        if output.stop_reason != "tool_use" or not blocks:
+            return _get_text(output)
+        respond(
+            content=run_tools(blocks=blocks, functions=functions, cache=cache),
+            messages=constructed_messages,
+            role="user",
+        )
+    red(var=f"`gen_tools`: Stopped after {max_iterations=} with tool calls pending.")
+    return _get_text(output)
+
+
+async def agen_tools(
+    user: Optional[str] = None,
+    tools: Sequence[Callable] = (),
+    messages: Optional[List[MessageParam]] = None,
+    system: str = "",
+    model: str = globals.DEFAULT_MODEL,
+    api_key: Optional[str] = None,
+    max_tokens=1024,
+    temperature=1.0,
+    max_iterations: int = 8,
+    cache: Optional[Dict[Tuple[str, str], Any]] = None,
+    stream_action: Optional[Callable] = None,
+    loud=False,
+    **kwargs: Any,
+) -> str:
+    """Experimental. Async version of `gen_tools`. Tools from one turn run concurrently with `asyncio.gather`."""
+    from alana.prompt_async import agen_msg
+
+    schemas, functions = _registry(tools)
+    constructed_messages: List[MessageParam] = _construct_messages(
+        user_message=user, messages=messages
+    )
+    cache = {} if cache is None else cache
+    for _ in range(max_iterations):
+        output: Message = await agen_msg(
+            messages=constructed_messages,
+            system=system,
+            model=model,
+            api_key=api_key,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream_action=stream_action,
+            loud=loud,
+            tools=schemas,
+            **kwargs,
+        )
+        _append_assistant_message(messages=constructed_messages, output=output)
+        blocks: List[Any] = _tool_use_blocks(output)
+        if output.stop_reason != "tool_use" or not blocks:
+            return _get_text(output)
+        respond(
+            content=await arun_tools(blocks=blocks, functions=functions, cache=cache),
+            messages=constructed_messages,
+            role="user",
+        )
+    red(var=f"`agen_tools`: Stopped after {max_iterations=} with tool calls pending.")
+    return _get_text(output)
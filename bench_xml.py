@@ -0,0 +1,41 @@
+"""Benchmark `get_xml` (linear-time tag scanner) against the old `<tag>(.*?)</tag>` regex on adversarial inputs.
+
+Run with `python bench_xml.py`. The old regex is quadratic when many opening tags are never closed.
+"""
+
+import re
+import time
+from typing import Callable, List
+
+from alana import get_xml, get_xml_pattern
+
+
+def old_get_xml(tag: str, content: str) -> List[str]:
+    return re.findall(get_xml_pattern(tag=tag), content, flags=re.DOTALL)
+
+
+def best_of(fn: Callable[[], object], repeat: int = 3) -> float:
+    times: List[float] = []
+    for _ in range(repeat):
+        start: float = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+CASES = {
+    "unclosed opens": lambda n: "<answer>x " * n,
+    "unclosed + one close": lambda n: "<answer>x " * n + "</answer>",
+    "many closed": lambda n: "<answer>x</answer> " * n,
+    "stray '<'": lambda n: "a < b " * n,
+    "long attribute junk": lambda n: "<answer " + "k" * (10 * n),
+}
+
+if __name__ == "__main__":
+    print(f"{'case':<22}{'n':>8}{'old (s)':>12}{'new (s)':>12}")
+    for name, make in CASES.items():
+        for n in (1_000, 4_000, 16_000):
+            text: str = make(n)
+            old: float = best_of(lambda: old_get_xml("answer", text))
+            new: float = best_of(lambda: get_xml("answer", text))
+            print(f"{name:<22}{n:>8}{old:>12.4f}{new:>12.4f}")
@@ -1,4 +1,9 @@
 from typing import List
+import os
+import json
+import math
+import asyncio
+import tempfile
 import unittest
 from unittest.mock import patch
 from anthropic.types import Message, MessageParam, ContentBlock, Usage
@@ -28,6 +33,496 @@ class TestFunctions(unittest.TestCase):
         with self.assertRaises(expected_exception=ValueError):
             remove_xml(tag="<tag>", content=content)
 
+    def test_xml_tokenizer(self):
+        """Check nesting, attributes, self-closing and unclosed tags in the tag scanner behind `get_xml`."""
+        self.assertEqual(
+            first=get_xml(tag="t", content="<t>a<t>b</t>c</t><t>d</t>"),
+            second=["a<t>b</t>c", "d"],
+        )
+        self.assertEqual(
+            first=get_xml(tag="example", content='<example id="3">x</example>'),
+            second=["x"],
+        )
+        self.assertEqual(
+            first=get_xml(
+                tag="answer", content="Use <answer/> tags. <answer>42</answer>"
+            ),
+            second=["42"],
+        )
+        truncated = "<a>1</a><a>2<a>3</a"
+        self.assertEqual(first=get_xml(tag="a", content=truncated), second=["1"])
+        self.assertEqual(
+            first=get_xml(tag="a", content=truncated, lenient=True),
+            second=["1", "2<a>3"],
+        )
+        self.assertEqual(
+            first=remove_xml(tag="reasoning", content="<reasoning>hm", lenient=True),
+            second="",
+        )
+        elements = alana.tags.elements(
+            tag="t", text='<t k="v">a<t>b</t></t>', nested=True
+        )
+        self.assertEqual(first=[e.depth for e in elements], second=[0, 1])
+        self.assertEqual(first=elements[0].attrs, second={"k": "v"})
+
+    def test_xml_index(self):
+        """Check that `XmlIndex` spans match `get_xml`/`remove_xml`, over a string and over a memory-mapped file."""
+        text = '<a k="1">x<a>y</a></a> <b>z</b> <a>w</a>'
+        index = alana.tags.XmlIndex(text)
+        self.assertEqual(first=index.tags(), second=["a", "b"])
+        self.assertEqual(first=index.find("a").texts(), second=get_xml("a", text))
+        self.assertEqual(first=index.count("a", nested=True), second=3)
+        spans = index.find("a")
+        self.assertEqual(first=spans[0].attrs, second={"k": "1"})
+        self.assertEqual(first=spans[spans.lengths == 1].texts(), second=["w"])
+        self.assertEqual(
+            first=index.find("a", nested=True).within(0, 22).texts(),
+            second=["x<a>y</a>", "y"],
+        )
+        self.assertEqual(
+            first="".join(index.without("a")), second=remove_xml("a", text)
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "transcript.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            with alana.tags.XmlIndex.open(path) as mapped:
+                self.assertEqual(
+                    first=mapped.find("a").texts(), second=get_xml("a", text)
+                )
+                self.assertEqual(first=bytes(mapped.find("b").view(0)), second=b"z")
+
+    def test_embedding_cache(self):
+        """Check that `EmbeddingCache` only embeds strings it hasn't seen, and persists across instances."""
+        calls: List[List[str]] = []
+
+        def embed_fn(strings: List[str]):
+            calls.append(strings)
+            return alana.embed.hash_embed(strings, dim=16)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first = alana.embed.EmbeddingCache(cache_dir).embed(
+                strings=["a b", "c d", "a b"], embed_fn=embed_fn
+            )
+            self.assertEqual(first=first.shape, second=(3, 16))
+            self.assertEqual(first=calls, second=[["a b", "c d"]])
+            second = alana.embed.EmbeddingCache(cache_dir).embed(
+                strings=["c d", "e f"], embed_fn=embed_fn
+            )
+            self.assertEqual(first=calls[-1], second=["e f"])
+            self.assertEqual(first=second[0].tolist(), second=first[1].tolist())
+
+    def test_semantic_cache(self):
+        """Check `SemanticCache` hits, scopes, index rebuilds and persistence, and its use from `gen_msg`."""
+        from types import SimpleNamespace
+        from anthropic.types import TextBlock
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = alana.cache.SemanticCache(cache_dir, train_size=8)
+            for i in range(20):
+                cache.put(f"question number {i} about topic {i * 7}", str(i), scope="s")
+            self.assertEqual(first=cache.stats()["indexed"], second=17)
+            self.assertEqual(
+                first=cache.get("Question number 3 about topic 21?", scope="s"),
+                second="3",
+            )
+            self.assertIsNone(cache.get("question number 3 about topic 21", scope="t"))
+            self.assertIsNone(cache.get("something else entirely", scope="s"))
+            reloaded = alana.cache.SemanticCache(cache_dir)
+            self.assertEqual(first=len(reloaded), second=20)
+            self.assertEqual(
+                first=reloaded.get("question number 5 about topic 35", scope="s"),
+                second="5",
+            )
+            self.assertEqual(first=cache.stats()["hit_rate"], second=1 / 3)
+
+            calls: List[dict] = []
+
+            def create(**kwargs):
+                calls.append(kwargs)
+                return Message(
+                    id="msg",
+                    content=[TextBlock(text="Paris", type="text")],
+                    model="haiku",
+                    role="assistant",
+                    stop_reason="end_turn",
+                    type="message",
+                    usage=Usage(input_tokens=1, output_tokens=1),
+                )
+
+            client = SimpleNamespace(messages=SimpleNamespace(create=create))
+            with patch("alana.prompt._get_client", return_value=client):
+                for user in [
+                    "What is the capital of France?",
+                    "what is  the capital of france",
+                ]:
+                    text = gen(
+                        user=user, model="haiku", loud=False, semantic_cache=cache
+                    )
+                    self.assertEqual(first=text, second="Paris")
+                gen(
+                    user="What is the capital of France?",
+                    model="haiku",
+                    loud=False,
+                    semantic_cache=cache,
+                    max_tokens=5,
+                )
+            self.assertEqual(first=len(calls), second=2)
+
+    def test_gen_msg_scheduling_kwargs(self):
+        """Check that sync `gen_msg` drops `priority`/`tenant` without a scheduler, and takes the loop with one (offline)."""
+        from types import SimpleNamespace
+        from anthropic.types import TextBlock
+        from alana import scheduler
+
+        message = Message.model_construct(
+            content=[TextBlock.model_construct(text="ok", type="text")],
+            usage=Usage(input_tokens=1, output_tokens=1),
+        )
+        calls: List[dict] = []
+
+        def create(**kwargs):
+            calls.append(kwargs)
+            return message
+
+        async def fake_agen_msg(**kwargs):
+            calls.append(kwargs)
+            return message
+
+        client = SimpleNamespace(messages=SimpleNamespace(create=create))
+        with patch("alana.prompt._get_client", return_value=client):
+            gen_msg(user="Hi", loud=False, priority="batch", tenant="a")
+        self.assertNotIn(member="priority", container=calls[-1])
+        self.assertNotIn(member="tenant", container=calls[-1])
+        scheduler.configure(max_concurrency=2)
+        try:
+            with patch("alana.prompt_async.agen_msg", fake_agen_msg):
+                gen_msg(user="Hi", loud=False, priority="batch", tenant="a")
+        finally:
+            scheduler.disable()
+        self.assertEqual(first=calls[-1]["priority"], second="batch")
+        self.assertEqual(first=calls[-1]["tenant"], second="a")
+
+    def test_example_bank(self):
+        """Check `ExampleBank` retrieval, coverage fallback, removal, compaction and reload, and its use from `gen_examples_list`."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "examples.jsonl")
+            bank = alana.examples.ExampleBank(path)
+            bank.add(
+                "Write a haiku about autumn leaves.", ["red leaves fall", "crisp air"]
+            )
+            bank.add(
+                "Translate English to French.", ["hello -> bonjour", "cat -> chat"]
+            )
+            self.assertEqual(
+                first=bank.examples("write a haiku about autumn leaves", k=2),
+                second=["red leaves fall", "crisp air"],
+            )
+            self.assertIsNone(bank.examples("write a limerick about dogs", k=2))
+            self.assertIsNone(bank.examples("translate english to french", k=3))
+            bank.remove([0])
+            shared = alana.examples.ExampleBank(os.path.join(directory, "shared.jsonl"))
+            shared.remove(shared.add("Common task.", ["a", "b", "c"])[1:])
+            self.assertGreater(a=shared._idf("common"), b=0.0)
+            bank.add("Translate English to French.", ["cat -> chat"])
+            self.assertEqual(first=bank.compact(), second=3)
+            reloaded = alana.examples.ExampleBank(path)
+            self.assertEqual(first=len(reloaded), second=3)
+            self.assertEqual(
+                first=[hit.example for hit in reloaded.search("haiku autumn")],
+                second=["crisp air"],
+            )
+
+            calls: List[str] = []
+
+            def fake_gen(user, **kwargs):
+                calls.append(user)
+                return "<example>1</example><example>2</example>"
+
+            with patch("alana.prompt.gen", new=fake_gen):
+                for _ in range(2):
+                    examples = gen_examples_list(
+                        "Count to two.", n_examples=2, bank=reloaded
+                    )
+                    self.assertEqual(first=examples, second=["1", "2"])
+            self.assertEqual(first=len(calls), second=1)
+
+    def test_dedup(self):
+        """Check MinHash/LSH near-duplicate removal on lists, on files, and from `gen_examples_list`."""
+        words: List[str] = [f"word{i}" for i in range(40)]
+        base: str = " ".join(words)
+        near: str = " ".join(words[:-1] + ["other"])
+        distinct: str = " ".join(reversed(words))
+        self.assertEqual(
+            first=alana.dedup.dedup([base, distinct, near, base]),
+            second=[base, distinct],
+        )
+        self.assertEqual(
+            first=alana.dedup.dedup([base, near], threshold=0.99), second=[base, near]
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "in.jsonl")
+            target = os.path.join(directory, "out.jsonl")
+            with open(source, "w") as f:
+                for i, text in enumerate([base, near, distinct, near]):
+                    f.write(json.dumps({"id": i, "text": text}) + "\n")
+            self.assertEqual(
+                first=alana.dedup.dedup_file(
+                    source, target, field="text", batch_size=3
+                ),
+                second={"read": 4, "kept": 2},
+            )
+            with open(target) as f:
+                self.assertEqual(
+                    first=[json.loads(line)["id"] for line in f], second=[0, 2]
+                )
+
+        def fake_gen(user, **kwargs):
+            return f"<example>{base}</example><example>{near}</example><example>{distinct}</example>"
+
+        with patch("alana.prompt.gen", new=fake_gen):
+            self.assertEqual(
+                first=gen_examples_list("x", n_examples=3, dedup_threshold=0.8),
+                second=[base, distinct],
+            )
+
+    def test_client_pool(self):
+        """Check `ClientPool` balancing, rate-limit resting, ejection, and that `gen` leases from it (offline)."""
+        from types import SimpleNamespace
+        from anthropic.types import TextBlock
+
+        pool = alana.pool.ClientPool(["key-a", "key-b"], eject_after=2, cooldown=60)
+        a, b = pool.endpoints
+        with pool.lease() as first:
+            with pool.lease() as second:
+                self.assertEqual(first=(first, second), second=(a, b))
+            self.assertIs(pool.pick(), b)
+        pool.observe(a, 429, {"retry-after": "30"})
+        self.assertIs(pool.pick(), b)
+        pool.observe(b, 529, {})
+        pool.observe(b, 529, {})
+        self.assertEqual(
+            first=[e["healthy"] for e in pool.stats()], second=[False, False]
+        )
+        self.assertIs(pool.pick(), a)  # Rate-limited, but available sooner.
+        a.limited_until = b.ejected_until = 0.0
+
+        pool.strategy = "tokens"
+        pool.observe(a, 200, {"anthropic-ratelimit-tokens-remaining": "100"})
+        pool.observe(b, 200, {"anthropic-ratelimit-tokens-remaining": "5000"})
+        self.assertIs(pool.pick(), b)
+        with pool.lease(cost=4950):
+            self.assertIs(pool.pick(), a)
+
+        def create(**kwargs):
+            return Message(
+                id="msg",
+                content=[TextBlock(text="ok", type="text")],
+                model="haiku",
+                role="assistant",
+                stop_reason="end_turn",
+                type="message",
+                usage=Usage(input_tokens=1, output_tokens=1),
+            )
+
+        clients = {}
+
+        def client(self, endpoint):
+            return clients.setdefault(
+                endpoint.name,
+                SimpleNamespace(messages=SimpleNamespace(create=create)),
+            )
+
+        alana.pool.configure(["key-a", "key-b"])
+        try:
+            with patch("alana.pool.ClientPool.client", new=client):
+                for _ in range(3):
+                    self.assertEqual(first=gen(user="Hi", loud=False), second="ok")
+                explicit = SimpleNamespace(messages=SimpleNamespace(create=create))
+                with patch.dict("alana.prompt._CLIENTS", {"explicit": explicit}):
+                    gen(user="Hi", loud=False, api_key="explicit")
+            self.assertEqual(
+                first=[e["served"] for e in alana.pool.get_pool().stats()],
+                second=[2, 1],
+            )
+        finally:
+            alana.pool.disable()
+
+    def test_downsampling(self):
+        """Check that LTTB/min-max keep endpoints and extrema (unsigned too), and that block-mean pooling averages blocks."""
+        import numpy as np
+        from alana.color import _lttb, _minmax, _block_mean
+
+        x = np.arange(10_000, dtype=np.float32)
+        y = np.sin(x / 100).astype(np.float16)
+        y[1234] = 5
+        keep = _lttb(x=x, y=y, n_out=500)
+        self.assertEqual(first=len(keep), second=500)
+        self.assertEqual(first=(keep[0], keep[-1]), second=(0, 9999))
+        self.assertIn(member=1234, container=keep)
+        self.assertIn(member=1234, container=_minmax(y=y, n_out=500))
+        unsigned = np.array([5, 0, 3, 200, 1, 7, 9, 255], dtype=np.uint8)
+        self.assertEqual(
+            first=_minmax(y=unsigned, n_out=4).tolist(), second=[1, 3, 4, 7]
+        )
+        pooled, rows, cols = _block_mean(
+            array=np.ones((9, 7), dtype=np.float16), max_cells=9
+        )
+        self.assertEqual(first=pooled.dtype, second=np.float32)
+        self.assertEqual(
+            first=(rows.tolist(), cols.tolist()), second=([0, 3, 6], [0, 3, 6])
+        )
+        self.assertTrue(expr=np.allclose(pooled, 1.0))
+
+    def test_reserve_filename(self):
+        """Check that `reserve_filename` skips existing files and never hands out the same name twice."""
+        from alana.export import reserve_filename
+
+        with tempfile.TemporaryDirectory() as directory:
+            title = os.path.join(directory, "plot")
+            open(f"{title}.png", "w").close()
+            open(f"{title}_7.png", "w").close()
+            first: str = reserve_filename(title=title, extension=".png")
+            second: str = reserve_filename(title=title)
+            self.assertEqual(first=first, second=f"{title}_8.png")
+            self.assertEqual(first=second, second=f"{title}_9.png")
+            self.assertTrue(expr=os.path.exists(second))
+
+    def test_reserve_released_on_failure(self):
+        """Check that a failed figure write is reported, and its reserved file removed."""
+        from alana.export import export
+
+        class BrokenFigure:
+            def write_image(self, filename, **kwargs):
+                raise RuntimeError("renderer crashed")
+
+        with tempfile.TemporaryDirectory() as directory:
+            with patch("alana.color.red") as reported:
+                future = export(
+                    fig=BrokenFigure(), title=os.path.join(directory, "plot")
+                )
+                alana.export.wait()
+            with self.assertRaises(RuntimeError):
+                future.result(timeout=10)
+            self.assertEqual(first=os.listdir(directory), second=[])
+            self.assertIn(
+                member="renderer crashed", container=reported.call_args.kwargs["var"]
+            )
+
+    def test_templates(self):
+        """Check template compilation: restricted variables, validation, static prefix and file hot reload."""
+        from alana.templates import Registry, Template, builtin
+
+        template = Template(
+            'JSON like {"a": 1}: {input_data}', variables=["input_data"]
+        )
+        self.assertEqual(
+            first=template.render(input_data="{x}"), second='JSON like {"a": 1}: {x}'
+        )
+        self.assertEqual(first=template.static_prefix, second='JSON like {"a": 1}: ')
+        with self.assertRaises(expected_exception=ValueError):
+            template.render(input_data="x", extra="y")
+        self.assertEqual(
+            first=builtin("user", "few_shot").render(instruction="Hi"),
+            second=alana.globals.USER["few_shot"].format(instruction="Hi"),
+        )
+        self.assertEqual(
+            first=builtin("system", "gen_prompt").render(),
+            second=alana.globals.SYSTEM["gen_prompt"],
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "greet.txt")
+            with open(path, "w") as f:
+                f.write("Hello {name}")
+            registry = Registry()
+            registry.load(path)
+            self.assertEqual(first=registry.render("greet", name="A"), second="Hello A")
+            with open(path, "w") as f:
+                f.write("Bye {name}")
+            os.utime(path, (0, 12345))
+            self.assertEqual(first=registry.render("greet", name="A"), second="Bye A")
+
+    def test_background_loop(self):
+        """Check that `alana.run` runs coroutines on one persistent loop, sharing one async client per key."""
+        import threading
+        from alana.prompt_async import _get_async_client
+
+        async def where():
+            return threading.current_thread().name, _get_async_client(api_key="test")
+
+        first_thread, first_client = alana.run(where())
+        second_thread, second_client = alana.run(where())
+        self.assertEqual(first=first_thread, second="alana-loop")
+        self.assertEqual(first=second_thread, second="alana-loop")
+        self.assertIs(expr1=first_client, expr2=second_client)
+
+        async def nested():
+            return alana.run(where())
+
+        with self.assertRaises(expected_exception=RuntimeError):
+            alana.run(nested())
+
+    def test_gen_tools(self):
+        """Check the tool loop: concurrent dispatch, pure-tool caching and `tool_result` turns (offline)."""
+        from anthropic.types import TextBlock, ToolUseBlock
+
+        calls: List[tuple] = []
+
+        @tool(pure=True)
+        def add(a: int, b: int) -> int:
+            """Add two integers."""
+            calls.append((a, b))
+            return a + b
+
+        def fake_message(stop_reason, *blocks):
+            return Message.model_construct(
+                id="msg",
+                content=list(blocks),
+                model="haiku",
+                role="assistant",
+                stop_reason=stop_reason,
+                stop_sequence=None,
+                type="message",
+                usage=Usage.model_construct(input_tokens=1, output_tokens=1),
+            )
+
+        def use(id, a, b):
+            return ToolUseBlock.model_construct(
+                id=id, name="add", input={"a": a, "b": b}, type="tool_use"
+            )
+
+        outputs = [
+            fake_message("tool_use", use("t1", 1, 2), use("t2", 3, 4)),
+            fake_message("tool_use", use("t3", 1, 2)),
+            fake_message(
+                "end_turn", TextBlock.model_construct(text="3 and 7", type="text")
+            ),
+        ]
+        sent_tools = []
+
+        def fake_gen_msg(tools, **kwargs):
+            sent_tools.append(tools)
+            return outputs[len(sent_tools) - 1]
+
+        messages: List[MessageParam] = []
+        with patch("alana.tools.gen_msg", new=fake_gen_msg):
+            text: str = gen_tools(
+                user="Add some numbers", tools=[add], messages=messages
+            )
+        self.assertEqual(first=text, second="3 and 7")
+        self.assertEqual(first=sorted(calls), second=[(1, 2), (3, 4)])
+        self.assertEqual(
+            first=sent_tools[0][0]["input_schema"]["required"], second=["a", "b"]
+        )
+        self.assertEqual(
+            first=[m["role"] for m in messages],
+            second=["user", "assistant", "user", "assistant", "user", "assistant"],
+        )
+        self.assertEqual(
+            first=[r["content"] for r in messages[2]["content"]], second=["3", "7"]
+        )
+        self.assertEqual(first=messages[4]["content"][0]["tool_use_id"], second="t3")
+
     def test_respond(self):
         """Check that respond correctly appends a user message."""
         messages: list[MessageParam] = [
@@ -286,6 +781,690 @@ class TestFunctions(unittest.TestCase):
 
 class AsyncTest(unittest.IsolatedAsyncioTestCase):
 
+    async def test_agen_msg_builds_on_astream(self):
+        """Check that `agen_msg` forwards text deltas to `stream_action` and returns the final message (offline)."""
+        from alana.stream import StreamEvent
+
+        final = object()
+
+        async def fake_astream(**kwargs):
+            for text in ["Hel", "lo"]:
+                yield StreamEvent(type="text", text=text)
+            yield StreamEvent(type="message_stop", message=final)  # type: ignore
+
+        received: List[str] = []
+        with patch("alana.prompt_async.astream", new=fake_astream):
+            message = await agen_msg(user="Hi", stream_action=received.append)
+        self.assertEqual(first=received, second=["Hel", "lo"])
+        self.assertIs(expr1=message, expr2=final)
+
+    async def test_stop_when(self):
+        """Check that stop predicates close the stream early, and that `agen_examples_list` uses them (offline)."""
+        from types import SimpleNamespace
+        from anthropic.types import TextBlock
+        from alana.stream import Matches, TagsClosed
+
+        pieces = [
+            "<example>a</exa",
+            "mple>\n<example>b<",
+            "/example>",
+            "<example>c</example>",
+            " bye",
+        ]
+        sent: List[str] = []
+
+        class FakeStream:
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            @property
+            def current_message_snapshot(self):
+                return Message(
+                    id="msg",
+                    content=[TextBlock(text="".join(sent), type="text")],
+                    model="haiku",
+                    role="assistant",
+                    stop_reason=None,
+                    type="message",
+                    usage=Usage(input_tokens=10, output_tokens=1),
+                )
+
+            async def __aiter__(self):
+                for piece in pieces:
+                    sent.append(piece)
+                    yield SimpleNamespace(
+                        type="content_block_delta",
+                        index=0,
+                        delta=SimpleNamespace(type="text_delta", text=piece),
+                    )
+
+        client = SimpleNamespace(
+            messages=SimpleNamespace(stream=lambda **kwargs: FakeStream())
+        )
+        with patch("alana.prompt_async._get_async_client", return_value=client):
+            examples = await agen_examples_list(
+                instruction="letters", n_examples=2, stream_action=None
+            )
+            self.assertEqual(first=examples, second=["a", "b"])
+            self.assertEqual(first=len(sent), second=3)
+            sent.clear()
+            events = [
+                e
+                async for e in alana.prompt_async.astream(
+                    user="Hi", stop_when=[Matches(r"c<")]
+                )
+            ]
+        self.assertEqual(first=len(sent), second=4)
+        self.assertEqual(first=events[-2].stop_reason, second="stop_sequence")
+        self.assertEqual(first=events[-1].message.stop_reason, second="stop_sequence")
+        predicate = TagsClosed("t", n=2)
+        self.assertFalse(predicate("<t>x<t>y</t"))
+        self.assertFalse(predicate("<t>x<t>y</t>"))
+        self.assertTrue(predicate("<t>x<t>y</t></t><t/><t>z</t>"))
+
+    async def test_resume(self):
+        """Check that a stream cut off mid-way resumes from an assistant prefill, as one stream with merged usage (offline)."""
+        from types import SimpleNamespace
+        from anthropic import APIConnectionError
+        from anthropic.types import TextBlock
+
+        legs = [["Once upon", " a time, ", "there "], [" was", " a fox."]]
+        requests: List[List[MessageParam]] = []
+
+        class FakeStream:
+            def __init__(self, messages):
+                self.pieces = legs[len(requests)]
+                self.drop = len(requests) == 0
+                requests.append(messages)
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            def message(self, text, output_tokens):
+                return Message(
+                    id="msg",
+                    content=[TextBlock(text=text, type="text")],
+                    model="haiku",
+                    role="assistant",
+                    stop_reason="end_turn",
+                    type="message",
+                    usage=Usage(input_tokens=10, output_tokens=output_tokens),
+                )
+
+            async def get_final_message(self):
+                return self.message("".join(self.pieces), output_tokens=3)
+
+            async def __aiter__(self):
+                yield SimpleNamespace(type="message_start", message=self.message("", 1))
+                for piece in self.pieces:
+                    yield SimpleNamespace(
+                        type="content_block_delta",
+                        index=0,
+                        delta=SimpleNamespace(type="text_delta", text=piece),
+                    )
+                if self.drop:
+                    raise APIConnectionError(request=None)
+
+        client = SimpleNamespace(
+            messages=SimpleNamespace(
+                stream=lambda messages, **kwargs: FakeStream(messages)
+            )
+        )
+        with patch("alana.prompt_async._get_async_client", return_value=client):
+            events = [
+                e
+                async for e in alana.prompt_async.astream(
+                    user="Tell a story.", max_tokens=100
+                )
+            ]
+        self.assertEqual(
+            first=requests[1][-1],
+            second={"role": "assistant", "content": "Once upon a time, there"},
+        )
+        self.assertEqual(
+            first=[e.type for e in events].count("message_start"), second=1
+        )
+        text: str = "".join(e.text for e in events if e.type == "text")
+        self.assertEqual(first=text, second="Once upon a time, there was a fox.")
+        message = events[-1].message
+        self.assertEqual(first=message.content[0].text, second=text)
+        self.assertEqual(first=message.usage.input_tokens, second=20)
+        self.assertEqual(first=message.usage.output_tokens, second=3 + 24 // 4)
+
+        requests.clear()
+        legs[0] = ["Hi"]
+        with patch("alana.prompt_async._get_async_client", return_value=client):
+            with self.assertRaises(APIConnectionError):
+                await agen_msg(user="Hi", resume=0, stream_action=lambda x: None)
+
+    async def test_redact(self):
+        """Check that `Redactor` hides tagged sections across delta boundaries and captures them (offline)."""
+        from alana.stream import Redactor, StreamEvent, redact
+
+        deltas = ["Hi <reas", "oning>sec", "ret</reasoning", "> there <thinking>hm"]
+        shown: List[str] = []
+        redactor = Redactor(action=shown.append)
+        for delta in deltas:
+            redactor(delta)
+        self.assertEqual(first=shown, second=["Hi ", " there "])
+        redactor.flush()
+        self.assertEqual(
+            first=redactor.sections,
+            second=[("reasoning", "secret"), ("thinking", "hm")],
+        )
+        strict = Redactor(tags=["thinking"], lenient=False)
+        self.assertEqual(
+            first="".join(map(strict.feed, deltas)) + strict.flush(),
+            second="Hi <reasoning>secret</reasoning> there <thinking>hm",
+        )
+
+        async def events():
+            for delta in deltas[:3] + ["> done"]:
+                yield StreamEvent(type="text", text=delta)
+            yield StreamEvent(type="message_stop")
+
+        texts = [e.text async for e in redact(events()) if e.type == "text"]
+        self.assertEqual(first="".join(texts), second="Hi  done")
+
+    async def test_agen_structured_retries_failing_member(self):
+        """Check that a member failing validation cuts the stream, and the retry prefills the valid prefix (offline)."""
+        from dataclasses import dataclass
+        from alana.stream import StreamEvent
+
+        @dataclass
+        class City:
+            name: str
+            population: int
+
+        attempts = [
+            ['"name": "Pa', 'ris", "population": "lots", "never": "sent"'],
+            [', "population": 2102650}', " trailing"],
+        ]
+        prefills: List[str] = []
+
+        async def fake_astream(messages, **kwargs):
+            prefills.append(messages[-1]["content"])
+            for text in attempts[len(prefills) - 1]:
+                yield StreamEvent(type="text", text=text)
+
+        with patch("alana.prompt_async.astream", new=fake_astream):
+            city = await agen_structured(City, user="Biggest city in France?")
+        self.assertEqual(first=city, second=City(name="Paris", population=2102650))
+        self.assertEqual(first=prefills, second=["{", '{"name": "Paris"'])
+
+    async def test_run_tools_in_loop(self):
+        """Check that sync `run_tools` can run a single async tool from inside a running event loop."""
+        from types import SimpleNamespace
+        from alana.tools import run_tools
+
+        async def double(x: int) -> int:
+            return 2 * x
+
+        block = SimpleNamespace(id="t1", name="double", input={"x": 21})
+        results = run_tools([block], functions={"double": double})
+        self.assertEqual(first=results[0]["content"], second="42")
+        self.assertNotIn(member="is_error", container=results[0])
+
+    async def test_agen_n_stops_early(self):
+        """Check that `agen_n` cancels the remaining samples once one is accepted (offline)."""
+        from alana.stream import StreamEvent
+
+        replies = iter(["bad", "good", "slow", "slower"])
+        delays = iter([0.0, 0.01, 1.0, 1.0])
+
+        async def fake_astream(**kwargs):
+            reply, delay = next(replies), next(delays)
+            yield StreamEvent(type="message_start")
+            await asyncio.sleep(delay)
+            yield StreamEvent(type="text", text=reply)
+
+        with patch("alana.prompt_async.astream", new=fake_astream):
+            candidates = await agen_n(
+                n=4, user="Hi", validator=lambda text: text == "good"
+            )
+        self.assertEqual(first=candidates.texts, second=["bad", "good", None, None])
+        self.assertEqual(first=(candidates.accepted, candidates.best), second=(1, 1))
+        self.assertEqual(first=candidates.best_text, second="good")
+
+    async def test_agen_n_survives_failures(self):
+        """Check that a failed sample doesn't sink `agen_n`, unless every sample fails (offline)."""
+        from anthropic import APIConnectionError
+        from alana.stream import StreamEvent
+
+        replies = iter(["a", None, "abc"])
+
+        async def fake_astream(**kwargs):
+            reply = next(replies)
+            yield StreamEvent(type="message_start")
+            if reply is None:
+                raise APIConnectionError(request=None)
+            yield StreamEvent(type="text", text=reply)
+
+        with patch("alana.prompt_async.astream", new=fake_astream):
+            candidates = await agen_n(n=3, user="Hi", scorer=len, cache_prefix=False)
+        self.assertEqual(first=candidates.texts, second=["a", None, "abc"])
+        self.assertEqual(first=candidates.best_text, second="abc")
+        self.assertIsInstance(obj=candidates.errors[1], cls=APIConnectionError)
+
+        replies = iter([None, None])
+        with patch("alana.prompt_async.astream", new=fake_astream):
+            with self.assertRaises(APIConnectionError):
+                await agen_n(n=2, user="Hi")
+
+    async def test_agen_n_stop_when(self):
+        """Check that concurrent `agen_n` samples don't share stop predicate state, and that cancelled samples count towards usage (offline)."""
+        from alana.stream import StreamEvent, TagsClosed
+
+        pieces = ["<example>", "one", "</example>", " and more"]
+
+        async def fake_astream(stop_when, **kwargs):
+            yield StreamEvent(
+                type="message_start",
+                message=Message.model_construct(
+                    usage=Usage(input_tokens=10, output_tokens=1)
+                ),
+            )
+            text = ""
+            for piece in pieces:
+                await asyncio.sleep(0.001)
+                text += piece
+                yield StreamEvent(type="text", text=piece)
+                if any(predicate(text) for predicate in stop_when):
+                    return
+
+        stop_when = [TagsClosed("example")]
+        with patch("alana.prompt_async.astream", new=fake_astream):
+            candidates = await agen_n(n=3, user="Hi", stop_when=stop_when)
+        self.assertEqual(first=candidates.texts, second=["<example>one</example>"] * 3)
+        self.assertEqual(first=stop_when[0].closed, second=0)
+        self.assertEqual(first=candidates.input_tokens, second=30)
+
+    async def test_avote_stops_when_decisive(self):
+        """Check that `avote` stops after the wave where the vote becomes decisive (offline)."""
+        from alana.sampling import Candidates
+
+        waves: List[List[str]] = []
+
+        async def fake_agen_n(n, **kwargs):
+            texts = ["<answer> Yes </answer>" for _ in range(n)]
+            waves.append(texts)
+            return Candidates(texts=texts, scores=[None] * n, output_tokens=10 * n)
+
+        with patch("alana.sampling.agen_n", new=fake_agen_n):
+            result = await avote(user="?", wave_size=3, max_samples=12)
+        # 3 unanimous votes give p = 1/8, 6 give p = 1/64 <= 0.05.
+        self.assertEqual(first=len(waves), second=2)
+        self.assertEqual(first=result.answer, second="yes")
+        self.assertEqual(first=result.distribution, second={"yes": 6})
+        self.assertEqual(first=result.tokens_saved, second=60)
+
+    async def test_micro_batching(self):
+        """Check that concurrent small `agen` calls are packed into one request, with per-item fallback (offline)."""
+        from anthropic.types import TextBlock
+        import alana.batching
+
+        prompts: List[str] = []
+
+        async def fake_agen_msg(user, **kwargs):
+            prompts.append(user)
+            if (
+                '<item id="1">' in user
+            ):  # The packed request. Pretend the model skipped item 1.
+                text = "<answer_0>A</answer_0><answer_2>C</answer_2>"
+            else:
+                text = f"single {user}"
+            return Message.model_construct(
+                content=[TextBlock.model_construct(text=text, type="text")]
+            )
+
+        alana.batching.enable(window=0.01)
+        try:
+            with patch("alana.prompt_async.agen_msg", new=fake_agen_msg):
+                answers = await asyncio.gather(
+                    *(agen(user=u, max_tokens=64, stream_action=None) for u in "abc")
+                )
+        finally:
+            alana.batching.disable()
+        self.assertEqual(first=answers, second=["A", "single b", "C"])
+        self.assertEqual(first=len(prompts), second=2)
+
+        budgets: List[int] = []
+
+        async def fake_packed(users, max_tokens, **settings):
+            budgets.append(max_tokens)
+            return [u.upper() for u in users]
+
+        alana.batching.enable(window=0.01, max_batch=16)
+        try:
+            with patch("alana.batching._packed", new=fake_packed):
+                answers = await asyncio.gather(
+                    *(
+                        agen(user=f"q{i}", max_tokens=512, stream_action=None)
+                        for i in range(16)
+                    )
+                )
+        finally:
+            alana.batching.disable()
+        self.assertEqual(first=answers, second=[f"Q{i}" for i in range(16)])
+        self.assertEqual(first=budgets, second=[4096, 4096])
+
+    async def test_scheduler(self):
+        """Check that `Scheduler` serves priority classes in order and interleaves tenants fairly."""
+        from alana.scheduler import Scheduler
+
+        scheduler = Scheduler(max_concurrency=1)
+        order: List[str] = []
+        release = asyncio.Event()
+
+        async def request(priority, tenant, name):
+            async with scheduler.slot(priority=priority, tenant=tenant, cost=10):
+                order.append(name)
+                if name == "first":
+                    await release.wait()
+
+        requests = [("interactive", "x", "first"), ("background", "x", "bg")]
+        requests += [("batch", "a", f"a{i}") for i in range(3)]
+        requests += [("batch", "b", f"b{i}") for i in range(3)]
+        requests += [("interactive", "x", "urgent")]
+        tasks = []
+        for priority, tenant, name in requests:
+            tasks.append(asyncio.ensure_future(request(priority, tenant, name)))
+            await asyncio.sleep(0)
+        self.assertEqual(first=scheduler.metrics()["queue_depth"]["batch"], second=6)
+        release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(
+            first=order,
+            second=["first", "urgent", "a0", "b0", "a1", "b1", "a2", "b2", "bg"],
+        )
+        self.assertEqual(first=scheduler.metrics()["running"], second=0)
+
+    async def test_job_queue(self):
+        """Check that `JobQueue` dedupes keys, retries failures, and skips finished jobs on a re-run (offline)."""
+        from anthropic.types import TextBlock
+        from alana.jobs import JobQueue
+
+        calls: List[str] = []
+
+        async def fake_agen_msg(user, **kwargs):
+            calls.append(user)
+            if user == "b" and calls.count("b") == 1:
+                raise ConnectionError("dropped")
+            return Message.model_construct(
+                content=[TextBlock.model_construct(text=user.upper(), type="text")],
+                model="fake",
+                role="assistant",
+                type="message",
+                id="msg",
+                stop_reason="end_turn",
+                usage=Usage(input_tokens=1, output_tokens=1),
+            )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            queue = JobQueue(os.path.join(tmp, "jobs.db"))
+            queue.add_many([{"user": u} for u in "abc"])
+            queue.add(user="a")  # Same request, same key: ignored.
+            with patch("alana.prompt_async.agen_msg", new=fake_agen_msg):
+                counts = await queue.arun(
+                    workers=2, sink=os.path.join(tmp, "out.jsonl")
+                )
+                self.assertEqual(first=counts, second={"done": 3})
+                self.assertEqual(first=len(calls), second=4)
+                await queue.arun(workers=2)
+                self.assertEqual(first=len(calls), second=4)
+            with open(os.path.join(tmp, "out.jsonl")) as f:
+                texts = sorted(json.loads(line)["text"] for line in f)
+            self.assertEqual(first=texts, second=["A", "B", "C"])
+            queue.close()
+
+    async def test_job_queue_resumes_after_crash(self):
+        """Check that a restarted `arun` requeues jobs left running by a dead run, without waiting for their lease (offline)."""
+        import sys
+        import socket
+        import subprocess
+        from anthropic.types import TextBlock
+        from alana.jobs import JobQueue
+
+        async def fake_agen_msg(user, **kwargs):
+            return Message.model_construct(
+                content=[TextBlock.model_construct(text=user, type="text")],
+                model="fake",
+                stop_reason="end_turn",
+                usage=Usage(input_tokens=1, output_tokens=1),
+            )
+
+        dead = subprocess.Popen([sys.executable, "-c", "pass"])
+        dead.wait()
+        with tempfile.TemporaryDirectory() as tmp:
+            queue = JobQueue(os.path.join(tmp, "jobs.db"))
+            queue.add_many([{"user": u} for u in "abcd"])
+            host: str = socket.gethostname()
+            queue._claim(f"{host}:{dead.pid}:crashed")  # Another process that died.
+            queue._claim(
+                f"{host}:{os.getpid()}:crashed"
+            )  # An earlier run in this process.
+            queue._claim(f"elsewhere:{dead.pid}:live")  # Another host: keeps its lease.
+            self.assertEqual(first=queue.counts(), second={"running": 3, "pending": 1})
+            with patch("alana.prompt_async.agen_msg", new=fake_agen_msg):
+                counts = await queue.arun(workers=2)
+            self.assertEqual(first=counts, second={"done": 3, "running": 1})
+            queue.close()
+
+    async def test_run_dataset(self):
+        """Check that `arun_dataset` renders rows, extracts typed tag columns, keeps row order and uses the cache (offline)."""
+        from alana.dataset import arun_dataset
+
+        async def fake_agen(user, **kwargs):
+            await asyncio.sleep(0.001 * (len(user) % 3))
+            return f"<n>{len(user)}</n>" if "bad" not in user else "no tags"
+
+        rows = [{"word": w} for w in ["a", "bb", "ccc", "bad", "eeeee"]]
+        cache = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "out.jsonl")
+            with patch("alana.prompt_async.agen", new=fake_agen):
+                stats = await arun_dataset(
+                    rows,
+                    "Word: {word}",
+                    output,
+                    tags={"n": int},
+                    chunk_size=2,
+                    cache=cache,
+                )
+                again = await arun_dataset(
+                    rows, "Word: {word}", output, tags={"n": int}, cache=cache
+                )
+            with open(output) as f:
+                written = [json.loads(line) for line in f]
+        self.assertEqual(first=stats, second={"rows": 5, "cached": 0, "errors": 0})
+        self.assertEqual(first=again["cached"], second=5)
+        self.assertEqual(
+            first=[r["word"] for r in written], second=[r["word"] for r in rows]
+        )
+        self.assertEqual(first=[r["n"] for r in written], second=[7, 8, 9, None, 11])
+
+        requests: List[dict] = []
+
+        async def fake_agen_messages(messages, system, **kwargs):
+            requests.append({"content": messages[0]["content"], "system": system})
+            return "<n>1</n>"
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with patch("alana.prompt_async.agen", new=fake_agen_messages):
+                prefixed = await arun_dataset(
+                    rows[:2],
+                    "Count the letters. Word: {word}",
+                    os.path.join(tmp, "out.jsonl"),
+                    tags={"n": int},
+                    system="Be brief.",
+                    cache_prefix=True,
+                )
+        self.assertEqual(first=prefixed["errors"], second=0)
+        self.assertEqual(
+            first=requests[0]["content"][0],
+            second={
+                "type": "text",
+                "text": "Count the letters. Word: ",
+                "cache_control": {"type": "ephemeral"},
+            },
+        )
+        self.assertEqual(
+            first=[r["content"][1]["text"] for r in requests], second=["a", "bb"]
+        )
+        self.assertEqual(
+            first=requests[0]["system"][0]["cache_control"],
+            second={"type": "ephemeral"},
+        )
+
+    async def test_run_dataset_outputs(self):
+        """Check that Parquet output survives the first error or tag value arriving in a later chunk, and CSV output rows with different keys (offline)."""
+        from alana.dataset import arun_dataset
+
+        async def fake_agen(user, **kwargs):
+            if "bad" in user:
+                raise ConnectionError("dropped")
+            return "<n>1</n>" if "late" in user else "no tags"
+
+        rows = [{"word": "a"}, {"word": "b"}, {"word": "late", "note": "x"}]
+        rows += [{"word": "bad"}]
+        with tempfile.TemporaryDirectory() as tmp:
+            with patch("alana.prompt_async.agen", new=fake_agen):
+                csv_stats = await arun_dataset(
+                    rows, "{word}", os.path.join(tmp, "out.csv"), tags={"n": int}
+                )
+                try:
+                    import pyarrow.parquet as pq
+                except ImportError:
+                    return
+                stats = await arun_dataset(
+                    rows,
+                    "{word}",
+                    os.path.join(tmp, "out.parquet"),
+                    tags={"n": int},
+                    chunk_size=2,
+                )
+            table = pq.read_table(os.path.join(tmp, "out.parquet")).to_pylist()
+        self.assertEqual(first=csv_stats["rows"], second=4)
+        self.assertEqual(first=stats, second={"rows": 4, "cached": 0, "errors": 1})
+        self.assertEqual(first=[r["n"] for r in table], second=[None, None, 1, None])
+        self.assertEqual(first=table[3]["error"], second="ConnectionError: dropped")
+
+    async def test_optimize_prompt(self):
+        """Check that `aoptimize_prompt` evaluates candidates, refines from the best one, and caches sub-calls (offline)."""
+        from alana.optimize import aoptimize_prompt
+
+        requests: List[str] = []
+
+        async def fake_agen_prompt(instruction, **kwargs):
+            requests.append(instruction)
+            return {"system": [], "user": f"Prompt {len(requests)}: {{input_data}}"}
+
+        async def fake_agen(user, **kwargs):
+            return user.upper()
+
+        def metric(input_data, output):
+            return float(output.startswith("PROMPT 3"))
+
+        cache = {}
+        with patch("alana.prompt_async.agen_prompt", new=fake_agen_prompt), patch(
+            "alana.prompt_async.agen", new=fake_agen
+        ):
+            result = await aoptimize_prompt(
+                "Shout.", eval_inputs=["a", "b"], metric=metric, k=2, cache=cache
+            )
+            again = await aoptimize_prompt(
+                "Shout.", eval_inputs=["a", "b"], metric=metric, k=2, cache=cache
+            )
+            longer = await aoptimize_prompt(
+                "Shout.",
+                eval_inputs=["a", "b"],
+                metric=metric,
+                k=2,
+                cache=cache,
+                max_tokens=2048,
+            )
+        self.assertEqual(first=len(result.candidates), second=4)
+        self.assertEqual(first=result.best.user, second="Prompt 3: {input_data}")
+        self.assertEqual(
+            first=result.best.outputs, second=["PROMPT 3: A", "PROMPT 3: B"]
+        )
+        self.assertIn(member="<previous_user_prompt>", container=requests[2])
+        self.assertEqual(first=(again.calls, again.cached_calls), second=(0, 12))
+        self.assertEqual(first=longer.cached_calls, second=0)
+
+    async def test_map_reduce(self):
+        """Check `chunk` boundaries and overlap, the reduce tree, and that an edit only re-runs the changed chunk's path (offline)."""
+        from alana.mapreduce import amap_reduce, chunk
+
+        paragraphs: List[str] = [
+            " ".join(f"p{i}w{j}" for j in range(30)) + "." for i in range(40)
+        ]
+        document: str = "\n\n".join(paragraphs)
+        bodies: List[str] = chunk(document, max_tokens=200, overlap=0)
+        self.assertEqual(first="".join(bodies), second=document)
+        self.assertTrue(all(len(body) <= 800 for body in bodies))
+        chunks: List[str] = chunk(document, max_tokens=200, overlap=20)
+        for previous, current in zip(chunks, chunks[1:]):
+            self.assertIn(member=current.split()[0], container=previous.split())
+
+        async def fake_agen(user, **kwargs):
+            return f"<result>{hash(user)}</result>"
+
+        cache = {}
+        with patch("alana.prompt_async.agen", new=fake_agen):
+            result = await amap_reduce(
+                document, "Count.", chunk_tokens=200, overlap=20, fan_in=2, cache=cache
+            )
+            edited = await amap_reduce(
+                document.replace("p7w3 ", "p7w3 edited "),
+                "Count.",
+                chunk_tokens=200,
+                overlap=20,
+                fan_in=2,
+                cache=cache,
+            )
+        n: int = len(result.chunks)
+        self.assertGreater(a=n, b=4)
+        self.assertEqual(first=result.levels, second=math.ceil(math.log2(n)))
+        self.assertEqual(first=result.calls + edited.calls, second=len(cache))
+        self.assertEqual(first=edited.calls, second=1 + edited.levels)
+        with patch("alana.prompt_async.agen", new=fake_agen):
+            longer = await amap_reduce(
+                document,
+                "Count.",
+                chunk_tokens=200,
+                overlap=20,
+                fan_in=2,
+                cache=cache,
+                max_tokens=2048,
+            )
+        self.assertEqual(first=longer.cached_calls, second=0)
+
+    async def test_fanout(self):
+        """Check that `Fanout` hands the same event objects to every consumer."""
+        from alana.stream import Fanout, StreamEvent
+
+        events = [StreamEvent(type="text", text=str(i)) for i in range(100)]
+
+        async def source():
+            for event in events:
+                yield event
+
+        async def collect(consumer):
+            return [event async for event in consumer]
+
+        fan = Fanout(source(), n=3, max_buffer=4)
+        results = await asyncio.gather(*(collect(fan[i]) for i in range(len(fan))))
+        for result in results:
+            self.assertEqual(first=len(result), second=100)
+            self.assertTrue(expr=all(a is b for a, b in zip(result, events)))
+
     @flaky(max_runs=1, min_passes=1)
     async def test_agen(self):
         """Check that `agen` correctly appends to `messages`."""